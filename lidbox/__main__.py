@@ -6,10 +6,11 @@ import sys
 import time
 
 import lidbox
-from lidbox.commands import create_argparser
 
 
 def main():
+    # Imported here to keep this module free of TensorFlow, since worker processes of lidbox.vad_engine import the main module when they start
+    from lidbox.commands import create_argparser
     profile = None
     if "--run-cProfile" in sys.argv:
         import cProfile
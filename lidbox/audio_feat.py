@@ -6,7 +6,8 @@ import collections
 
 import tensorflow as tf
 import numpy as np
-import webrtcvad
+
+from . import vad_engine
 
 
 Wav = collections.namedtuple("Wav", ["audio", "sample_rate"])
@@ -28,10 +29,49 @@ def power_to_db(S, ref=tf.math.reduce_max, amin=1e-10, top_db=80.0):
     db_spectrogram = 20.0 * (log10(tf.math.maximum(amin, S)) - log10(tf.math.maximum(amin, ref(S))))
     return tf.math.maximum(db_spectrogram, tf.math.reduce_max(db_spectrogram) - top_db)
 
+@tf.function
+def power_to_db_masked(S, mask, amin=1e-10, top_db=80.0):
+    """
+    Same as power_to_db with ref=tf.math.reduce_max, but computed separately for each spectrogram in a batch of zero padded spectrograms S.
+    The boolean matrix mask of shape (batch, frames) must be False for all padded frames.
+    """
+    mask = tf.expand_dims(mask, -1)
+    ref = tf.math.reduce_max(tf.where(mask, S, tf.zeros_like(S)), axis=[1, 2], keepdims=True)
+    db_spectrogram = 20.0 * (log10(tf.math.maximum(amin, S)) - log10(tf.math.maximum(amin, ref)))
+    db_max = tf.math.reduce_max(tf.where(mask, db_spectrogram, tf.fill(tf.shape(db_spectrogram), db_spectrogram.dtype.min)), axis=[1, 2], keepdims=True)
+    return tf.math.maximum(db_spectrogram, db_max - top_db)
+
 @tf.function
 def ms_to_frames(sample_rate, ms):
     return tf.cast(tf.cast(sample_rate, tf.float32) * 1e-3 * tf.cast(ms, tf.float32), tf.int32)
 
+def spectrogram_lengths(signal_lengths, sample_rate, frame_length_ms=25, frame_step_ms=10, **spec_kwargs):
+    """Amount of frames that spectrograms produces from signals of given lengths, without padding."""
+    frame_length = ms_to_frames(sample_rate, frame_length_ms)
+    frame_step = ms_to_frames(sample_rate, frame_step_ms)
+    return tf.math.maximum(0, 1 + (signal_lengths - frame_length) // frame_step)
+
+@tf.function
+def fft_resample(signal, new_length):
+    """Resample a 1-dimensional signal to new_length samples by truncating or zero padding its spectrum."""
+    length = tf.size(signal)
+    X = tf.signal.rfft(signal, fft_length=tf.expand_dims(length, 0))
+    num_bins = new_length // 2 + 1
+    X = tf.pad(X, [[0, tf.math.maximum(0, num_bins - tf.size(X))]])[:num_bins]
+    scale = tf.cast(new_length, tf.float32) / tf.cast(length, tf.float32)
+    return scale * tf.signal.irfft(X, fft_length=tf.expand_dims(new_length, 0))
+
+@tf.function
+def change_speed(wav, rate):
+    """
+    Speed perturbation without changing the sample rate.
+    Equal to resampling wav.audio from sample rate rate*wav.sample_rate to wav.sample_rate.
+    """
+    if rate == 1.0:
+        return wav
+    new_length = tf.cast(tf.math.round(tf.cast(tf.size(wav.audio), tf.float32) / rate), tf.int32)
+    return Wav(fft_resample(wav.audio, new_length), wav.sample_rate)
+
 @tf.function
 def spectrograms(signals, frame_length_ms=25, frame_step_ms=10, power=2.0, fmin=0.0, fmax=8000.0, fft_length=512):
     tf.debugging.assert_rank(signals.audio, 2, "Expected input signals from which to compute spectrograms to be of shape (batch_size, signal_frames)")
@@ -92,27 +132,147 @@ def framewise_mfcc_energy_vad_decisions(wav, spec_kwargs, melspec_kwargs, energy
     return vad_decisions
 
 @tf.function
-def wav_to_bytes(wav):
+def wav_to_pcm16(wav):
+    """
+    Convert a float32 signal in range [-1, 1] to int16 PCM samples without encoding it into any container format.
+    Same scaling as tf.audio.encode_wav, i.e. the inverse of dividing int16 samples by 2^15 when decoding.
+    """
     tf.debugging.assert_rank(wav.audio, 1, message="Expected a single 1D signal (i.e. one mono audio tensor without explicit channels)")
-    wav_bytes = tf.audio.encode_wav(tf.expand_dims(wav.audio, -1), wav.sample_rate)
-    # expecting one wav pcm header and sample width of 2
-    tf.debugging.assert_equal(tf.strings.length(wav_bytes) - 44, 2 * tf.size(wav.audio), message="wav encoding failed")
-    # drop wav header
-    wav_bytes = tf.strings.substr(wav_bytes, 44, -1)
-    return wav_bytes
-
-#TODO cleanup and/or webrtcvad in tf graph (might be nontrivial)
-def framewise_webrtcvad_decisions(wav_length, wav_bytes, sample_rate, vad_frame_length, vad_frame_step, feat_frame_length, feat_frame_step, aggressiveness):
-    frame_begin_pos = 2 * np.arange(0, wav_length, feat_frame_step)
-    num_feat_frames = (wav_length - feat_frame_length + feat_frame_step) // feat_frame_step
-    num_vad_frames = (feat_frame_length - vad_frame_length + vad_frame_step) // vad_frame_step
-    frame_begin_pos = frame_begin_pos[:num_feat_frames]
-    vad_decisions = np.zeros([num_feat_frames], np.bool)
-    vad = webrtcvad.Vad(aggressiveness)
-    for i, feat_begin in enumerate(frame_begin_pos):
-        feat_frame_bytes = wav_bytes[feat_begin:feat_begin + 2 * feat_frame_length]
-        vad_begin = 2 * np.arange(0, feat_frame_length - vad_frame_step, vad_frame_step)
-        for j in vad_begin:
-            vad_frame = feat_frame_bytes[j:j + 2 * vad_frame_length]
-            vad_decisions[i] |= (len(vad_frame) < 2 * vad_frame_length or vad.is_speech(vad_frame, sample_rate))
-    return vad_decisions
+    return tf.cast(tf.clip_by_value(tf.math.round(32768.0 * wav.audio), -32768.0, 32767.0), tf.int16)
+
+def float_to_pcm16(signal):
+    """NumPy version of wav_to_pcm16."""
+    return np.clip(np.rint(32768.0 * signal), -32768, 32767).astype(np.int16)
+
+def framewise_webrtcvad_decisions(wav_length, pcm, sample_rate, vad_frame_length, vad_frame_step, feat_frame_length, feat_frame_step, aggressiveness):
+    """
+    For every feature frame, True if webrtcvad classifies any VAD frame inside the feature frame as speech.
+    Adjacent feature frames overlap, so every distinct VAD frame is evaluated only once in the vad_engine worker pool and the decisions are then gathered for all feature frames.
+    """
+    num_feat_frames = max(0, (wav_length - feat_frame_length + feat_frame_step) // feat_frame_step)
+    # Begin positions of all VAD frames relative to the beginning of a feature frame
+    vad_offsets = np.arange(0, feat_frame_length - vad_frame_step, vad_frame_step)
+    if np.any(vad_offsets + vad_frame_length > feat_frame_length):
+        # VAD frames cut short by the end of the feature frame are always considered speech
+        return np.ones([num_feat_frames], np.bool_)
+    vad_begin = feat_frame_step * np.arange(num_feat_frames).reshape(-1, 1) + vad_offsets.reshape(1, -1)
+    unique_vad_begin, vad_index = np.unique(vad_begin.ravel(), return_inverse=True)
+    vad_decisions = vad_engine.parallel_webrtcvad_decisions(
+        pcm,
+        sample_rate,
+        unique_vad_begin,
+        vad_frame_length,
+        aggressiveness)
+    return vad_decisions[vad_index].reshape(vad_begin.shape).any(axis=1)
+
+
+# Amount of adjacent mel filters multiplied together in FeatureFrontEnd with sparse_mel_bands
+MEL_BLOCK_SIZE = 8
+
+class FeatureFrontEnd(tf.keras.layers.Layer):
+    """
+    Spectrogram, melspectrogram, log and MFCC extraction in a single layer, for signals with a fixed sample rate.
+    Computes the same features as tf_data.extract_features, but the frequency band, mel weights and DCT weights are precomputed constants, and the frequency band is selected by slicing a contiguous range of FFT bins.
+    If trim_mel_band is True, FFT bins that have zero weight for all mel bins are also sliced off before the mel matrix multiplication.
+    If sparse_mel_bands is True, the banded mel matrix is split into blocks of MEL_BLOCK_SIZE adjacent mel filters, and each block is multiplied only with the FFT bins it covers, which skips most zeros of the mel matrix.
+    Input is a batch of signals of shape (batch_size, samples), output is a batch of features of shape (batch_size, frames, feature_dim).
+    """
+    def __init__(self, sample_rate, feattype="logmelspectrogram", spectrogram=None, melspectrogram=None, mfcc=None, db_spectrogram=None, trim_mel_band=True, sparse_mel_bands=False, name="feature_frontend", **kwargs):
+        super().__init__(name=name, **kwargs)
+        assert feattype in ("spectrogram", "melspectrogram", "logmelspectrogram", "mfcc", "db_spectrogram"), "unknown feature type '{}'".format(feattype)
+        self.sample_rate = int(sample_rate)
+        self.feattype = feattype
+        self.spectrogram = dict(spectrogram or {})
+        self.melspectrogram = dict(melspectrogram or {})
+        self.mfcc = dict(mfcc or {})
+        self.db_spectrogram = dict(db_spectrogram or {})
+        self.trim_mel_band = trim_mel_band
+        self.sparse_mel_bands = sparse_mel_bands
+        # Defaults of spectrograms and melspectrograms
+        spec_kwargs = dict({"frame_length_ms": 25, "frame_step_ms": 10, "power": 2.0, "fmin": 0.0, "fmax": 8000.0, "fft_length": 512}, **self.spectrogram)
+        melspec_kwargs = dict({"num_mel_bins": 40, "fmin": 60.0, "fmax": 6000.0}, **self.melspectrogram)
+        # Same float32 arithmetic as ms_to_frames
+        ms_to_frames = lambda ms: int(np.float32(self.sample_rate) * np.float32(1e-3) * np.float32(ms))
+        self.frame_length = ms_to_frames(spec_kwargs["frame_length_ms"])
+        self.frame_step = ms_to_frames(spec_kwargs["frame_step_ms"])
+        self.fft_length = int(spec_kwargs["fft_length"])
+        self.power = float(spec_kwargs["power"])
+        fft_freqs = fft_frequencies(self.sample_rate, self.fft_length).numpy()
+        bins_in_band = np.flatnonzero((spec_kwargs["fmin"] <= fft_freqs) & (fft_freqs <= spec_kwargs["fmax"]))
+        self.band_begin, self.band_end = int(bins_in_band[0]), int(bins_in_band[-1]) + 1
+        assert np.all(np.diff(bins_in_band) == 1)
+        self.mel_weights = None
+        self.dct_weights = None
+        if feattype in ("melspectrogram", "logmelspectrogram", "mfcc"):
+            mel_weights = tf.signal.linear_to_mel_weight_matrix(
+                num_mel_bins=melspec_kwargs["num_mel_bins"],
+                num_spectrogram_bins=self.band_end - self.band_begin,
+                sample_rate=self.sample_rate,
+                lower_edge_hertz=melspec_kwargs["fmin"],
+                upper_edge_hertz=melspec_kwargs["fmax"]).numpy()
+            if trim_mel_band:
+                nonzero_rows = np.flatnonzero(np.any(mel_weights != 0, axis=1))
+                mel_weights = mel_weights[nonzero_rows[0]:nonzero_rows[-1]+1]
+                self.band_begin, self.band_end = self.band_begin + int(nonzero_rows[0]), self.band_begin + int(nonzero_rows[-1]) + 1
+            self.mel_weights = tf.constant(mel_weights, tf.float32)
+            if sparse_mel_bands:
+                # Every mel filter is nonzero only in one contiguous range of FFT bins.
+                # Split the mel bins into blocks of adjacent filters and multiply each block only with the FFT bins covered by its filters.
+                is_nonzero = mel_weights != 0
+                self.mel_blocks = []
+                for mel_begin in range(0, mel_weights.shape[1], MEL_BLOCK_SIZE):
+                    mel_end = min(mel_begin + MEL_BLOCK_SIZE, mel_weights.shape[1])
+                    nonzero_rows = np.flatnonzero(np.any(is_nonzero[:, mel_begin:mel_end], axis=1))
+                    if nonzero_rows.size == 0:
+                        nonzero_rows = np.array([0])
+                    fft_begin, fft_end = int(nonzero_rows[0]), int(nonzero_rows[-1]) + 1
+                    self.mel_blocks.append((fft_begin, fft_end, tf.constant(mel_weights[fft_begin:fft_end, mel_begin:mel_end], tf.float32)))
+        if feattype == "mfcc":
+            # Equal to tf.signal.mfccs_from_log_mel_spectrograms, i.e. DCT-II scaled by 1/sqrt(2N), restricted to the coefficients [coef_begin, coef_end)
+            N = melspec_kwargs["num_mel_bins"]
+            n, k = np.meshgrid(np.arange(N), np.arange(N), indexing="ij")
+            dct_weights = 2.0 * np.cos(np.pi * k * (2 * n + 1) / (2 * N)) / np.sqrt(2 * N)
+            coef_begin = self.mfcc.get("coef_begin", 1)
+            coef_end = self.mfcc.get("coef_end", 13)
+            self.dct_weights = tf.constant(dct_weights[:, coef_begin:coef_end], tf.float32)
+
+    def call(self, inputs, lengths=None):
+        """If lengths of the signals is given, the inputs are assumed to be zero padded and db_spectrogram references are computed from non-padded frames only."""
+        S = tf.signal.stft(inputs, self.frame_length, self.frame_step, fft_length=self.fft_length)
+        S = S[..., self.band_begin:self.band_end]
+        if self.power == 2.0:
+            S = tf.math.square(tf.math.abs(S))
+        else:
+            S = tf.math.pow(tf.math.abs(S), self.power)
+        if self.feattype == "spectrogram":
+            return S
+        if self.feattype == "db_spectrogram":
+            if lengths is None:
+                # Same reference as extract_features, i.e. the maximum of the whole batch
+                return power_to_db(S, **self.db_spectrogram)
+            num_frames = spectrogram_lengths(lengths, self.sample_rate, **self.spectrogram)
+            return power_to_db_masked(S, tf.sequence_mask(num_frames, tf.shape(S)[1]), **self.db_spectrogram)
+        if self.sparse_mel_bands:
+            S = tf.concat([tf.matmul(S[..., begin:end], weights) for begin, end, weights in self.mel_blocks], axis=-1)
+        else:
+            S = tf.matmul(S, self.mel_weights)
+        if self.feattype == "melspectrogram":
+            return S
+        S = tf.math.log(S + 1e-6)
+        if self.feattype == "logmelspectrogram":
+            return S
+        return tf.matmul(S, self.dct_weights)
+
+    def get_config(self):
+        config = {
+            "sample_rate": self.sample_rate,
+            "feattype": self.feattype,
+            "spectrogram": self.spectrogram,
+            "melspectrogram": self.melspectrogram,
+            "mfcc": self.mfcc,
+            "db_spectrogram": self.db_spectrogram,
+            "trim_mel_band": self.trim_mel_band,
+            "sparse_mel_bands": self.sparse_mel_bands,
+        }
+        base_config = super().get_config()
+        return dict(list(base_config.items()) + list(config.items()))
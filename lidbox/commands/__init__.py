@@ -8,6 +8,7 @@ import os
 import lidbox
 from . import util
 from . import e2e
+from . import serve
 
 
 def create_argparser():
@@ -20,6 +21,7 @@ def create_argparser():
     command_tree = itertools.chain(
         util.command_tree,
         e2e.command_tree,
+        serve.command_tree,
     )
     # Create command line options for all valid commands
     for command_group, subcommands in command_tree:
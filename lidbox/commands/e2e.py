@@ -1,7 +1,10 @@
+import argparse
 import collections
+import contextlib
 import datetime
 import hashlib
 import importlib
+import inspect
 import itertools
 import json
 import os
@@ -15,7 +18,9 @@ import tensorflow as tf
 
 from lidbox import yaml_pprint
 from lidbox.commands.base import BaseCommand, Command, ExpandAbspath
-# from lidbox.metrics import AverageDetectionCost, AverageEqualErrorRate, AveragePrecision, AverageRecall
+import lidbox.audio_feat as audio_feat
+import lidbox.feature_store as feature_store
+import lidbox.metrics as metrics
 import lidbox.models as models
 import lidbox.tf_data as tf_data
 import lidbox.system as system
@@ -77,12 +82,78 @@ def count_dim_sizes(ds, ds_element_index, ndims):
          tf.ragged.boolean_mask(sorted_size_indices, is_nonzero)),
         axis=2)
 
+def parse_shard(shard):
+    """Parse 'i/N' into a pair of ints (i, N)."""
+    try:
+        index, num_shards = (int(x) for x in shard.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected a shard in format i/N, e.g. 0/4, but got '{}'".format(shard))
+    if not 0 <= index < num_shards:
+        raise argparse.ArgumentTypeError("shard index must be in range [0, N) but got '{}'".format(shard))
+    return index, num_shards
+
+def scan_utterance_cache(cache_dir):
+    """
+    Load the indexes of all complete segments of a per-utterance features cache.
+    If several segments contain the features of the same source, e.g. after concurrent writers with different shards, only the first segment is used.
+    """
+    source2entries = collections.defaultdict(list)
+    done_sources = set()
+    feature_rank = None
+    for segment in sorted(os.scandir(cache_dir), key=lambda e: e.name):
+        if not (segment.is_dir() and feature_store.is_complete(segment.path)) or feature_store.is_tmp_dir(segment.path):
+            continue
+        meta = feature_store.load_meta(segment.path)
+        new_sources = set(meta.get("sources", [])) - done_sources
+        done_sources.update(new_sources)
+        if meta["num_records"]:
+            feature_rank = meta["feature_rank"]
+        for entry in feature_store.load_index(segment.path).values():
+            if entry.source in new_sources:
+                source2entries[entry.source].append((segment.path, entry))
+    return source2entries, done_sources, feature_rank
+
+
 def now_str(date=False):
     return str(datetime.datetime.now() if date else int(time.time()))
 
 
+class ChunkScoreAggregator:
+    """Aggregate the scores of chunks, predicted in batches, into utterance-level scores of the source utterances of the chunks."""
+
+    def __init__(self, method, num_labels, output_activation=None):
+        self.method = method
+        self.num_labels = num_labels
+        self.output_activation = output_activation
+        self.utt2scores = {}
+
+    def add(self, chunk_uttids, scores):
+        """Reduce the chunk scores of one batch in the graph and merge them with the reduced scores of previous batches, since the chunks of one utterance can be in several batches."""
+        uttids, reduced, num_chunks = tf_data.reduce_chunk_scores(chunk_uttids, tf.convert_to_tensor(scores), self.method, self.output_activation)
+        for utt, utt_scores, utt_num_chunks in zip(uttids.numpy(), reduced.numpy().astype(np.float64), num_chunks.numpy()):
+            if utt not in self.utt2scores:
+                self.utt2scores[utt] = [utt_scores, utt_num_chunks]
+                continue
+            total = self.utt2scores[utt]
+            if self.method == "max":
+                total[0] = np.maximum(total[0], utt_scores)
+            else:
+                total[0] = total[0] + utt_scores
+            total[1] += utt_num_chunks
+
+    def get_utterance_scores(self):
+        """Return the sorted utterance ids and a matrix with the aggregated scores of each utterance as rows."""
+        uttids = sorted(self.utt2scores)
+        scores = [self.utt2scores[utt][0] if self.method == "max" else self.utt2scores[utt][0] / self.utt2scores[utt][1] for utt in uttids]
+        return [utt.decode("utf-8") for utt in uttids], np.array(scores, dtype=np.float32).reshape((len(uttids), self.num_labels))
+
+
 class E2EBase(Command):
 
+    def __init__(self, args):
+        super().__init__(args)
+        self.utt2meta = {}
+
     @classmethod
     def create_argparser(cls, parent_parser):
         parser = super().create_argparser(parent_parser)
@@ -92,10 +163,255 @@ class E2EBase(Command):
             help="Extract only up to this many files from the wavpath list (e.g. for debugging).")
         return parser
 
+    def get_features_cache_path(self, ds_config, feat_config, datagroup_key, conf_checksum):
+        if ds_config.get("persistent_features_cache", True):
+            features_cache_dir = os.path.join(self.cache_dir, "features")
+        else:
+            features_cache_dir = "/tmp/tensorflow-cache"
+        return os.path.join(
+            features_cache_dir,
+            datagroup_key,
+            feat_config["type"],
+            conf_checksum,
+        )
+
+    def cache_features(self, extractor_ds, ds_config, feat_config, datagroup_key, conf_json, conf_checksum):
+        """
+        Write all features from extractor_ds into a sharded feature store, unless a complete store already exists for this config checksum, and return a dataset that reads all features from the store.
+        If --shard i/N was given, the features are written into part i of the store, and None is returned if some of the N parts are still incomplete.
+        Only one process at a time writes the store, concurrent processes with the same config wait until the store is complete and then read it.
+        """
+        args = self.args
+        features_cache_path = self.get_features_cache_path(ds_config, feat_config, datagroup_key, conf_checksum)
+        self.make_named_dir(os.path.dirname(features_cache_path), "features cache")
+        if not os.path.exists(features_cache_path + ".md5sum-input"):
+            system.write_atomic(features_cache_path + ".md5sum-input", conf_json)
+        utt2dataset = {utt: meta["dataset"] for utt, meta in self.utt2meta.get(datagroup_key, {}).items()}
+        shard = getattr(args, "shard", None)
+        if shard:
+            index, num_shards = shard
+            part_dir = feature_store.get_part_dirs(features_cache_path, num_shards)[index]
+            with system.file_lock(part_dir, verbosity=args.verbosity):
+                if feature_store.is_complete(features_cache_path) or feature_store.is_complete(part_dir):
+                    if args.verbosity:
+                        print("Feature store part {}/{} already exists: '{}'".format(index, num_shards, part_dir))
+                else:
+                    num_store_shards = ds_config.get("feature_store", {}).get("num_shards", 16)
+                    if args.verbosity:
+                        print("Writing features of part {}/{} into new feature store with {} shards: '{}'".format(index, num_shards, num_store_shards, part_dir))
+                    feature_store.write(extractor_ds, part_dir, num_store_shards, utt2dataset, verbosity=args.verbosity)
+        with system.file_lock(features_cache_path, verbosity=args.verbosity):
+            if feature_store.is_complete(features_cache_path):
+                if args.verbosity:
+                    print("Loading features from existing feature store: '{}'".format(features_cache_path))
+            elif shard:
+                if not self.merge_feature_parts(features_cache_path):
+                    return None
+            else:
+                num_shards = ds_config.get("feature_store", {}).get("num_shards", 16)
+                if args.verbosity:
+                    print("Writing features into new feature store with {} shards: '{}'".format(num_shards, features_cache_path))
+                feature_store.write(extractor_ds, features_cache_path, num_shards, utt2dataset, verbosity=args.verbosity)
+        return feature_store.load(features_cache_path)
+
+    def merge_feature_parts(self, features_cache_path):
+        """If all parts of the feature store have been written, merge them into the feature store and return True."""
+        args = self.args
+        part_dirs, num_parts = feature_store.find_part_dirs(features_cache_path)
+        num_complete = sum(feature_store.is_complete(part_dir) for part_dir in part_dirs)
+        if not part_dirs or num_complete < num_parts:
+            if args.verbosity:
+                print("{} of {} parts of feature store '{}' are complete, merge the parts after all parts have been written".format(num_complete, num_parts, features_cache_path))
+            return False
+        assert part_dirs == feature_store.get_part_dirs(features_cache_path, num_parts), "expected parts 0 to {} of feature store '{}' but found {}".format(num_parts - 1, features_cache_path, part_dirs)
+        if args.verbosity:
+            print("All {} parts of feature store '{}' are complete, merging".format(num_parts, features_cache_path))
+        feature_store.merge(part_dirs, features_cache_path, verbosity=args.verbosity)
+        return True
+
+    def select_shard(self, utterance_list):
+        """If --shard i/N was given, return every N'th utterance id, starting at i, from the sorted utterance ids."""
+        shard = getattr(self.args, "shard", None)
+        if not shard:
+            return utterance_list
+        index, num_shards = shard
+        return sorted(utterance_list)[index::num_shards]
+
+    def get_utterance_cache_dir(self, feat_config, datagroup_key):
+        cache_config = feat_config["utterance_cache"]
+        cache_root = cache_config.get("path", os.path.join(self.cache_dir, "utterance-features"))
+        # Augmentation is applied only on the training datagroup
+        is_augmented = datagroup_key == "train" and bool(feat_config.get("wav_config", {}).get("augmentation"))
+        key_config = {k: v for k, v in feat_config.items() if k != "utterance_cache"}
+        key_json = json.dumps({"features": key_config, "augmented": is_augmented}, ensure_ascii=False, sort_keys=True)
+        return os.path.join(cache_root, feat_config["type"], hashlib.md5(key_json.encode("utf-8")).hexdigest())
+
+    def cache_utterance_features(self, datasets, feat_config, datagroup_key, trim_audio, debug_squeeze_last_dim):
+        """
+        Load the features of all utterances of the datagroup from the per-utterance features cache, where the features of each utterance are identified by the md5sum of its audio file and the feature extraction config.
+        Features are extracted only from utterances missing from the cache and written as a new segment into the cache, i.e. each segment is a feature store.
+        Utterance ids and labels of the loaded records are replaced with the ids and labels of the current datasets.
+        """
+        args = self.args
+        cache_dir = self.get_utterance_cache_dir(feat_config, datagroup_key)
+        self.make_named_dir(cache_dir, "utterance features cache")
+        utterance_list, utt2path, utt2meta, _ = self.parse_datagroup(datasets, datagroup_key)
+        if args.verbosity:
+            print("Computing md5sums of {} audio files for looking up features from the utterance features cache '{}'".format(len(utterance_list), cache_dir))
+        # Audio file md5sums do not depend on the feature config and are shared by all caches under the cache root
+        md5sums = system.all_md5sums_cached(
+            [utt2path[utt] for utt in utterance_list],
+            os.path.join(os.path.dirname(os.path.dirname(cache_dir)), "md5sums.tsv"),
+            num_workers=len(os.sched_getaffinity(0)))
+        utt2source = dict(zip(utterance_list, md5sums))
+        shard = getattr(args, "shard", None)
+        lock_name = "shard-{}-of-{}".format(*shard) if shard else "all"
+        # Concurrent processes extracting the same utterances wait for each other and the waiting processes then find the features from the cache
+        with system.file_lock(os.path.join(cache_dir + ".locks", lock_name), verbosity=args.verbosity):
+            source2entries, done_sources, feature_rank = scan_utterance_cache(cache_dir)
+            # Utterances with equal audio are extracted only once
+            missing = collections.OrderedDict()
+            for utt in self.select_shard(utterance_list):
+                if utt2source[utt] not in done_sources and utt2source[utt] not in missing:
+                    missing[utt2source[utt]] = utt
+            if args.verbosity:
+                num_cached = sum(utt2source[utt] in done_sources for utt in utterance_list)
+                print("{} utterances found from the utterance features cache, extracting features from {} new audio files".format(num_cached, len(missing)))
+            if missing:
+                segment_dir = os.path.join(cache_dir, "segment-{}-{}".format(now_str(), os.getpid()))
+                extractor_ds = self.extract_features(
+                    datasets,
+                    json.loads(json.dumps(feat_config)),
+                    datagroup_key,
+                    trim_audio,
+                    debug_squeeze_last_dim,
+                    utterance_ids=missing.values())
+                meta = feature_store.write(
+                    extractor_ds,
+                    segment_dir,
+                    feat_config["utterance_cache"].get("num_shards", 16),
+                    {utt: m["dataset"] for utt, m in utt2meta.items()},
+                    verbosity=args.verbosity,
+                    utt2source={utt: source for source, utt in missing.items()},
+                    extra_meta={"sources": list(missing)})
+                if meta["num_records"]:
+                    feature_rank = meta["feature_rank"]
+                for entry in feature_store.load_index(segment_dir).values():
+                    source2entries[entry.source].append((segment_dir, entry))
+        store_entries, utterance_ids, labels = [], [], []
+        for utt in utterance_list:
+            for store_dir, entry in source2entries[utt2source[utt]]:
+                store_entries.append((store_dir, entry))
+                # Replace the source key prefix with the utterance id, keeping the suffixes of chunks and augmented signals
+                utterance_ids.append(utt + entry.utt[len(entry.source):])
+                labels.append(utt2meta[utt]["label"])
+        if args.verbosity:
+            print("Loading {} records from the utterance features cache".format(len(store_entries)))
+        return feature_store.load_entries(store_entries, feature_rank or 2, utterance_ids, labels)
+
+    def load_features(self, ds_config, feat_config, datagroup_key, conf_json, conf_checksum, trim_audio, debug_squeeze_last_dim):
+        """Return a dataset of all features of the datagroup, either from the per-utterance features cache or from a feature store of the whole datagroup."""
+        if "utterance_cache" in feat_config:
+            return self.cache_utterance_features(
+                self.experiment_config["datasets"],
+                feat_config,
+                datagroup_key,
+                trim_audio,
+                debug_squeeze_last_dim)
+        extractor_ds = self.extract_features(
+            self.experiment_config["datasets"],
+            json.loads(json.dumps(feat_config)),
+            datagroup_key,
+            trim_audio,
+            debug_squeeze_last_dim,
+        )
+        return self.cache_features(
+            extractor_ds,
+            ds_config,
+            feat_config,
+            datagroup_key,
+            conf_json,
+            conf_checksum,
+        )
+
+    def get_utterance_num_frames(self, ds_config, feat_config, datagroup_key, conf_checksum):
+        """
+        Amount of feature frames of every utterance of the datagroup, for computing bucket boundaries, e.g. with frame_budget_batching.
+        Read from the index of the feature store if it is complete, else estimated from the durations in utt2dur.
+        """
+        features_cache_path = self.get_features_cache_path(ds_config, feat_config, datagroup_key, conf_checksum)
+        if feature_store.is_complete(features_cache_path):
+            if self.args.verbosity > 1:
+                print("Reading amount of frames of each utterance from the feature store index of '{}'".format(features_cache_path))
+            return np.array([entry.num_frames for entry in feature_store.load_index(features_cache_path).values()], np.int64)
+        durations = np.array([meta["duration_sec"] for meta in self.utt2meta[datagroup_key].values()], np.float64)
+        assert np.all(durations >= 0), "frame_budget_batching requires utt2dur files or a complete feature store for datagroup '{}'".format(datagroup_key)
+        sample_rate = ds_config.get("frame_budget_batching", {}).get("sample_rate", feat_config.get("wav_config", {}).get("target_sample_rate"))
+        assert sample_rate, "frame_budget_batching requires a sample_rate or a wav_config.target_sample_rate to estimate the amount of frames from utt2dur"
+        if self.args.verbosity > 1:
+            print("Estimating amount of frames of each utterance from utt2dur durations at sample rate {}".format(sample_rate))
+        spec_kwargs = feat_config.get("spectrogram", {})
+        num_samples = np.round(durations * sample_rate).astype(np.int32)
+        return audio_feat.spectrogram_lengths(num_samples, sample_rate, **spec_kwargs).numpy()
+
+    def get_pcm_corpus_prefix(self, datagroup_key):
+        return os.path.join(self.cache_dir, "pcm-corpus", datagroup_key, "corpus")
+
+    def get_resampled_audio_cache_dir(self, feat_config):
+        cache = feat_config.get("wav_config", {}).get("resampling", {}).get("cache", False)
+        if not cache:
+            return None
+        if isinstance(cache, str):
+            # Shared cache, e.g. for several experiments resampling the same audio
+            return cache
+        return os.path.join(self.cache_dir, "resampled-audio")
+
     def get_checkpoint_dir(self):
         model_cache_dir = os.path.join(self.cache_dir, self.model_id)
         return os.path.join(model_cache_dir, "checkpoints")
 
+    def get_best_checkpoint_path(self, training_config):
+        """Path to the best checkpoint according to the checkpoint monitor value, or None if the model has no checkpoints."""
+        checkpoint_dir = self.get_checkpoint_dir()
+        checkpoints = [c.name for c in os.scandir(checkpoint_dir) if c.is_file()] if os.path.isdir(checkpoint_dir) else []
+        if not checkpoints:
+            return None
+        if "checkpoints" in training_config:
+            monitor_value = training_config["checkpoints"]["monitor"]
+            monitor_mode = training_config["checkpoints"].get("mode")
+        else:
+            monitor_value = "epoch"
+            monitor_mode = None
+        return os.path.join(checkpoint_dir, models.get_best_checkpoint(checkpoints, key=monitor_value, mode=monitor_mode))
+
+    def get_trained_checkpoint_path(self, training_config):
+        """
+        Path to the checkpoint given with --checkpoint, or to the checkpoint 'best_checkpoint' in the prediction config, or to the best checkpoint according to the checkpoint monitor value.
+        Returns None if the model has no checkpoints.
+        """
+        checkpoint_dir = self.get_checkpoint_dir()
+        if getattr(self.args, "checkpoint", None):
+            return os.path.join(checkpoint_dir, self.args.checkpoint)
+        if "best_checkpoint" in self.experiment_config.get("prediction", {}):
+            return os.path.join(checkpoint_dir, self.experiment_config["prediction"]["best_checkpoint"])
+        return self.get_best_checkpoint_path(training_config)
+
+    def load_trained_model(self, training_config, labels):
+        """Create the model for inference and load its weights from the trained checkpoint, or return None if the model has not been trained."""
+        args = self.args
+        model = self.create_model(dict(training_config), skip_training=True)
+        if args.verbosity > 1:
+            print("Preparing model")
+        model.prepare(labels, training_config)
+        checkpoint_path = self.get_trained_checkpoint_path(training_config)
+        if checkpoint_path is None:
+            print("Error: Cannot evaluate with a model that has no checkpoints, i.e. is not trained.")
+            return None
+        if args.verbosity:
+            print("Loading model weights from checkpoint file '{}'".format(checkpoint_path))
+        model.load_weights(checkpoint_path)
+        return model
+
     def create_model(self, config, skip_training=False):
         model_cache_dir = os.path.join(self.cache_dir, self.model_id)
         tensorboard_log_dir = os.path.join(model_cache_dir, "tensorboard", "logs")
@@ -129,14 +445,14 @@ class E2EBase(Command):
             print()
         return models.KerasWrapper(self.model_id, config["model_definition"], **callbacks_kwargs)
 
-    def extract_features(self, datasets, config, datagroup_key, trim_audio, debug_squeeze_last_dim):
+    def parse_datagroup(self, datasets, datagroup_key):
+        """
+        Parse utterance ids, labels, durations and wav paths of a datagroup from all datasets.
+        Returns the list of utterance ids to process, the utterance to path and utterance to metadata mappings, and the config of the last parsed datagroup.
+        """
         args = self.args
         utt2path = collections.OrderedDict()
         utt2meta = collections.OrderedDict()
-        if args.verbosity > 1:
-            print("Extracting features from datagroup '{}'".format(datagroup_key))
-            if args.verbosity > 2:
-                yaml_pprint(config)
         num_utts_dropped = collections.Counter()
         for ds_config in datasets:
             if args.verbosity > 1:
@@ -183,8 +499,9 @@ class E2EBase(Command):
                 print("Utterances skipped due to unexpected labels: {}".format(len(skipped_utterances)))
         # All utterance ids must be present in both files
         assert set(utt2path) == set(utt2meta), "Mismatching sets of utterances in utt2path and utt2meta, the utterance ids must be exactly the same"
+        self.utt2meta[datagroup_key] = utt2meta
         utterance_list = list(utt2path.keys())
-        if args.shuffle_utt2path or datagroup.get("shuffle_utt2path", False):
+        if getattr(args, "shuffle_utt2path", False) or datagroup.get("shuffle_utt2path", False):
             if args.verbosity > 1:
                 print("Shuffling utterance ids, all wavpaths in the utt2path list will be processed in random order.")
             random.shuffle(utterance_list)
@@ -198,6 +515,26 @@ class E2EBase(Command):
             if args.verbosity > 3:
                 print("Using utterance ids:")
                 yaml_pprint(utterance_list)
+        return utterance_list, utt2path, utt2meta, datagroup
+
+    def extract_features(self, datasets, config, datagroup_key, trim_audio, debug_squeeze_last_dim, utterance_ids=None):
+        """
+        Create a dataset that extracts features from all utterances of the datagroup.
+        If utterance_ids is given, features are extracted only from those utterances.
+        """
+        args = self.args
+        if args.verbosity > 1:
+            print("Extracting features from datagroup '{}'".format(datagroup_key))
+            if args.verbosity > 2:
+                yaml_pprint(config)
+        utterance_list, utt2path, utt2meta, datagroup = self.parse_datagroup(datasets, datagroup_key)
+        if getattr(args, "shard", None):
+            utterance_list = self.select_shard(utterance_list)
+            if args.verbosity:
+                print("--shard {}/{} given, using {} utterances of the sorted utterance id list".format(*args.shard, len(utterance_list)))
+        if utterance_ids is not None:
+            utterance_ids = set(utterance_ids)
+            utterance_list = [utt for utt in utterance_list if utt in utterance_ids]
         paths = []
         paths_meta = []
         for utt in utterance_list:
@@ -231,6 +568,13 @@ class E2EBase(Command):
                 print("Parsing Kaldi features from '{}' with expected shape {}".format(kaldi_feats_scp, expected_shape))
             feat = tf_data.parse_kaldi_features(utterance_list, kaldi_feats_scp, utt2label, expected_shape, feat_conf)
         else:
+            pcm_corpus = None
+            pcm_corpus_prefix = self.get_pcm_corpus_prefix(datagroup_key)
+            if os.path.exists(pcm_corpus_prefix + ".index"):
+                if args.verbosity:
+                    print("Using pre-decoded PCM corpus '{}'".format(pcm_corpus_prefix))
+                pcm_corpus = system.load_pcm_corpus(pcm_corpus_prefix)
+            resampled_audio_cache_dir = self.get_resampled_audio_cache_dir(config)
             feat = tf_data.extract_features_from_paths(
                 config,
                 paths,
@@ -239,6 +583,8 @@ class E2EBase(Command):
                 trim_audio=trim_audio,
                 debug_squeeze_last_dim=debug_squeeze_last_dim,
                 verbosity=args.verbosity,
+                pcm_corpus=pcm_corpus,
+                resampled_audio_cache_dir=resampled_audio_cache_dir,
             )
         return feat
 
@@ -262,11 +608,15 @@ class Train(E2EBase):
         optional.add_argument("--exhaust-dataset-iterator",
             action="store_true",
             default=False,
-            help="Explictly iterate once over the feature extractor tf.data.Dataset object in order to evaluate the feature extraction pipeline and fill the feature cache on disk. Using this with --skip-training allows you to extract features on multiple CPUs without needing a GPU.")
+            help="Explictly iterate once over all features loaded from the feature store, e.g. to check that all records can be read. Features are always written into the feature store before training starts, so using --skip-training allows you to extract features on multiple CPUs without needing a GPU.")
         optional.add_argument("--dataset-config",
             type=str,
             action=ExpandAbspath,
             help="Path to a yaml-file containing a list of datasets.")
+        optional.add_argument("--shard",
+            type=parse_shard,
+            metavar="i/N",
+            help="Extract features only from every N'th utterance of the sorted utterance ids, starting at i, into part i of the feature store, and exit without training. Running N processes with shards 0/N, ..., N-1/N, e.g. on different machines sharing the cache directory, extracts all features. The process that completes the last part merges all parts into the feature store, which is then used for training.")
         return parser
 
     def train(self):
@@ -317,37 +667,22 @@ class Train(E2EBase):
             if args.verbosity > 2:
                 print("Config md5 checksum '{}' computed from json string:".format(conf_checksum))
                 print(conf_json)
-            extractor_ds = self.extract_features(
-                self.experiment_config["datasets"],
-                json.loads(json.dumps(feat_config)),
+            extractor_ds = self.load_features(
+                ds_config,
+                feat_config,
                 datagroup_key,
+                conf_json,
+                conf_checksum,
                 summary_kwargs.pop("trim_audio", False),
                 debug_squeeze_last_dim,
             )
-            if ds_config.get("persistent_features_cache", True):
-                features_cache_dir = os.path.join(self.cache_dir, "features")
-            else:
-                features_cache_dir = "/tmp/tensorflow-cache"
-            features_cache_path = os.path.join(
-                features_cache_dir,
-                datagroup_key,
-                feat_config["type"],
-                conf_checksum,
-            )
-            self.make_named_dir(os.path.dirname(features_cache_path), "features cache")
-            if not os.path.exists(features_cache_path + ".md5sum-input"):
-                with open(features_cache_path + ".md5sum-input", "w") as f:
-                    print(conf_json, file=f, end='')
-                if args.verbosity:
-                    print("Writing features into new cache: '{}'".format(features_cache_path))
-            else:
+            if args.shard:
                 if args.verbosity:
-                    print("Loading features from existing cache: '{}'".format(features_cache_path))
-            extractor_ds = extractor_ds.cache(filename=features_cache_path)
+                    print("--shard {}/{} given, features of datagroup '{}' written, not preparing the dataset for training".format(*args.shard, datagroup_key))
+                continue
             if args.exhaust_dataset_iterator:
                 if args.verbosity:
-                    print("--exhaust-dataset-iterator given, now iterating once over the dataset iterator to fill the features cache.")
-                # This forces the extractor_ds pipeline to be evaluated, and the features being serialized into the cache
+                    print("--exhaust-dataset-iterator given, now iterating once over the feature store to check all records can be read.")
                 i = 0
                 if args.verbosity > 1:
                     print(now_str(date=True), "- 0 samples done")
@@ -358,6 +693,9 @@ class Train(E2EBase):
                         tf_data.tf_print("sample:", i, "features shape:", tf.shape(feats), "metadata:", *meta)
                 if args.verbosity > 1:
                     print(now_str(date=True), "- all", i, "samples done")
+            num_frames = None
+            if "frame_budget_batching" in ds_config:
+                num_frames = self.get_utterance_num_frames(ds_config, feat_config, datagroup_key, conf_checksum)
             dataset[ds] = tf_data.prepare_dataset_for_training(
                 extractor_ds,
                 ds_config,
@@ -366,6 +704,7 @@ class Train(E2EBase):
                 self.model_id,
                 conf_checksum=conf_checksum,
                 verbosity=args.verbosity,
+                num_frames=num_frames,
             )
             if args.debug_dataset:
                 if args.verbosity:
@@ -406,18 +745,14 @@ class Train(E2EBase):
                             if args.verbosity > 1:
                                 print(i, "batches done")
                             del logged_dataset
-        checkpoint_dir = self.get_checkpoint_dir()
-        checkpoints = [c.name for c in os.scandir(checkpoint_dir) if c.is_file()] if os.path.isdir(checkpoint_dir) else []
-        if checkpoints:
-            if "checkpoints" in training_config:
-                monitor_value = training_config["checkpoints"]["monitor"]
-                monitor_mode = training_config["checkpoints"].get("mode")
-            else:
-                monitor_value = "epoch"
-                monitor_mode = None
-            checkpoint_path = os.path.join(checkpoint_dir, models.get_best_checkpoint(checkpoints, key=monitor_value, mode=monitor_mode))
+        if args.shard:
             if args.verbosity:
-                print("Loading model weights from checkpoint file '{}' according to monitor value '{}'".format(checkpoint_path, monitor_value))
+                print("--shard given, will not call model.fit")
+            return
+        checkpoint_path = self.get_best_checkpoint_path(training_config)
+        if checkpoint_path is not None:
+            if args.verbosity:
+                print("Loading model weights from checkpoint file '{}' according to monitor value '{}'".format(checkpoint_path, training_config.get("checkpoints", {}).get("monitor", "epoch")))
             model.load_weights(checkpoint_path)
         if args.verbosity:
             print("\nStarting training")
@@ -467,6 +802,21 @@ class Predict(E2EBase):
         optional.add_argument("--score-separator", type=str, default=' ')
         optional.add_argument("--trials", type=str)
         optional.add_argument("--scores", type=str)
+        optional.add_argument("--scores-format",
+            choices=sorted(system.SCORE_WRITERS),
+            default="text",
+            help="Write scores as text rows, as a float32 .npy matrix with utterance ids in a separate file, or as Kaldi ark and scp files. Default: %(default)s")
+        optional.add_argument("--utterance-scores",
+            type=str,
+            help="If the wav_config has chunks, write the scores of all chunks aggregated into utterance-level scores at this path. Default: utterance_scores next to the scores.")
+        optional.add_argument("--chunk-aggregation",
+            choices=tf_data.CHUNK_SCORE_AGGREGATIONS,
+            default="mean_loglik",
+            help="How to aggregate chunk scores into utterance-level scores: mean of the log posteriors, mean of the posteriors or the maximum log posteriors of all chunks. Default: %(default)s")
+        optional.add_argument("--skip-chunk-scores",
+            action="store_true",
+            default=False,
+            help="Write only the utterance-level scores, not the scores of each chunk.")
         optional.add_argument("--checkpoint",
             type=str,
             help="Specify which Keras checkpoint to load model weights from, instead of using the most recent one.")
@@ -483,6 +833,8 @@ class Predict(E2EBase):
             args.scores = os.path.join(self.cache_dir, self.model_id, "predictions", "scores")
         self.make_named_dir(os.path.dirname(args.trials))
         self.make_named_dir(os.path.dirname(args.scores))
+        if not args.utterance_scores:
+            args.utterance_scores = os.path.join(os.path.dirname(args.scores), "utterance_scores")
         training_config = self.experiment_config["experiment"]
         feat_config = self.experiment_config["features"]
         if args.verbosity > 1:
@@ -493,31 +845,10 @@ class Predict(E2EBase):
             print("Using feature extraction parameters:")
             yaml_pprint(feat_config)
             print()
-        model = self.create_model(dict(training_config), skip_training=True)
-        if args.verbosity > 1:
-            print("Preparing model")
-        labels = self.experiment_config["dataset"]["labels"]
-        model.prepare(labels, training_config)
-        checkpoint_dir = self.get_checkpoint_dir()
-        if args.checkpoint:
-            checkpoint_path = os.path.join(checkpoint_dir, args.checkpoint)
-        elif "best_checkpoint" in self.experiment_config.get("prediction", {}):
-            checkpoint_path = os.path.join(checkpoint_dir, self.experiment_config["prediction"]["best_checkpoint"])
-        else:
-            checkpoints = os.listdir(checkpoint_dir) if os.path.isdir(checkpoint_dir) else []
-            if not checkpoints:
-                print("Error: Cannot evaluate with a model that has no checkpoints, i.e. is not trained.")
-                return 1
-            if "checkpoints" in training_config:
-                monitor_value = training_config["checkpoints"]["monitor"]
-                monitor_mode = training_config["checkpoints"].get("mode")
-            else:
-                monitor_value = "epoch"
-                monitor_mode = None
-            checkpoint_path = os.path.join(checkpoint_dir, models.get_best_checkpoint(checkpoints, key=monitor_value, mode=monitor_mode))
-        if args.verbosity:
-            print("Loading model weights from checkpoint file '{}'".format(checkpoint_path))
-        model.load_weights(checkpoint_path)
+        labels = sorted(set(l for d in self.experiment_config["datasets"] for l in d["labels"]))
+        model = self.load_trained_model(training_config, labels)
+        if model is None:
+            return 1
         if args.verbosity:
             print("\nEvaluating testset with model:")
             print(str(model))
@@ -531,43 +862,21 @@ class Predict(E2EBase):
         if args.verbosity and "dataset_logger" in ds_config:
             print("Warning: dataset_logger in the test datagroup has no effect.")
         datagroup_key = ds_config.pop("datagroup")
-        datagroup = self.experiment_config["dataset"]["datagroups"][datagroup_key]
-        utt2path_path = os.path.join(datagroup["path"], datagroup.get("utt2path", "utt2path"))
-        utt2label_path = os.path.join(datagroup["path"], datagroup.get("utt2label", "utt2label"))
-        utt2path = collections.OrderedDict(
-            row[:2] for row in parse_space_separated(utt2path_path)
-        )
-        utt2label = collections.OrderedDict(
-            row[:2] for row in parse_space_separated(utt2label_path)
-        )
-        utterance_list = list(utt2path.keys())
-        if args.file_limit:
-            utterance_list = utterance_list[:args.file_limit]
-            if args.verbosity > 3:
-                print("Using utterance ids:")
-                yaml_pprint(utterance_list)
-        int2label = self.experiment_config["dataset"]["labels"]
-        label2int, OH = make_label2onehot(int2label)
+        label2int, OH = make_label2onehot(labels)
         def label2onehot(label):
             return OH[label2int.lookup(label)]
-        labels_set = set(int2label)
-        paths = []
-        paths_meta = []
-        for utt in utterance_list:
-            label = utt2label[utt]
-            if label not in labels_set:
-                continue
-            paths.append(utt2path[utt])
-            paths_meta.append((utt, label))
         if args.verbosity:
             print("Extracting test set features for prediction")
-        features = self.extract_features(
+        conf_json, conf_checksum = config_checksum(self.experiment_config, datagroup_key)
+        features = self.load_features(
+            ds_config,
             feat_config,
-            "test",
+            datagroup_key,
+            conf_json,
+            conf_checksum,
             trim_audio=False,
             debug_squeeze_last_dim=(ds_config["input_shape"][-1] == 1),
         )
-        conf_json, conf_checksum = config_checksum(self.experiment_config, datagroup_key)
         features = tf_data.prepare_dataset_for_training(
             features,
             ds_config,
@@ -579,198 +888,453 @@ class Predict(E2EBase):
         )
         # drop meta wavs required only for vad
         features = features.map(lambda *t: t[:3])
-        if ds_config.get("persistent_features_cache", True):
-            features_cache_dir = os.path.join(self.cache_dir, "features")
-        else:
-            features_cache_dir = "/tmp/tensorflow-cache"
-        features_cache_path = os.path.join(
-            features_cache_dir,
-            self.experiment_config["dataset"]["key"],
-            ds,
-            feat_config["type"],
-            conf_checksum,
-        )
-        self.make_named_dir(os.path.dirname(features_cache_path), "features cache")
-        if not os.path.exists(features_cache_path + ".md5sum-input"):
-            with open(features_cache_path + ".md5sum-input", "w") as f:
-                print(conf_json, file=f, end='')
-            if args.verbosity:
-                print("Writing features into new cache: '{}'".format(features_cache_path))
-        else:
+        if args.verbosity:
+            print("Writing target and non-target language information for each utterance to '{}'.".format(args.trials))
+        with open(args.trials, "w") as trials_f:
+            for utt, meta in self.utt2meta[datagroup_key].items():
+                target = meta["label"]
+                for lang in labels:
+                    print(lang, utt, "target" if target == lang else "nontarget", file=trials_f)
+        aggregator = None
+        if "chunks" in feat_config.get("wav_config", {}):
+            aggregator = ChunkScoreAggregator(args.chunk_aggregation, len(labels), model.get_output_activation())
             if args.verbosity:
-                print("Loading features from existing cache: '{}'".format(features_cache_path))
-        features = features.cache(filename=features_cache_path)
+                print("Aggregating chunk scores into utterance-level scores by '{}'".format(args.chunk_aggregation))
+        elif args.skip_chunk_scores:
+            print("Warning: --skip-chunk-scores given but the wav_config has no chunks, writing all scores")
+            args.skip_chunk_scores = False
         if args.verbosity:
-            print("Gathering all utterance ids from features dataset iterator")
-        # Gather utterance ids, this also causes the extraction pipeline to be evaluated
-        utterance_ids = []
-        i = 0
+            if args.skip_chunk_scores:
+                print("Starting prediction with model, --skip-chunk-scores given, writing only utterance-level scores")
+            else:
+                print("Starting prediction with model, writing scores in format '{}' to '{}'".format(args.scores_format, args.scores))
         if args.verbosity > 1:
             print(now_str(date=True), "- 0 samples done")
-        for _, _, uttids in features.as_numpy_iterator():
-            for uttid in uttids:
-                utterance_ids.append(uttid.decode("utf-8"))
-                i += 1
-                if args.verbosity > 1 and i % 10000 == 0:
-                    print(now_str(date=True), "-", i, "samples done")
+        # Predict batch by batch while the features are extracted and append the scores to the output, the utterance ids are carried alongside each batch
+        num_predictions = 0
+        score_writer_kwargs = {"precision": args.score_precision, "separator": args.score_separator}
+        with contextlib.ExitStack() as stack:
+            writer = None
+            if not args.skip_chunk_scores:
+                writer = stack.enter_context(system.open_score_writer(args.scores, labels, args.scores_format, **score_writer_kwargs))
+            for feats, _, uttids in features:
+                predictions = model.predict_on_batch(feats)
+                if writer is not None:
+                    writer.write([uttid.decode("utf-8") for uttid in uttids.numpy()], predictions)
+                if aggregator is not None:
+                    aggregator.add(uttids, predictions)
+                num_done = num_predictions + len(predictions)
+                if args.verbosity > 1 and num_done // 10000 > num_predictions // 10000:
+                    print(now_str(date=True), "-", num_done, "samples done")
+                num_predictions = num_done
+        if args.verbosity and writer is not None:
+            print("Wrote {} prediction scores to '{}'.".format(num_predictions, args.scores))
+        if aggregator is not None:
+            utterance_ids, utterance_scores = aggregator.get_utterance_scores()
+            with system.open_score_writer(args.utterance_scores, labels, args.scores_format, **score_writer_kwargs) as writer:
+                writer.write(utterance_ids, utterance_scores)
+            if args.verbosity:
+                print("Wrote {} utterance-level scores, aggregated from {} chunk scores, to '{}'.".format(len(utterance_ids), num_predictions, args.utterance_scores))
+
+    def run(self):
+        super().run()
+        return self.predict()
+
+
+class Evaluate(E2EBase):
+    """Evaluate predicted scores by equal error rate, minimum detection cost, average detection cost (C_avg), precision, recall and the confusion matrix."""
+
+    @classmethod
+    def create_argparser(cls, parent_parser):
+        parser = super().create_argparser(parent_parser)
+        optional = parser.add_argument_group("evaluate options")
+        optional.add_argument("--trials", type=str)
+        optional.add_argument("--scores",
+            type=str,
+            help="Scores written by predict. Default: the utterance-level scores if they exist, else the scores.")
+        optional.add_argument("--scores-format",
+            choices=sorted(system.SCORE_WRITERS),
+            default="text",
+            help="Format of the scores, as given to predict. Default: %(default)s")
+        optional.add_argument("--score-separator", type=str, default=' ')
+        optional.add_argument("--convert-scores",
+            choices=("softmax", "log_softmax", "exp", "none"),
+            default="none",
+            help="Convert scores before evaluation, e.g. softmax for logits or exp for log posteriors. Default: %(default)s")
+        optional.add_argument("--p-target", type=float, default=0.5)
+        optional.add_argument("--c-miss", type=float, default=1.0)
+        optional.add_argument("--c-fa", type=float, default=1.0)
+        return parser
+
+    def evaluate(self):
+        args = self.args
+        self.model_id = self.experiment_config["experiment"]["name"]
+        predictions_dir = os.path.join(self.cache_dir, self.model_id, "predictions")
+        if not args.trials:
+            args.trials = os.path.join(predictions_dir, "trials")
+        if not args.scores:
+            args.scores = os.path.join(predictions_dir, "utterance_scores")
+            if not os.path.exists(args.scores):
+                args.scores = os.path.join(predictions_dir, "scores")
+        if args.verbosity:
+            print("Evaluating scores '{}' in format '{}' using trials '{}'".format(args.scores, args.scores_format, args.trials))
+        labels, utterance_ids, scores = system.read_scores(args.scores, args.scores_format, args.score_separator)
+        if labels is None:
+            labels = sorted(set(l for d in self.experiment_config["datasets"] for l in d["labels"]))
+        label2int = {l: i for i, l in enumerate(labels)}
+        with open(args.trials) as f:
+            utt2target = dict(line.split()[1::-1] for line in f if line.rstrip().endswith(" target"))
         if args.verbosity > 1:
-            print(now_str(date=True), "- all", i, "samples done")
+            print("Read scores of {} utterances for {} labels and targets of {} utterances".format(len(utterance_ids), len(labels), len(utt2target)))
+        has_target = np.array([utt2target.get(utt) in label2int for utt in utterance_ids], dtype=bool)
+        if not has_target.all():
+            print("Warning: skipping scores of {} utterances that have no target language in the trials, e.g. '{}'. Evaluate utterance-level scores if predict divided utterances into chunks".format(
+                np.count_nonzero(~has_target), utterance_ids[np.argmin(has_target)]), file=sys.stderr)
+        scores = np.asarray(scores[has_target], dtype=np.float64)
+        targets = np.array([label2int[utt2target[utt]] for utt, ok in zip(utterance_ids, has_target) if ok], dtype=np.int64)
+        if not targets.size:
+            print("Error: no scores to evaluate")
+            return 1
+        if args.convert_scores in ("softmax", "log_softmax"):
+            scores = scores - scores.max(axis=1, keepdims=True)
+            scores = scores - np.log(np.exp(scores).sum(axis=1, keepdims=True))
+            if args.convert_scores == "softmax":
+                scores = np.exp(scores)
+        elif args.convert_scores == "exp":
+            scores = np.exp(scores)
+        cost_kwargs = {"p_target": args.p_target, "c_miss": args.c_miss, "c_fa": args.c_fa}
         if args.verbosity:
-            print("Features extracted, writing target and non-target language information for each utterance to '{}'.".format(args.trials))
-        with open(args.trials, "w") as trials_f:
-            for utt, target in utt2label.items():
-                for lang in int2label:
-                    print(lang, utt, "target" if target == lang else "nontarget", file=trials_f)
+            print("Computing metrics from {} utterances with {} scores".format(targets.size, scores.size))
+        min_cavg, min_threshold = metrics.min_average_detection_cost(scores, targets, **cost_kwargs)
+        eers = np.array([metrics.equal_error_rate(scores[:, i], targets == i) for i in range(len(labels))])
+        min_dcfs = np.array([metrics.min_detection_cost(scores[:, i], targets == i, **cost_kwargs)[0] for i in range(len(labels))])
+        precision, recall = metrics.precision_recall(scores, targets, min_threshold)
+        def print_metric(name, value):
+            print("{:15s}\t{:.3f}".format(name + ":", value))
+        print("min C_avg at threshold {:.6f}".format(min_threshold))
+        print_metric("min_C_avg", min_cavg)
+        print_metric("avg_EER", np.nanmean(eers))
+        print_metric("avg_min_DCF", np.nanmean(min_dcfs))
+        print_metric("avg_precision", np.nanmean(precision))
+        print_metric("avg_recall", np.nanmean(recall))
+        print("\nMetrics by target, precision and recall using threshold {:.6f}".format(min_threshold))
+        print("{:15s}\t{:>9s}\t{:>9s}\t{:>9s}\t{:>9s}".format("", "EER", "min_DCF", "precision", "recall"))
+        for label, eer, min_dcf, p, r in zip(labels, eers, min_dcfs, precision, recall):
+            print("{:15s}\t{:9.3f}\t{:9.3f}\t{:9.3f}\t{:9.3f}".format(label + ":", eer, min_dcf, p, r))
+        print("\nConfusion matrix, rows are true languages and columns predicted languages")
+        print(labels)
+        print(np.array_str(metrics.confusion_matrix(targets, scores.argmax(axis=1), len(labels))))
+
+    def run(self):
+        super().run()
+        return self.evaluate()
+
+
+class Export(E2EBase):
+    """
+    Export a trained model as a SavedModel, which contains the feature extraction, feature normalization and the weights of the trained checkpoint.
+    The 'serving_default' signature takes int16 PCM samples and their sample rate, and returns the labels, the chunk scores and the utterance-level scores.
+    """
+
+    @classmethod
+    def create_argparser(cls, parent_parser):
+        parser = super().create_argparser(parent_parser)
+        optional = parser.add_argument_group("export options")
+        optional.add_argument("--export-dir",
+            type=str,
+            action=ExpandAbspath,
+            help="Write the SavedModel into this directory. Default: exported_model in the model cache directory.")
+        optional.add_argument("--chunk-aggregation",
+            choices=tf_data.CHUNK_SCORE_AGGREGATIONS,
+            default="mean_loglik",
+            help="How to aggregate chunk scores into utterance-level scores, as in predict. Default: %(default)s")
+        optional.add_argument("--checkpoint",
+            type=str,
+            help="Specify which Keras checkpoint to load model weights from, instead of using the most recent one.")
+        return parser
+
+    def export(self):
+        args = self.args
+        self.model_id = self.experiment_config["experiment"]["name"]
+        if not args.export_dir:
+            args.export_dir = os.path.join(self.cache_dir, self.model_id, "exported_model")
+        training_config = self.experiment_config["experiment"]
+        feat_config = self.experiment_config["features"]
+        wav_config = feat_config.get("wav_config", {})
+        if "webrtcvad" in wav_config:
+            print("Warning: wav_config has webrtcvad but the exported model does not drop silence, apply VAD before inference if needed")
+        if wav_config.get("target_sample_rate") is None and "frontend_layer" not in feat_config:
+            print("Warning: wav_config has no target_sample_rate, the exported model will extract features from signals at their own sample rate")
+        labels = sorted(set(l for d in self.experiment_config["datasets"] for l in d["labels"]))
+        model = self.load_trained_model(training_config, labels)
+        if model is None:
+            return 1
         if args.verbosity:
-            print("Starting prediction with model")
-        predictions = model.predict(features.map(lambda *t: t[0]))
+            print("Exporting model '{}' with feature extraction for labels {} into '{}'".format(self.model_id, labels, args.export_dir))
+        module = model.export(args.export_dir, labels, feat_config, args.chunk_aggregation)
         if args.verbosity > 1:
-            print("Done predicting, model returned predictions of shape {}. Writing them to '{}'.".format(predictions.shape, args.scores))
-        num_predictions = 0
-        with open(args.scores, "w") as scores_f:
-            print(*int2label, file=scores_f)
-            for utt, pred in zip(utterance_ids, predictions):
-                pred_scores = [np.format_float_positional(x, precision=args.score_precision) for x in pred]
-                print(utt, *pred_scores, sep=args.score_separator, file=scores_f)
-                num_predictions += 1
+            print("Serving signature:")
+            print(module.serve.get_concrete_function().structured_outputs)
+
+    def run(self):
+        super().run()
+        return self.export()
+
+
+class Optimize(E2EBase):
+    """
+    Optimize a trained model for CPU inference by folding batch norms into the weights of the preceding layers and optionally quantizing it to int8.
+    Writes the optimized model as a TensorFlow Lite file and reports its accuracy against the float model on the test set.
+    """
+
+    @classmethod
+    def create_argparser(cls, parent_parser):
+        parser = super().create_argparser(parent_parser)
+        optional = parser.add_argument_group("optimize options")
+        optional.add_argument("--output",
+            type=str,
+            action=ExpandAbspath,
+            help="Write the TensorFlow Lite model to this path. Default: model.tflite or model-int8.tflite in directory 'optimized' of the model cache directory.")
+        optional.add_argument("--int8",
+            action="store_true",
+            default=False,
+            help="Quantize weights and activations to int8 after folding batch norms, using value ranges calibrated on training set features.")
+        optional.add_argument("--num-calibration-batches",
+            type=int,
+            default=100,
+            help="Amount of training set batches used for calibrating the int8 value ranges. Default: %(default)s")
+        optional.add_argument("--num-evaluation-batches",
+            type=int,
+            help="Compare the optimized and the float model on only this many test set batches instead of all.")
+        optional.add_argument("--checkpoint",
+            type=str,
+            help="Specify which Keras checkpoint to load model weights from, instead of using the most recent one.")
+        return parser
+
+    def load_prepared_features(self, ds, labels):
+        """Features and onehot labels of the datagroup of the dataset config 'train', 'validation' or 'test', batched as for training."""
+        training_config = self.experiment_config["experiment"]
+        feat_config = self.experiment_config["features"]
+        ds_config = dict(training_config, **training_config[ds])
+        del ds_config["train"], ds_config["validation"]
+        datagroup_key = ds_config.pop("datagroup")
+        label2int, OH = make_label2onehot(labels)
+        def label2onehot(label):
+            return OH[label2int.lookup(label)]
+        conf_json, conf_checksum = config_checksum(self.experiment_config, datagroup_key)
+        features = self.load_features(
+            ds_config,
+            feat_config,
+            datagroup_key,
+            conf_json,
+            conf_checksum,
+            trim_audio=False,
+            debug_squeeze_last_dim=(ds_config["input_shape"][-1] == 1),
+        )
+        num_frames = None
+        if "frame_budget_batching" in ds_config:
+            num_frames = self.get_utterance_num_frames(ds_config, feat_config, datagroup_key, conf_checksum)
+        features = tf_data.prepare_dataset_for_training(
+            features,
+            ds_config,
+            feat_config,
+            label2onehot,
+            self.model_id,
+            verbosity=self.args.verbosity,
+            conf_checksum=conf_checksum,
+            num_frames=num_frames,
+        )
+        return features.map(lambda *t: t[:2])
+
+    def optimize(self):
+        args = self.args
+        self.model_id = self.experiment_config["experiment"]["name"]
+        training_config = self.experiment_config["experiment"]
+        if not args.output:
+            args.output = os.path.join(self.cache_dir, self.model_id, "optimized", "model-int8.tflite" if args.int8 else "model.tflite")
+        self.make_named_dir(os.path.dirname(args.output))
+        labels = sorted(set(l for d in self.experiment_config["datasets"] for l in d["labels"]))
+        float_model = self.load_trained_model(training_config, labels)
+        if float_model is None:
+            return 1
+        model = self.load_trained_model(training_config, labels)
+        folded = model.fold_batch_norms()
         if args.verbosity:
-            print("Wrote {} prediction scores to '{}'.".format(num_predictions, args.scores))
+            print("Folded batch norms of {} layers into their weights: {}".format(len(folded), ', '.join(folded)))
+        if args.int8:
+            if args.verbosity:
+                print("Calibrating int8 quantization on {} batches of training set features".format(args.num_calibration_batches))
+            calibration_features = self.load_prepared_features("train", labels).take(args.num_calibration_batches)
+            def generate_calibration_batches():
+                for feats, _ in calibration_features.as_numpy_iterator():
+                    yield [feats]
+            representative_dataset = generate_calibration_batches
+        else:
+            representative_dataset = None
+        if args.verbosity:
+            print("Converting model to TensorFlow Lite")
+        tflite_model = model.to_tflite(args.output, representative_dataset)
+        if args.verbosity:
+            print("Wrote {} byte TensorFlow Lite model to '{}'".format(len(tflite_model), args.output))
+        interpreter = tf.lite.Interpreter(model_content=tflite_model)
+        input_index = interpreter.get_input_details()[0]["index"]
+        output_index = interpreter.get_output_details()[0]["index"]
+        def predict_tflite(feats):
+            interpreter.resize_tensor_input(input_index, feats.shape)
+            interpreter.allocate_tensors()
+            interpreter.set_tensor(input_index, feats)
+            interpreter.invoke()
+            return interpreter.get_tensor(output_index)
+        if args.verbosity:
+            print("Comparing optimized and float model predictions on the test set")
+        test_features = self.load_prepared_features("test", labels)
+        if args.num_evaluation_batches:
+            test_features = test_features.take(args.num_evaluation_batches)
+        num_samples = 0
+        num_correct = collections.Counter()
+        max_abs_diff = collections.Counter()
+        for feats, onehot in test_features.as_numpy_iterator():
+            true_labels = onehot.argmax(axis=1)
+            float_scores = float_model.predict_on_batch(feats)
+            for key, scores in (("float", float_scores), ("folded", model.predict_on_batch(feats)), ("tflite", predict_tflite(feats))):
+                scores = np.asarray(scores)
+                num_correct[key] += np.count_nonzero(scores.argmax(axis=1) == true_labels)
+                max_abs_diff[key] = max(max_abs_diff[key], float(np.abs(scores - float_scores).max()))
+            num_samples += len(true_labels)
+        if not num_samples:
+            print("Error: no test set samples to compare the optimized model on")
+            return 1
+        float_accuracy = num_correct["float"] / num_samples
+        print("Accuracy on {} test set samples".format(num_samples))
+        print("{:15s}\t{:>9s}\t{:>9s}\t{:>13s}".format("", "accuracy", "delta", "max_abs_diff"))
+        for key, name in (("float", "float"), ("folded", "folded_bn"), ("tflite", "tflite_int8" if args.int8 else "tflite")):
+            accuracy = num_correct[key] / num_samples
+            print("{:15s}\t{:9.4f}\t{:+9.4f}\t{:13.6f}".format(name + ":", accuracy, accuracy - float_accuracy, max_abs_diff[key]))
 
     def run(self):
         super().run()
-        return self.predict()
+        return self.optimize()
 
 
-#class Evaluate(E2EBase):
-#    """Evaluate predicted scores by average detection cost (C_avg)."""
-
-#    @classmethod
-#    def create_argparser(cls, parent_parser):
-#        parser = super().create_argparser(parent_parser)
-#        optional = parser.add_argument_group("evaluate options")
-#        optional.add_argument("--trials", type=str)
-#        optional.add_argument("--scores", type=str)
-#        optional.add_argument("--threshold-bins", type=int, default=40)
-#        optional.add_argument("--convert-scores", choices=("softmax", "exp", "none"), default=None)
-#        return parser
-
-#    #TODO tf is very slow in the for loop, maybe numpy would be sufficient
-#    def evaluate(self):
-#        args = self.args
-#        self.model_id = self.experiment_config["experiment"]["name"]
-#        if not args.trials:
-#            args.trials = os.path.join(self.cache_dir, self.model_id, "predictions", "trials")
-#        if not args.scores:
-#            args.scores = os.path.join(self.cache_dir, self.model_id, "predictions", "scores")
-#        if args.verbosity > 1:
-#            print("Evaluating minimum average detection cost using trials '{}' and scores '{}'".format(args.trials, args.scores))
-#        score_lines = list(parse_space_separated(args.scores))
-#        langs = score_lines[0]
-#        lang2int = {l: i for i, l in enumerate(langs)}
-#        utt2scores = {utt: tf.constant([float(s) for s in scores], dtype=tf.float32) for utt, *scores in score_lines[1:]}
-#        if args.verbosity > 1:
-#            print("Parsed scores for {} utterances".format(len(utt2scores)))
-#        if args.convert_scores == "softmax":
-#            print("Applying softmax on logit scores")
-#            utt2scores = {utt: tf.keras.activations.softmax(tf.expand_dims(scores, 0))[0] for utt, scores in utt2scores.items()}
-#        elif args.convert_scores == "exp":
-#            print("Applying exp on log likelihood scores")
-#            utt2scores = {utt: tf.math.exp(scores) for utt, scores in utt2scores.items()}
-#        if args.verbosity > 2:
-#            print("Asserting all scores sum to 1")
-#            tolerance = 1e-3
-#            for utt, scores in utt2scores.items():
-#                one = tf.constant(1.0, dtype=tf.float32)
-#                tf.debugging.assert_near(
-#                    tf.reduce_sum(scores),
-#                    one,
-#                    rtol=tolerance,
-#                    atol=tolerance,
-#                    message="failed to convert log likelihoods to probabilities, the probabilities of predictions for utterance '{}' does not sum to 1".format(utt))
-#        if args.verbosity > 1:
-#            print("Generating {} threshold bins".format(args.threshold_bins))
-#        assert args.threshold_bins > 0
-#        from_logits = False
-#        max_score = tf.constant(-float("inf"), dtype=tf.float32)
-#        min_score = tf.constant(float("inf"), dtype=tf.float32)
-#        for utt, scores in utt2scores.items():
-#            max_score = tf.math.maximum(max_score, tf.math.reduce_max(scores))
-#            min_score = tf.math.minimum(min_score, tf.math.reduce_min(scores))
-#        if args.verbosity > 2:
-#            tf_data.tf_print("Max score", max_score, "min score", min_score)
-#        thresholds = tf.linspace(min_score, max_score, args.threshold_bins)
-#        if args.verbosity > 2:
-#            print("Score thresholds for language detection decisions:")
-#            tf_data.tf_print(thresholds, summarize=5)
-#        # First do C_avg to get the best threshold
-#        cavg = AverageDetectionCost(langs, theta_det=list(thresholds.numpy()))
-#        if args.verbosity > 1:
-#            print("Sorting trials")
-#        trials_by_utt = sorted(parse_space_separated(args.trials), key=lambda t: t[1])
-#        trials_by_utt = [
-#            (utt, tf.constant([float(t == "target") for _, _, t in sorted(group, key=lambda t: lang2int[t[0]])], dtype=tf.float32))
-#            for utt, group in itertools.groupby(trials_by_utt, key=lambda t: t[1])
-#        ]
-#        if args.verbosity:
-#            print("Computing minimum C_avg using {} score thresholds".format(len(thresholds)))
-#        # Collect labels and predictions for confusion matrix
-#        cm_labels = []
-#        cm_predictions = []
-#        for utt, y_true in trials_by_utt:
-#            if utt not in utt2scores:
-#                print("Warning: correct class for utterance '{}' listed in trials but it has no predicted scores, skipping".format(utt), file=sys.stderr)
-#                continue
-#            y_pred = utt2scores[utt]
-#            # Update using singleton batches
-#            cavg.update_state(
-#                tf.expand_dims(y_true, 0),
-#                tf.expand_dims(y_pred, 0)
-#            )
-#            cm_labels.append(tf.math.argmax(y_true))
-#            cm_predictions.append(tf.math.argmax(y_pred))
-#        # Evaluating the cavg result has a side effect of generating the argmin of the minimum cavg into cavg.min_index
-#        _ = cavg.result()
-#        min_threshold = thresholds[cavg.min_index].numpy()
-#        def print_metric(m):
-#            print("{:15s}\t{:.3f}".format(m.name + ":", m.result().numpy()))
-#        print("min C_avg at threshold {:.6f}".format(min_threshold))
-#        print_metric(cavg)
-#        # Now we know the threshold that minimizes C_avg and use the same threshold to compute all other metrics
-#        metrics = [
-#            M(langs, from_logits=from_logits, thresholds=min_threshold)
-#            for M in (AverageEqualErrorRate, AveragePrecision, AverageRecall)
-#        ]
-#        if args.verbosity:
-#            print("Computing rest of the metrics using threshold {:.6f}".format(min_threshold))
-#        for utt, y_true in trials_by_utt:
-#            if utt not in utt2scores:
-#                continue
-#            y_true_batch = tf.expand_dims(y_true, 0)
-#            y_pred = tf.expand_dims(utt2scores[utt], 0)
-#            for m in metrics:
-#                m.update_state(y_true_batch, y_pred)
-#        for avg_m in metrics:
-#            print_metric(avg_m)
-#        print("\nMetrics by target, using threshold {:.6f}".format(min_threshold))
-#        for avg_m in metrics:
-#            print(avg_m.name)
-#            for m in avg_m:
-#                print_metric(m)
-#        print("\nConfusion matrix")
-#        cm_labels = tf.cast(tf.stack(cm_labels), dtype=tf.int32)
-#        cm_predictions = tf.cast(tf.stack(cm_predictions), dtype=tf.int32)
-#        confusion_matrix = tf.math.confusion_matrix(cm_labels, cm_predictions, len(langs))
-#        print(langs)
-#        print(np.array_str(confusion_matrix.numpy()))
-
-#    def run(self):
-#        super().run()
-#        return self.evaluate()
+class Embed(E2EBase):
+    """
+    Extract embeddings, e.g. x-vectors, from the outputs of an intermediate layer of a trained model for all utterances of a datagroup.
+    Features are streamed from the features cache in batches of utterances of similar length, bucketed with frame_budget_buckets from the amount of frames of all utterances.
+    Shorter utterances of a batch are padded with the mask value of the model, which excludes padded frames from the outputs, hence the model definition must support mask_value.
+    No utterance is truncated or dropped.
+    """
+
+    @classmethod
+    def create_argparser(cls, parent_parser):
+        parser = super().create_argparser(parent_parser)
+        optional = parser.add_argument_group("embed options")
+        optional.add_argument("--layer",
+            type=str,
+            default="segment1",
+            help="Name of the model layer whose outputs are the embeddings. Default: %(default)s")
+        optional.add_argument("--dataset",
+            choices=("train", "validation", "test"),
+            default="test",
+            help="Embed the utterances of the datagroup of this dataset config. Default: %(default)s")
+        optional.add_argument("--batch-size",
+            type=int,
+            default=256,
+            help="Maximum amount of utterances embedded with one model call. Default: %(default)s")
+        optional.add_argument("--max-frames",
+            type=int,
+            help="Maximum amount of frames in one batch, including padding. Default: batch size times the amount of frames of the longest utterance.")
+        optional.add_argument("--num-buckets",
+            type=int,
+            default=8,
+            help="Amount of sequence length buckets for batching utterances of similar length. Default: %(default)s")
+        optional.add_argument("--padding-value",
+            type=float,
+            default=0.0,
+            help="Pad and mask frames with this value, unless the model definition specifies a mask_value. Default: %(default)s")
+        optional.add_argument("--embeddings",
+            type=str,
+            help="Write embeddings to this path. Default: embeddings/<dataset>/<layer> in the model cache directory.")
+        optional.add_argument("--embeddings-format",
+            choices=sorted(system.SCORE_WRITERS),
+            default="npy",
+            help="Write embeddings as a float32 .npy matrix with utterance ids in a separate file, as Kaldi ark and scp files, or as text rows. Default: %(default)s")
+        optional.add_argument("--checkpoint",
+            type=str,
+            help="Specify which Keras checkpoint to load model weights from, instead of using the most recent one.")
+        return parser
+
+    def embed(self):
+        args = self.args
+        self.model_id = self.experiment_config["experiment"]["name"]
+        training_config = self.experiment_config["experiment"]
+        feat_config = self.experiment_config["features"]
+        if not args.embeddings:
+            args.embeddings = os.path.join(self.cache_dir, self.model_id, "embeddings", args.dataset, args.layer)
+        self.make_named_dir(os.path.dirname(args.embeddings))
+        labels = sorted(set(l for d in self.experiment_config["datasets"] for l in d["labels"]))
+        model_definition = training_config["model_definition"]
+        model_kwargs = model_definition.get("kwargs", {})
+        model_module = importlib.import_module("lidbox.models." + model_definition["name"])
+        assert "mask_value" in inspect.signature(model_module.loader).parameters, "cannot embed padded batches with model '{}', which does not support mask_value".format(model_definition["name"])
+        mask_value = model_kwargs.get("mask_value")
+        if mask_value is None:
+            mask_value = args.padding_value
+        # Same weights as the trained model, but padded frames are excluded from e.g. statistics pooling
+        training_config = dict(training_config, model_definition=dict(model_definition, kwargs=dict(model_kwargs, mask_value=mask_value)))
+        model = self.load_trained_model(training_config, labels)
+        if model is None:
+            return 1
+        ds_config = dict(training_config, **training_config[args.dataset])
+        del ds_config["train"], ds_config["validation"]
+        datagroup_key = ds_config.pop("datagroup")
+        conf_json, conf_checksum = config_checksum(self.experiment_config, datagroup_key)
+        features = self.load_features(
+            ds_config,
+            feat_config,
+            datagroup_key,
+            conf_json,
+            conf_checksum,
+            trim_audio=False,
+            debug_squeeze_last_dim=(ds_config["input_shape"][-1] == 1),
+        )
+        features = features.map(lambda feats, meta: (feats, meta[0]))
+        num_frames = self.get_utterance_num_frames(ds_config, feat_config, datagroup_key, conf_checksum)
+        max_frames = args.max_frames or args.batch_size * int(np.max(num_frames))
+        bucket_boundaries, bucket_batch_sizes, padding_ratio = tf_data.frame_budget_buckets(num_frames, max_frames, args.num_buckets, args.batch_size)
+        if args.verbosity > 1:
+            print("Batching features into batches of at most {} frames with bucket boundaries {} and batch sizes {}, at most {:.1f}% of the frames are padding".format(max_frames, bucket_boundaries, bucket_batch_sizes, 100 * padding_ratio))
+        features = features.apply(tf.data.experimental.bucket_by_sequence_length(
+            lambda feats, uttid: tf.shape(feats)[0],
+            bucket_boundaries,
+            bucket_batch_sizes,
+            padding_values=(tf.constant(mask_value, tf.float32), tf.constant('', tf.string))))
+        features = features.prefetch(tf_data.TF_AUTOTUNE)
+        if args.verbosity:
+            print("Writing embeddings from layer '{}' of datagroup '{}' in format '{}' to '{}'".format(args.layer, datagroup_key, args.embeddings_format, args.embeddings))
+        if args.verbosity > 1:
+            print(now_str(date=True), "- 0 utterances done")
+        num_done = 0
+        with system.open_score_writer(args.embeddings, None, args.embeddings_format) as writer:
+            for feats, uttids in features:
+                embeddings = model.embed_on_batch(feats, args.layer)
+                writer.write([uttid.decode("utf-8") for uttid in uttids.numpy()], embeddings)
+                num_batch = len(embeddings)
+                if args.verbosity > 1 and (num_done + num_batch) // 10000 > num_done // 10000:
+                    print(now_str(date=True), "-", num_done + num_batch, "utterances done")
+                num_done += num_batch
+        if args.verbosity:
+            print("Wrote embeddings of {} utterances to '{}'".format(num_done, args.embeddings))
+
+    def run(self):
+        super().run()
+        return self.embed()
 
 
 class Util(E2EBase):
     tasks = (
         "get_cache_checksum",
+        "pack_pcm_corpus",
+        "merge_feature_shards",
     )
 
     @classmethod
@@ -781,6 +1345,14 @@ class Util(E2EBase):
             type=str,
             metavar="datagroup_key",
             help="For a given datagroup key, compute md5sum of config file in the same way as it would be computed when generating the filename for the features cache. E.g. for checking if the pipeline will be using the cache or start the feature extraction from scratch.")
+        optional.add_argument("--pack-pcm-corpus",
+            type=str,
+            metavar="datagroup_key",
+            help="For a given datagroup key, decode all audio files listed in the utt2path files of all datasets into one contiguous int16 PCM file in the cache directory. Feature extraction will then read the audio of those utterances from a memory mapped view of the corpus instead of decoding each file separately.")
+        optional.add_argument("--merge-feature-shards",
+            type=str,
+            metavar="datagroup_key",
+            help="For a given datagroup key, merge all parts of the feature store written with 'train --shard i/N' into the feature store, e.g. if the merge was not done by the process that wrote the last part.")
         return parser
 
     def get_cache_checksum(self):
@@ -793,11 +1365,47 @@ class Util(E2EBase):
         print("cache md5 checksum for datagroup key '{}' is:".format(datagroup_key))
         print(conf_checksum)
 
+    def pack_pcm_corpus(self):
+        args = self.args
+        datagroup_key = args.pack_pcm_corpus
+        utt2path = collections.OrderedDict()
+        for ds_config in self.experiment_config["datasets"]:
+            datagroup = ds_config["datagroups"][datagroup_key]
+            utt2path_path = os.path.join(datagroup["path"], datagroup.get("utt2path", "utt2path"))
+            if args.verbosity:
+                print("Reading paths of wav files from utt2path file '{}'".format(utt2path_path))
+            for utt, path, *rest in parse_space_separated(utt2path_path):
+                assert utt not in utt2path, "duplicate utterance id found when parsing paths: '{}'".format(utt)
+                utt2path[utt] = path
+        pcm_corpus_prefix = self.get_pcm_corpus_prefix(datagroup_key)
+        self.make_named_dir(os.path.dirname(pcm_corpus_prefix), "PCM corpus")
+        if args.verbosity:
+            print("Packing {} files into PCM corpus '{}'".format(len(utt2path), pcm_corpus_prefix))
+        system.write_pcm_corpus(utt2path, pcm_corpus_prefix, verbosity=args.verbosity)
+
+    def merge_feature_shards(self):
+        args = self.args
+        datagroup_key = args.merge_feature_shards
+        training_config = self.experiment_config["experiment"]
+        ds_configs = [dict(training_config, **training_config[ds]) for ds in ("train", "validation", "test") if training_config.get(ds, {}).get("datagroup") == datagroup_key]
+        if not ds_configs:
+            print("Error: no dataset config in the experiment has datagroup '{}'".format(datagroup_key), file=sys.stderr)
+            return 1
+        conf_json, conf_checksum = config_checksum(self.experiment_config, datagroup_key)
+        features_cache_path = self.get_features_cache_path(ds_configs[0], self.experiment_config["features"], datagroup_key, conf_checksum)
+        with system.file_lock(features_cache_path, verbosity=args.verbosity):
+            if feature_store.is_complete(features_cache_path):
+                print("Feature store '{}' is already complete".format(features_cache_path))
+                return
+            if not self.merge_feature_parts(features_cache_path):
+                print("Error: cannot merge, all parts of feature store '{}' are not complete".format(features_cache_path), file=sys.stderr)
+                return 1
+
     def run(self):
         super().run()
         return self.run_tasks()
 
 
 command_tree = [
-    (E2E, [Train, Predict, Util]),
+    (E2E, [Train, Predict, Evaluate, Embed, Export, Optimize, Util]),
 ]
@@ -0,0 +1,388 @@
+"""
+Inference server that keeps a trained model and its feature extraction pipeline in memory and answers language identification requests over HTTP.
+"""
+import collections
+import concurrent.futures
+import http.server
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+import urllib.parse
+
+import librosa
+import numpy as np
+import tensorflow as tf
+
+from lidbox import yaml_pprint
+from lidbox.commands.e2e import E2EBase
+import lidbox.audio_feat as audio_feat
+import lidbox.models.xvector as xvector
+import lidbox.system as system
+import lidbox.tf_data as tf_data
+
+
+class BatchingPredictor:
+    """
+    Collect model inputs of concurrent requests into batches and predict each batch with one model call in a background thread.
+    A batch is predicted when it contains at least max_batch_size inputs or when max_latency seconds have passed since its first request was received.
+    """
+
+    def __init__(self, model, max_batch_size, max_latency):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="batching-predictor", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def submit(self, inputs):
+        """Add inputs of shape [N, ...] into the next batch and return a Future of the N predictions."""
+        future = concurrent.futures.Future()
+        self.requests.put((inputs, future))
+        return future
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            num_inputs = len(batch[0][0])
+            deadline = time.monotonic() + self.max_latency
+            while num_inputs < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                num_inputs += len(request[0])
+            try:
+                self.predict(batch)
+            except Exception as error:
+                # Keep serving other requests, only the requests of this batch that did not get a result fail
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+
+    def predict(self, batch):
+        # Inputs of different shapes, e.g. features of full utterances of different lengths, cannot be stacked into one model input
+        requests_by_shape = collections.defaultdict(list)
+        for inputs, future in batch:
+            requests_by_shape[inputs.shape[1:]].append((inputs, future))
+        for requests in requests_by_shape.values():
+            try:
+                inputs = np.concatenate([inputs for inputs, _ in requests])
+                predictions = np.concatenate([
+                    np.asarray(self.model.predict_on_batch(inputs[begin:begin+self.max_batch_size]))
+                    for begin in range(0, len(inputs), self.max_batch_size)])
+            except Exception as error:
+                for _, future in requests:
+                    future.set_exception(error)
+                continue
+            offsets = np.cumsum([0] + [len(inputs) for inputs, _ in requests])
+            for (_, future), begin, end in zip(requests, offsets[:-1], offsets[1:]):
+                future.set_result(predictions[begin:end])
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    POST /predict with a JSON body {"path": "/path/to/audio/file"}, or with a body of raw mono int16 little-endian PCM samples, Content-Type application/octet-stream and the sample rate as query parameter, e.g. /predict?sample_rate=16000.
+    The response is a JSON object with the score of each language, averaged over all chunks of the signal.
+    POST /stream?id=<stream id>&sample_rate=16000 with a body of raw PCM samples as above appends a block of audio into the stream with the given id, and responds with the scores of all audio of the stream so far.
+    Add end=1 into the query of the last block of the stream to flush the stream and free its state.
+    GET /labels returns the list of languages in the order used by the model.
+    """
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urllib.parse.urlparse(self.path).path != "/labels":
+            self.send_json(404, {"error": "unknown path '{}'".format(self.path)})
+            return
+        self.send_json(200, {"labels": self.server.command.labels})
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path == "/stream":
+            self.post_stream(url)
+            return
+        if url.path != "/predict":
+            self.send_json(404, {"error": "unknown path '{}'".format(url.path)})
+            return
+        command = self.server.command
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            if self.headers.get("Content-Type", '').startswith("application/octet-stream"):
+                sample_rate = int(urllib.parse.parse_qs(url.query)["sample_rate"][0])
+                signal = np.frombuffer(body, dtype="<i2").astype(np.float32) / 32768.0
+            else:
+                signal, sample_rate = command.load_audio(json.loads(body.decode("utf-8"))["path"])
+        except Exception as error:
+            self.send_json(400, {"error": "cannot read audio from request: {}".format(repr(error))})
+            return
+        try:
+            response = command.predict_signal(signal, sample_rate)
+        except (ValueError, AssertionError, tf.errors.InvalidArgumentError) as error:
+            self.send_json(422, {"error": str(error)})
+            return
+        except Exception as error:
+            self.send_json(500, {"error": "prediction failed: {}".format(repr(error))})
+            return
+        self.send_json(200, response)
+
+    def post_stream(self, url):
+        command = self.server.command
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            query = urllib.parse.parse_qs(url.query)
+            stream_id = query["id"][0]
+            sample_rate = int(query["sample_rate"][0])
+            end = query.get("end", ["0"])[0] == "1"
+            signal = np.frombuffer(body, dtype="<i2").astype(np.float32) / 32768.0
+        except Exception as error:
+            self.send_json(400, {"error": "cannot read stream block from request: {}".format(repr(error))})
+            return
+        try:
+            response = command.predict_stream_block(stream_id, signal, sample_rate, end)
+        except (ValueError, AssertionError, tf.errors.InvalidArgumentError) as error:
+            self.send_json(422, {"error": str(error)})
+            return
+        except Exception as error:
+            self.send_json(500, {"error": "prediction failed: {}".format(repr(error))})
+            return
+        self.send_json(200, response)
+
+    def address_string(self):
+        # Clients of unix sockets have no address
+        return self.client_address[0] if self.client_address else "unix-socket"
+
+    def log_message(self, format, *args):
+        if self.server.command.args.verbosity > 1:
+            super().log_message(format, *args)
+
+
+class UnixSocketHTTPServer(http.server.ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        # HTTPServer.server_bind expects a (host, port) address
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+
+class Serve(E2EBase):
+    """Keep a trained model in memory and predict language scores for audio received over HTTP, batching concurrent requests."""
+
+    @classmethod
+    def create_argparser(cls, parent_parser):
+        parser = super().create_argparser(parent_parser)
+        optional = parser.add_argument_group("serve options")
+        optional.add_argument("--host",
+            type=str,
+            default="127.0.0.1",
+            help="Address to listen on for HTTP requests. Default: %(default)s")
+        optional.add_argument("--port",
+            type=int,
+            default=8080,
+            help="Port to listen on for HTTP requests. Default: %(default)s")
+        optional.add_argument("--unix-socket",
+            type=str,
+            help="Listen on this unix socket path instead of a TCP port.")
+        optional.add_argument("--max-batch-size",
+            type=int,
+            default=64,
+            help="Maximum amount of model inputs, e.g. chunks of all concurrent requests, predicted in one batch. Default: %(default)s")
+        optional.add_argument("--max-latency-ms",
+            type=float,
+            default=10,
+            help="Maximum time to wait for more requests into a batch after its first request was received. Default: %(default)s")
+        optional.add_argument("--stream-timeout-sec",
+            type=float,
+            default=60,
+            help="Drop the state of streams that have received no blocks within this time. Default: %(default)s")
+        optional.add_argument("--chunk-aggregation",
+            choices=tf_data.CHUNK_SCORE_AGGREGATIONS,
+            default="mean_loglik",
+            help="How to aggregate chunk scores into utterance-level scores, as in predict. Default: %(default)s")
+        optional.add_argument("--checkpoint",
+            type=str,
+            help="Specify which Keras checkpoint to load model weights from, instead of using the most recent one.")
+        return parser
+
+    def load_audio(self, path):
+        wav_config = self.experiment_config["features"].get("wav_config", {})
+        res_type = wav_config.get("resampling", {}).get("type", "kaiser_best")
+        return system.load_resampled_audio(path, wav_config.get("target_sample_rate"), res_type=res_type)
+
+    def extract_features(self, signal, sample_rate):
+        """Extract features from a signal, divided into chunks if the config has wav_config.chunks, and return them as a batch of model inputs."""
+        feat_config = self.experiment_config["features"]
+        chunks = feat_config.get("wav_config", {}).get("chunks")
+        if chunks:
+            chunk_length = int(sample_rate * 1e-3 * chunks["length_ms"])
+            chunk_step = int(sample_rate * 1e-3 * chunks["step_ms"])
+            if signal.size < chunk_length:
+                raise ValueError("signal of length {} is shorter than the chunk length {}".format(signal.size, chunk_length))
+            audio = tf.signal.frame(signal, chunk_length, chunk_step, axis=0)
+        else:
+            num_frames = audio_feat.spectrogram_lengths(signal.size, sample_rate, **feat_config.get("spectrogram", {}))
+            if num_frames <= 0:
+                raise ValueError("signal of length {} is shorter than one spectrogram frame".format(signal.size))
+            audio = tf.expand_dims(signal, 0)
+        feats = self.extract_features_fn(audio, tf.fill([tf.shape(audio)[0]], sample_rate))
+        if "mean_var_norm_numpy" in feat_config:
+            feats = tf_data.mean_var_norm_nopad_slide_numpy(
+                feats.numpy(),
+                feat_config["mean_var_norm_numpy"]["window_len"],
+                feat_config["mean_var_norm_numpy"].get("normalize_variance", True))
+        return np.asarray(feats)
+
+    def aggregate_chunk_scores(self, chunk_scores):
+        """Utterance-level scores from the model outputs of all chunks of one utterance, aggregated as in predict and the exported model."""
+        _, reduced, num_chunks = tf_data.reduce_chunk_scores(
+            tf.fill([len(chunk_scores)], "utterance"),
+            tf.convert_to_tensor(chunk_scores),
+            self.args.chunk_aggregation,
+            self.output_activation)
+        scores = reduced[0].numpy()
+        if self.args.chunk_aggregation != "max":
+            scores /= num_chunks[0].numpy()
+        return scores
+
+    def predict_signal(self, signal, sample_rate):
+        wav_config = self.experiment_config["features"].get("wav_config", {})
+        target_sample_rate = wav_config.get("target_sample_rate")
+        if target_sample_rate and sample_rate != target_sample_rate:
+            res_type = wav_config.get("resampling", {}).get("type", "kaiser_best")
+            signal = librosa.core.resample(signal, sample_rate, target_sample_rate, res_type=res_type)
+            sample_rate = target_sample_rate
+        if "webrtcvad" in wav_config:
+            signal = tf_data.drop_silence(signal, sample_rate, wav_config["webrtcvad"], self.args.verbosity)
+        inputs = self.extract_features(np.asarray(signal, dtype=np.float32), sample_rate)
+        predictions = self.predictor.submit(inputs).result()
+        scores = self.aggregate_chunk_scores(predictions)
+        return {
+            "scores": {label: float(score) for label, score in zip(self.labels, scores)},
+            "num_chunks": len(predictions),
+        }
+
+    def predict_stream_block(self, stream_id, signal, sample_rate, end):
+        """
+        Append a block of audio into a stream and return the scores of all audio of the stream so far, computed incrementally by models.xvector.StreamingXVector.
+        Streams are not resampled and silence is not dropped, since both would need the whole signal.
+        """
+        target_sample_rate = self.experiment_config["features"].get("wav_config", {}).get("target_sample_rate")
+        if target_sample_rate and sample_rate != target_sample_rate:
+            raise ValueError("streams must have the sample rate of the model features {}, got {}".format(target_sample_rate, sample_rate))
+        with self.streams_lock:
+            now = time.monotonic()
+            for expired_id in [i for i, stream in self.streams.items() if now - stream["last_update"] > self.args.stream_timeout_sec]:
+                del self.streams[expired_id]
+            if stream_id not in self.streams:
+                self.streams[stream_id] = {
+                    "features": tf_data.StreamingFeatureExtractor(self.experiment_config["features"], sample_rate, self.stream_extract_features_fn),
+                    "model": xvector.StreamingXVector(self.model.model),
+                    "lock": threading.Lock(),
+                    "num_samples": 0,
+                }
+            stream = self.streams[stream_id]
+            stream["last_update"] = now
+            if end:
+                del self.streams[stream_id]
+        # Blocks of one stream are processed in order, different streams in parallel
+        with stream["lock"]:
+            stream["num_samples"] += signal.size
+            blocks = [stream["features"].update(signal)]
+            if end:
+                blocks.append(stream["features"].flush())
+            for feats in blocks:
+                if feats is not None:
+                    stream["model"].update(feats)
+            scores = stream["model"].get_outputs()
+        if scores is not None:
+            # The whole stream is one chunk
+            scores = self.aggregate_chunk_scores(scores[np.newaxis])
+        return {
+            "scores": None if scores is None else {label: float(score) for label, score in zip(self.labels, scores)},
+            "num_frames": stream["model"].num_frames,
+            "num_samples": stream["num_samples"],
+            "end": end,
+        }
+
+    def serve(self):
+        args = self.args
+        self.model_id = self.experiment_config["experiment"]["name"]
+        training_config = self.experiment_config["experiment"]
+        feat_config = self.experiment_config["features"]
+        if args.verbosity > 1:
+            print("Using feature extraction parameters:")
+            yaml_pprint(feat_config)
+            print()
+        self.labels = sorted(set(l for d in self.experiment_config["datasets"] for l in d["labels"]))
+        model = self.load_trained_model(training_config, self.labels)
+        if model is None:
+            return 1
+        self.model = model
+        self.output_activation = model.get_output_activation()
+        self.streams = {}
+        self.streams_lock = threading.Lock()
+        self.feat_extract_args = tf_data.feat_extraction_args_as_list(feat_config)
+        self.frontend = tf_data.get_frontend_layer(feat_config) if "frontend_layer" in feat_config else None
+        # Signals of any length and any amount of chunks are processed by the same graph, instead of tracing a new graph for every new signal length
+        self.extract_features_fn = tf.function(
+            lambda audio, sample_rate: tf_data.extract_features(audio_feat.Wav(audio, sample_rate), *self.feat_extract_args, frontend=self.frontend),
+            input_signature=[tf.TensorSpec([None, None], tf.float32), tf.TensorSpec([None], tf.int32)])
+        # Streams are normalized incrementally after feature extraction, all streams share the same graph
+        self.stream_extract_features_fn = tf_data.streaming_extract_features_fn(feat_config)
+        self.predictor = BatchingPredictor(model, args.max_batch_size, 1e-3 * args.max_latency_ms)
+        # Trace the feature extractor and the model before accepting requests
+        wav_config = feat_config.get("wav_config", {})
+        warmup_sample_rate = wav_config.get("target_sample_rate", 16000)
+        # At least 2 seconds, but never shorter than one chunk, which extract_features would reject
+        warmup_length = max(warmup_sample_rate * 2, int(warmup_sample_rate * 1e-3 * (wav_config.get("chunks") or {}).get("length_ms", 0)))
+        warmup_inputs = self.extract_features(np.zeros(warmup_length, dtype=np.float32), warmup_sample_rate)
+        model.predict_on_batch(warmup_inputs)
+        self.predictor.start()
+        if args.unix_socket:
+            if os.path.exists(args.unix_socket):
+                os.remove(args.unix_socket)
+            server = UnixSocketHTTPServer(args.unix_socket, RequestHandler)
+            address = "unix socket '{}'".format(args.unix_socket)
+        else:
+            server = http.server.ThreadingHTTPServer((args.host, args.port), RequestHandler)
+            address = "http://{}:{}".format(*server.server_address[:2])
+        server.command = self
+        if args.verbosity:
+            print("Serving predictions of model '{}' for labels {} at {}, batching at most {} inputs within {} ms".format(
+                self.model_id, self.labels, address, args.max_batch_size, args.max_latency_ms))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            if args.verbosity:
+                print("Interrupted, shutting down server")
+        finally:
+            server.server_close()
+            if args.unix_socket and os.path.exists(args.unix_socket):
+                os.remove(args.unix_socket)
+
+    def run(self):
+        super().run()
+        return self.serve()
+
+
+command_tree = [
+    (Serve, []),
+]
@@ -0,0 +1,298 @@
+"""
+Sharded TFRecord storage for extracted features.
+Features and their metadata are written as tf.train.Example records into N shards, and a tab separated index maps each utterance id to the shard and byte offset of its record.
+The shards can be read in parallel with tf.data interleave and single utterances can be read by seeking directly to their records.
+"""
+import collections
+import json
+import os
+import re
+import shutil
+
+import numpy as np
+import tensorflow as tf
+
+from . import audio_feat
+from .tf_data import TF_AUTOTUNE
+
+INDEX_FILENAME = "index.tsv"
+META_FILENAME = "meta.json"
+SHARD_FORMAT = "shard-{:05d}-of-{:05d}.tfrecord"
+PART_FORMAT = "part-{:05d}-of-{:05d}"
+PART_PATTERN = re.compile(r"part-(\d+)-of-(\d+)")
+# Every TFRecord is prefixed with a uint64 length and a uint32 CRC of the length, and suffixed with a uint32 CRC of the data
+RECORD_HEADER_BYTES = 12
+RECORD_FOOTER_BYTES = 4
+
+# Source is an optional key of the utterance that produced the record, e.g. a content hash of the audio file
+IndexEntry = collections.namedtuple("IndexEntry", ["utt", "shard", "offset", "length", "num_frames", "label", "dataset", "source"], defaults=('',))
+
+
+def _bytes_feature(value):
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+def _int64_feature(values):
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=list(values)))
+
+def serialize_example(feats, utt, label, dataset, wav):
+    feats = np.asarray(feats, dtype=np.float32)
+    example = tf.train.Example(features=tf.train.Features(feature={
+        "features": _bytes_feature(feats.tobytes()),
+        "shape": _int64_feature(feats.shape),
+        "utt": _bytes_feature(utt),
+        "label": _bytes_feature(label),
+        "dataset": _bytes_feature(dataset),
+        "audio": _bytes_feature(np.asarray(wav.audio, dtype=np.float32).tobytes()),
+        "sample_rate": _int64_feature([wav.sample_rate]),
+    }))
+    return example.SerializeToString()
+
+def get_parse_fn(feature_rank):
+    feature_description = {
+        "features": tf.io.FixedLenFeature([], tf.string),
+        "shape": tf.io.FixedLenFeature([feature_rank], tf.int64),
+        "utt": tf.io.FixedLenFeature([], tf.string),
+        "label": tf.io.FixedLenFeature([], tf.string),
+        "audio": tf.io.FixedLenFeature([], tf.string),
+        "sample_rate": tf.io.FixedLenFeature([], tf.int64),
+    }
+    def parse_example(record):
+        example = tf.io.parse_single_example(record, feature_description)
+        feats = tf.reshape(tf.io.decode_raw(example["features"], tf.float32), example["shape"])
+        wav = audio_feat.Wav(
+            tf.io.decode_raw(example["audio"], tf.float32),
+            tf.cast(example["sample_rate"], tf.int32))
+        return feats, (example["utt"], example["label"], wav)
+    return parse_example
+
+def source_utterance(utt, known_utterances):
+    """Find the utterance that produced utt by stripping '-suffix' parts added by chunking and augmentation until a known utterance id is found."""
+    while utt not in known_utterances and '-' in utt:
+        utt = utt.rsplit('-', 1)[0]
+    return utt
+
+def source_dataset(utt, utt2dataset):
+    return utt2dataset.get(source_utterance(utt, utt2dataset), '')
+
+def is_complete(store_dir):
+    return os.path.exists(os.path.join(store_dir, META_FILENAME))
+
+def load_meta(store_dir):
+    with open(os.path.join(store_dir, META_FILENAME)) as f:
+        return json.load(f)
+
+def write(ds, store_dir, num_shards=16, utt2dataset=None, verbosity=0, utt2source=None, extra_meta=None):
+    """
+    Iterate once over ds, which must contain elements (features, (uttid, label, wav)), and write all elements as records into num_shards TFRecord shards in store_dir.
+    If utt2source is given, the utterance id prefix of every record is replaced by the source key of the utterance and the key is written into the index.
+    All files are written into a temporary directory, which is renamed to store_dir after the meta file has been written, so readers never see partially written stores.
+    """
+    assert num_shards > 0, "feature store must have at least one shard"
+    if utt2dataset is None:
+        utt2dataset = {}
+    final_store_dir, store_dir = store_dir, get_tmp_dir(store_dir)
+    os.makedirs(store_dir, exist_ok=True)
+    shards = [SHARD_FORMAT.format(i, num_shards) for i in range(num_shards)]
+    writers = [tf.io.TFRecordWriter(os.path.join(store_dir, shard)) for shard in shards]
+    offsets = [0 for _ in shards]
+    feature_rank = None
+    num_records = 0
+    index_path = os.path.join(store_dir, INDEX_FILENAME)
+    try:
+        with open(index_path + ".tmp", "w") as index_f:
+            for i, (feats, (utt, label, wav)) in enumerate(ds.as_numpy_iterator()):
+                if feature_rank is None:
+                    feature_rank = feats.ndim
+                assert feats.ndim == feature_rank, "all features in a feature store must have equal rank, expected {} but got {} for '{}'".format(feature_rank, feats.ndim, utt)
+                utt_str, label_str = utt.decode("utf-8"), label.decode("utf-8")
+                dataset = source_dataset(utt_str, utt2dataset)
+                row_suffix = []
+                if utt2source is not None:
+                    source_utt = source_utterance(utt_str, utt2source)
+                    source = utt2source[source_utt]
+                    utt_str = source + utt_str[len(source_utt):]
+                    utt = utt_str.encode("utf-8")
+                    row_suffix = [source]
+                record = serialize_example(feats, utt, label, dataset.encode("utf-8"), wav)
+                shard_index = i % num_shards
+                writers[shard_index].write(record)
+                print(utt_str, shards[shard_index], offsets[shard_index], len(record), feats.shape[0], label_str, dataset, *row_suffix, sep='\t', file=index_f)
+                offsets[shard_index] += RECORD_HEADER_BYTES + len(record) + RECORD_FOOTER_BYTES
+                num_records += 1
+                if verbosity > 1 and num_records % 10000 == 0:
+                    print(num_records, "records written to feature store '{}'".format(store_dir))
+    finally:
+        for writer in writers:
+            writer.close()
+    os.rename(index_path + ".tmp", index_path)
+    meta = {
+        "shards": shards,
+        "feature_rank": feature_rank if feature_rank is not None else 2,
+        "num_records": num_records,
+    }
+    if extra_meta:
+        meta.update(extra_meta)
+    with open(os.path.join(store_dir, META_FILENAME), "w") as f:
+        json.dump(meta, f, indent=2)
+    publish(store_dir, final_store_dir)
+    if verbosity:
+        print("Wrote {} records into {} shards of feature store '{}'".format(num_records, num_shards, final_store_dir))
+    return meta
+
+def get_tmp_dir(store_dir):
+    """Temporary directory next to store_dir, unique for this process, such that paths relative to store_dir are also valid relative to the temporary directory."""
+    return "{}.tmp-{}".format(store_dir, os.getpid())
+
+def is_tmp_dir(path):
+    name = os.path.basename(path)
+    return ".tmp-" in name or ".old-" in name
+
+def publish(tmp_dir, store_dir):
+    """
+    Replace store_dir, e.g. an incomplete store left by a crashed process, with the complete store at tmp_dir.
+    An existing store_dir is first renamed aside and removed only after tmp_dir has been renamed to store_dir, so store_dir never contains a mix of both stores.
+    """
+    old_dir = "{}.old-{}".format(store_dir, os.getpid())
+    if os.path.isdir(store_dir):
+        os.rename(store_dir, old_dir)
+    os.rename(tmp_dir, store_dir)
+    if os.path.isdir(old_dir):
+        shutil.rmtree(old_dir)
+
+def get_part_dirs(store_dir, num_parts):
+    """Directories of feature stores that contain disjoint parts of the feature store at store_dir, each written by an independent process."""
+    return [os.path.join(store_dir + ".parts", PART_FORMAT.format(i, num_parts)) for i in range(num_parts)]
+
+def find_part_dirs(store_dir):
+    """
+    Find all existing part directories of store_dir and return them ordered by part index, together with the total amount of parts, or an empty list and 0 if there are none.
+    All parts must have been written with the same total amount of parts.
+    """
+    parts_dir = store_dir + ".parts"
+    if not os.path.isdir(parts_dir):
+        return [], 0
+    part_names = sorted(e.name for e in os.scandir(parts_dir) if e.is_dir() and e.name.startswith("part-") and not is_tmp_dir(e.name))
+    if not part_names:
+        return [], 0
+    parsed = [PART_PATTERN.fullmatch(name) for name in part_names]
+    assert all(parsed), "unexpected part directories in '{}': {}".format(parts_dir, [n for n, p in zip(part_names, parsed) if not p])
+    num_parts = set(int(p.group(2)) for p in parsed)
+    assert len(num_parts) == 1, "parts of feature store '{}' have been written with different amounts of parts {}, remove the parts that do not belong to the same run".format(store_dir, sorted(num_parts))
+    num_parts = num_parts.pop()
+    indexes = [int(p.group(1)) for p in parsed]
+    assert all(0 <= i < num_parts for i in indexes), "part indexes {} of feature store '{}' are out of range for {} parts".format(indexes, store_dir, num_parts)
+    return [os.path.join(parts_dir, name) for name in part_names], num_parts
+
+def merge(part_dirs, store_dir, verbosity=0):
+    """
+    Merge complete feature stores in part_dirs into a single feature store at store_dir, without copying any records.
+    The index and the meta file of the merged store refer to the shards of the parts by paths relative to store_dir.
+    """
+    metas = [load_meta(part_dir) for part_dir in part_dirs]
+    feature_ranks = set(meta["feature_rank"] for meta in metas if meta["num_records"])
+    assert len(feature_ranks) <= 1, "cannot merge feature stores with different feature ranks {}".format(feature_ranks)
+    tmp_dir = get_tmp_dir(store_dir)
+    os.makedirs(tmp_dir, exist_ok=True)
+    shards = []
+    index_path = os.path.join(tmp_dir, INDEX_FILENAME)
+    with open(index_path + ".tmp", "w") as index_f:
+        for part_dir, meta in zip(part_dirs, metas):
+            part_path = os.path.relpath(part_dir, store_dir)
+            shards.extend(os.path.join(part_path, shard) for shard in meta["shards"])
+            for entry in load_index(part_dir).values():
+                entry = entry._replace(shard=os.path.join(part_path, entry.shard))
+                row = entry if entry.source else entry[:-1]
+                print(*row, sep='\t', file=index_f)
+    os.rename(index_path + ".tmp", index_path)
+    meta = {
+        "shards": shards,
+        "feature_rank": feature_ranks.pop() if feature_ranks else 2,
+        "num_records": sum(meta["num_records"] for meta in metas),
+        "parts": [os.path.relpath(part_dir, store_dir) for part_dir in part_dirs],
+    }
+    with open(os.path.join(tmp_dir, META_FILENAME), "w") as f:
+        json.dump(meta, f, indent=2)
+    publish(tmp_dir, store_dir)
+    if verbosity:
+        print("Merged {} records from {} parts into feature store '{}'".format(meta["num_records"], len(part_dirs), store_dir))
+    return meta
+
+def load(store_dir, cycle_length=None):
+    """Read all records from all shards of the feature store in parallel."""
+    meta = load_meta(store_dir)
+    shard_paths = [os.path.join(store_dir, shard) for shard in meta["shards"]]
+    if cycle_length is None:
+        cycle_length = len(shard_paths)
+    return (tf.data.Dataset
+            .from_tensor_slices(tf.constant(shard_paths, tf.string))
+            .interleave(
+                tf.data.TFRecordDataset,
+                cycle_length=cycle_length,
+                num_parallel_calls=TF_AUTOTUNE)
+            .map(get_parse_fn(meta["feature_rank"]), num_parallel_calls=TF_AUTOTUNE))
+
+def load_index(store_dir):
+    index = collections.OrderedDict()
+    with open(os.path.join(store_dir, INDEX_FILENAME)) as f:
+        for line in f:
+            utt, shard, offset, length, num_frames, label, dataset, *source = line.rstrip('\n').split('\t')
+            index[utt] = IndexEntry(utt, shard, int(offset), int(length), int(num_frames), label, dataset, *source)
+    return index
+
+def read_record(path, offset, length):
+    with open(path, "rb") as f:
+        f.seek(offset + RECORD_HEADER_BYTES)
+        return f.read(length)
+
+def read_utterance(store_dir, utt, index=None):
+    """Read the features and metadata of a single utterance by seeking to its record."""
+    if index is None:
+        index = load_index(store_dir)
+    entry = index[utt]
+    record = read_record(os.path.join(store_dir, entry.shard), entry.offset, entry.length)
+    return get_parse_fn(load_meta(store_dir)["feature_rank"])(tf.constant(record))
+
+def load_utterances(store_dir, utterance_ids, index=None):
+    """Read the records of the given utterances by seeking directly to each record."""
+    if index is None:
+        index = load_index(store_dir)
+    store_entries = [(store_dir, index[utt]) for utt in utterance_ids]
+    return load_entries(store_entries, load_meta(store_dir)["feature_rank"])
+
+def load_entries(store_entries, feature_rank, utterance_ids=None, labels=None):
+    """
+    Read records given as (store_dir, IndexEntry) pairs, possibly from several feature stores.
+    The records of each shard are read in the order of their offsets with a single open file per shard, and the shards are interleaved in parallel, i.e. the records are not returned in the order of store_entries.
+    If utterance_ids or labels are given, they replace the utterance ids or labels stored in the records.
+    """
+    if utterance_ids is None:
+        utterance_ids = [e.utt for _, e in store_entries]
+    if labels is None:
+        labels = [e.label for _, e in store_entries]
+    shard2records = collections.OrderedDict()
+    for (store_dir, e), utt, label in zip(store_entries, utterance_ids, labels):
+        shard2records.setdefault(os.path.join(store_dir, e.shard), []).append((e.offset, e.length, utt, label))
+    shard_paths = list(shard2records)
+    def read_shard_records(shard_index):
+        path = shard_paths[shard_index]
+        with open(path, "rb") as f:
+            for offset, length, utt, label in sorted(shard2records[path]):
+                f.seek(offset + RECORD_HEADER_BYTES)
+                yield f.read(length), utt, label
+    def shard_records_ds(shard_index):
+        return tf.data.Dataset.from_generator(
+            read_shard_records,
+            (tf.string, tf.string, tf.string),
+            (tf.TensorShape([]), tf.TensorShape([]), tf.TensorShape([])),
+            args=(shard_index,))
+    parse_example = get_parse_fn(feature_rank)
+    def parse_and_rename(record, utt, label):
+        feats, (_, _, wav) = parse_example(record)
+        return feats, (utt, label, wav)
+    return (tf.data.Dataset
+            .range(len(shard_paths))
+            .interleave(
+                shard_records_ds,
+                cycle_length=max(1, len(shard_paths)),
+                num_parallel_calls=TF_AUTOTUNE)
+            .map(parse_and_rename, num_parallel_calls=TF_AUTOTUNE))
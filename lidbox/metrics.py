@@ -0,0 +1,253 @@
+"""
+Language identification metrics.
+All threshold sweeps are computed by sorting the scores once and accumulating the errors with cumulative sums, which gives the result for every distinct score as threshold at once.
+The Keras metrics do the same sweep in the graph over fixed size score histograms, with the bin edges as thresholds, so they can be updated batch by batch during validation.
+"""
+import numpy as np
+import tensorflow as tf
+
+
+def detection_error_tradeoff(scores, is_target):
+    """
+    Miss and false alarm probabilities of accepting all scores greater than or equal to a threshold, for every distinct score as threshold.
+    Returns the thresholds in decreasing order, preceded by infinity, which rejects all scores, and the miss and false alarm probabilities at each threshold.
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    is_target = np.asarray(is_target, dtype=bool)
+    order = np.argsort(-scores, kind="stable")
+    scores, is_target = scores[order], is_target[order]
+    # Only the last score of a group of equal scores is a threshold, since all equal scores are accepted at once
+    is_last = np.append(scores[1:] != scores[:-1], True)
+    num_targets = is_target.sum()
+    num_nontargets = is_target.size - num_targets
+    with np.errstate(divide="ignore", invalid="ignore"):
+        p_miss = 1.0 - np.cumsum(is_target)[is_last] / num_targets
+        p_fa = np.cumsum(~is_target)[is_last] / num_nontargets
+    return np.append(np.inf, scores[is_last]), np.append(1.0, p_miss), np.append(0.0, p_fa)
+
+def equal_error_rate(scores, is_target):
+    """Equal error rate of target detection, interpolated linearly between the two thresholds where the false alarm rate exceeds the miss rate. Returns NaN if there are no targets or no non-targets."""
+    is_target = np.asarray(is_target, dtype=bool)
+    if is_target.all() or not is_target.any():
+        return np.nan
+    _, p_miss, p_fa = detection_error_tradeoff(scores, is_target)
+    diff = p_fa - p_miss
+    # diff is -1 at the first threshold, which rejects everything, and non-negative at the last threshold, which accepts everything
+    i = np.argmax(diff >= 0)
+    ratio = diff[i-1] / (diff[i-1] - diff[i])
+    return p_miss[i-1] + ratio * (p_miss[i] - p_miss[i-1])
+
+def min_detection_cost(scores, is_target, p_target=0.5, c_miss=1.0, c_fa=1.0):
+    """Minimum of the normalized detection cost function over all thresholds, and the threshold that minimizes it. Returns NaN if there are no targets or no non-targets."""
+    is_target = np.asarray(is_target, dtype=bool)
+    if is_target.all() or not is_target.any():
+        return np.nan, np.nan
+    thresholds, p_miss, p_fa = detection_error_tradeoff(scores, is_target)
+    cost = c_miss * p_target * p_miss + c_fa * (1 - p_target) * p_fa
+    i = np.argmin(cost)
+    return cost[i] / min(c_miss * p_target, c_fa * (1 - p_target)), thresholds[i]
+
+def _average_detection_cost_weights(scores, labels, p_target, c_miss, c_fa):
+    """
+    C_avg at threshold t is the constant c_miss * p_target plus the sum of the weights of all scores that are greater than or equal to t.
+    Accepting a target score decreases the miss cost of its language and accepting a non-target score increases the false alarm cost of the score language against the true language.
+    Only languages with at least one utterance are included.
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    labels = np.asarray(labels)
+    num_utterances = np.bincount(labels, minlength=scores.shape[1])
+    included = num_utterances > 0
+    num_languages = included.sum()
+    assert num_languages > 1, "C_avg requires utterances from at least 2 languages, got {}".format(num_languages)
+    is_target = labels[:, np.newaxis] == np.arange(scores.shape[1])
+    utterance_weights = 1.0 / (num_languages * num_utterances[labels])
+    weights = np.where(
+            is_target,
+            -c_miss * p_target * utterance_weights[:, np.newaxis],
+            c_fa * (1 - p_target) / (num_languages - 1) * utterance_weights[:, np.newaxis])
+    return scores[:, included], weights[:, included]
+
+def min_average_detection_cost(scores, labels, p_target=0.5, c_miss=1.0, c_fa=1.0):
+    """
+    Minimum average detection cost C_avg over all thresholds, and the threshold that minimizes it, as defined in the NIST language recognition evaluations, with one threshold for all languages.
+    scores is a matrix with a column of scores for each language and labels contains the index of the true language of each row.
+    """
+    scores, weights = _average_detection_cost_weights(scores, labels, p_target, c_miss, c_fa)
+    scores, weights = scores.ravel(), weights.ravel()
+    order = np.argsort(-scores, kind="stable")
+    scores, weights = scores[order], weights[order]
+    is_last = np.append(scores[1:] != scores[:-1], True)
+    cavg = c_miss * p_target + np.append(0.0, np.cumsum(weights)[is_last])
+    thresholds = np.append(np.inf, scores[is_last])
+    i = np.argmin(cavg)
+    return cavg[i], thresholds[i]
+
+def average_detection_cost(scores, labels, threshold, p_target=0.5, c_miss=1.0, c_fa=1.0):
+    """Average detection cost C_avg at the given threshold."""
+    scores, weights = _average_detection_cost_weights(scores, labels, p_target, c_miss, c_fa)
+    return c_miss * p_target + weights[scores >= threshold].sum()
+
+def precision_recall(scores, labels, threshold):
+    """Precision and recall of detecting each language by accepting all scores greater than or equal to threshold, NaN for languages that have no accepted scores or no utterances."""
+    scores = np.asarray(scores)
+    labels = np.asarray(labels)
+    accepted = scores >= threshold
+    true_positives = accepted[np.arange(labels.size), labels]
+    num_true_positives = np.bincount(labels[true_positives], minlength=scores.shape[1])
+    num_utterances = np.bincount(labels, minlength=scores.shape[1])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precision = num_true_positives / accepted.sum(axis=0)
+        recall = num_true_positives / num_utterances
+    # Accepted scores of languages without utterances are all false alarms, which would give precision 0 instead of undefined
+    precision[num_utterances == 0] = np.nan
+    return precision, recall
+
+def confusion_matrix(labels, predictions, num_labels):
+    """Matrix where row i, column j contains the amount of utterances of language i classified as language j."""
+    labels = np.asarray(labels, dtype=np.int64)
+    predictions = np.asarray(predictions, dtype=np.int64)
+    return np.bincount(labels * num_labels + predictions, minlength=num_labels * num_labels).reshape((num_labels, num_labels))
+
+
+class LanguageScoreHistogram(tf.keras.metrics.Metric):
+    """
+    Base class for streaming language detection metrics, which accumulate the scores of each language into fixed size histograms instead of storing all scores.
+    The histogram of shape (num_labels, num_labels, num_bins) contains, for every true language, the amount of scores of every language in each bin.
+    The thresholds are the lower bin edges, so accepting all scores in bins k, k+1, ... is the same as accepting all scores greater than or equal to threshold k, up to the bin width.
+    Scores outside [min_score, max_score) are counted in the first or last bin.
+    The default range is for probabilities, hence parse_metrics sets convert_scores from the output activation of the model, e.g. 'exp' for log_softmax outputs.
+    """
+
+    def __init__(self, num_labels, num_bins=1000, min_score=0.0, max_score=1.0, convert_scores=None, name=None, **kwargs):
+        super().__init__(name=name, **kwargs)
+        assert num_bins > 0, "num_bins must be positive, got {}".format(num_bins)
+        assert min_score < max_score, "min_score must be less than max_score, got {} and {}".format(min_score, max_score)
+        assert convert_scores in (None, "softmax", "exp"), "unknown convert_scores '{}'".format(convert_scores)
+        self.num_labels = num_labels
+        self.num_bins = num_bins
+        self.min_score = min_score
+        self.max_score = max_score
+        self.convert_scores = convert_scores
+        self.histogram = self.add_weight(
+                name="histogram",
+                shape=(num_labels, num_labels, num_bins),
+                initializer="zeros")
+
+    def update_state(self, y_true, y_pred, sample_weight=None):
+        """y_true contains the one-hot encoded true languages and y_pred the predicted scores of all languages."""
+        y_pred = tf.cast(y_pred, tf.float32)
+        if self.convert_scores == "softmax":
+            y_pred = tf.nn.softmax(y_pred)
+        elif self.convert_scores == "exp":
+            y_pred = tf.math.exp(y_pred)
+        labels = tf.math.argmax(y_true, axis=1, output_type=tf.int32)
+        bin_width = (self.max_score - self.min_score) / self.num_bins
+        bins = tf.clip_by_value(tf.cast(tf.math.floor((y_pred - self.min_score) / bin_width), tf.int32), 0, self.num_bins - 1)
+        # Flat index of (true language, score language, bin) for every score
+        index = (tf.expand_dims(labels, 1) * self.num_labels + tf.range(self.num_labels)) * self.num_bins + bins
+        weights = None
+        if sample_weight is not None:
+            weights = tf.broadcast_to(tf.reshape(tf.cast(sample_weight, tf.float32), (-1, 1)), tf.shape(index))
+            weights = tf.reshape(weights, [-1])
+        counts = tf.math.bincount(
+                tf.reshape(index, [-1]),
+                weights=weights,
+                minlength=self.histogram.shape.num_elements(),
+                maxlength=self.histogram.shape.num_elements(),
+                dtype=tf.float32)
+        self.histogram.assign_add(tf.reshape(counts, self.histogram.shape))
+
+    def thresholds(self):
+        """Thresholds of all accepted counts, from accepting all scores to accepting none."""
+        return tf.linspace(self.min_score, self.max_score, self.num_bins + 1)
+
+    def accepted_counts(self):
+        """Amount of scores greater than or equal to each threshold, the last threshold accepts no scores."""
+        accepted = tf.math.cumsum(self.histogram, axis=2, reverse=True)
+        return tf.pad(accepted, [[0, 0], [0, 0], [0, 1]])
+
+    def get_config(self):
+        return dict(
+                super().get_config(),
+                num_labels=self.num_labels,
+                num_bins=self.num_bins,
+                min_score=self.min_score,
+                max_score=self.max_score,
+                convert_scores=self.convert_scores)
+
+
+def _histogram_average_detection_cost(accepted, p_target, c_miss, c_fa):
+    """C_avg at every threshold from accepted counts of shape (true language, score language, threshold), as in min_average_detection_cost."""
+    num_utterances = tf.linalg.diag_part(accepted[:, :, 0])
+    included = tf.cast(num_utterances > 0, tf.float32)
+    num_languages = tf.reduce_sum(included)
+    # Fraction of utterances of the true language accepted as the score language, zero for languages without utterances
+    accepted_rate = tf.math.divide_no_nan(accepted, num_utterances[:, tf.newaxis, tf.newaxis])
+    is_target = tf.eye(tf.shape(accepted)[0])[:, :, tf.newaxis]
+    p_miss = (1.0 - tf.reduce_sum(is_target * accepted_rate, axis=0)) * included[:, tf.newaxis]
+    # False alarms against languages without utterances are excluded, as their columns are in min_average_detection_cost
+    p_fa = tf.reduce_sum((1.0 - is_target) * accepted_rate, axis=0) * included[:, tf.newaxis]
+    cost = c_miss * p_target * p_miss + tf.math.divide_no_nan(c_fa * (1 - p_target), num_languages - 1) * p_fa
+    return tf.math.divide_no_nan(tf.reduce_sum(cost, axis=0), num_languages)
+
+
+class MinAverageDetectionCost(LanguageScoreHistogram):
+    """Minimum average detection cost C_avg over all histogram thresholds, see min_average_detection_cost."""
+
+    def __init__(self, num_labels, p_target=0.5, c_miss=1.0, c_fa=1.0, name="min_c_avg", **kwargs):
+        super().__init__(num_labels, name=name, **kwargs)
+        self.p_target = p_target
+        self.c_miss = c_miss
+        self.c_fa = c_fa
+
+    def result(self):
+        return tf.reduce_min(_histogram_average_detection_cost(self.accepted_counts(), self.p_target, self.c_miss, self.c_fa))
+
+    def get_config(self):
+        return dict(super().get_config(), p_target=self.p_target, c_miss=self.c_miss, c_fa=self.c_fa)
+
+
+class AverageDetectionCost(MinAverageDetectionCost):
+    """Average detection cost C_avg at a fixed threshold, rounded down to the nearest histogram threshold."""
+
+    def __init__(self, num_labels, threshold=0.5, name="c_avg", **kwargs):
+        super().__init__(num_labels, name=name, **kwargs)
+        self.threshold = threshold
+
+    def result(self):
+        bin_width = (self.max_score - self.min_score) / self.num_bins
+        k = int(np.clip(np.floor((self.threshold - self.min_score) / bin_width), 0, self.num_bins))
+        return _histogram_average_detection_cost(self.accepted_counts(), self.p_target, self.c_miss, self.c_fa)[k]
+
+    def get_config(self):
+        return dict(super().get_config(), threshold=self.threshold)
+
+
+class AverageEqualErrorRate(LanguageScoreHistogram):
+    """Equal error rate of detecting each language, averaged over all languages that have targets and non-targets, see equal_error_rate."""
+
+    def __init__(self, num_labels, name="avg_eer", **kwargs):
+        super().__init__(num_labels, name=name, **kwargs)
+
+    def result(self):
+        accepted = self.accepted_counts()
+        is_target = tf.eye(self.num_labels)[:, :, tf.newaxis]
+        # Accepted target and non-target scores of each score language at every threshold
+        accepted_targets = tf.reduce_sum(is_target * accepted, axis=0)
+        accepted_nontargets = tf.reduce_sum((1.0 - is_target) * accepted, axis=0)
+        num_targets = accepted_targets[:, :1]
+        num_nontargets = accepted_nontargets[:, :1]
+        p_miss = 1.0 - tf.math.divide_no_nan(accepted_targets, num_targets)
+        p_fa = tf.math.divide_no_nan(accepted_nontargets, num_nontargets)
+        # Sweep from the last threshold, which accepts nothing, to the first threshold, which accepts everything
+        p_miss = tf.reverse(p_miss, axis=[1])
+        diff = tf.reverse(p_fa, axis=[1]) - p_miss
+        # diff is non-decreasing during the sweep, interpolate between the last negative and the first non-negative diff as in equal_error_rate
+        i = tf.clip_by_value(tf.math.count_nonzero(diff < 0, axis=1, dtype=tf.int32), 1, self.num_bins)
+        d0, d1 = tf.gather(diff, i - 1, batch_dims=1), tf.gather(diff, i, batch_dims=1)
+        m0, m1 = tf.gather(p_miss, i - 1, batch_dims=1), tf.gather(p_miss, i, batch_dims=1)
+        eer = m0 + tf.math.divide_no_nan(d0, d0 - d1) * (m1 - m0)
+        valid = tf.logical_and(num_targets[:, 0] > 0, num_nontargets[:, 0] > 0)
+        return tf.math.divide_no_nan(
+                tf.reduce_sum(tf.where(valid, eer, 0.0)),
+                tf.reduce_sum(tf.cast(valid, tf.float32)))
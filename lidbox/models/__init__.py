@@ -9,6 +9,9 @@ import numpy as np
 import tensorflow as tf
 
 from lidbox.tf_data import without_metadata
+import lidbox.audio_feat as audio_feat
+import lidbox.metrics
+import lidbox.tf_data as tf_data
 
 # Check if the KerasWrapper instance has a tf.device string argument and use that when running the method, else let tf decide
 def with_device(method):
@@ -36,13 +39,25 @@ def get_best_checkpoint(checkpoints, key="epoch", mode=None):
         elif mode == "max":
             return max(checkpoints, key=lambda p: float(key_fn(p)))
 
-def parse_metrics(metrics, target_names):
+def parse_metrics(metrics, target_names, output_activation=None):
+    """
+    Keras metrics from the list of metric configs.
+    output_activation is the activation of the model outputs, as returned by KerasWrapper.get_output_activation, from which language detection metrics convert the scores into probabilities, unless convert_scores is given.
+    """
     keras_metrics = []
     for m in metrics:
         metric = None
         kwargs = dict(m.get("kwargs", {}))
         if "cls" in m:
-            metric = getattr(tf.keras.metrics, m["cls"])(**kwargs)
+            if hasattr(lidbox.metrics, m["cls"]):
+                if "convert_scores" not in kwargs:
+                    kwargs["convert_scores"] = {"log_softmax": "exp", "softmax": None, None: "softmax"}[output_activation]
+                assert kwargs["convert_scores"] is not None or output_activation == "softmax" or "min_score" in kwargs or "max_score" in kwargs, (
+                    "metric '{}' histograms probabilities in [0, 1) by default, but the model outputs have activation '{}', set convert_scores or min_score and max_score".format(m["cls"], output_activation))
+                # Language detection metrics need the amount of languages for their histograms
+                metric = getattr(lidbox.metrics, m["cls"])(len(target_names), **kwargs)
+            else:
+                metric = getattr(tf.keras.metrics, m["cls"])(**kwargs)
         assert metric is not None, "unknown metric: '{}'".format(m)
         keras_metrics.append(metric)
     return keras_metrics
@@ -72,6 +87,74 @@ class LearningRateDateLogger(tf.keras.callbacks.Callback):
             output_stream=self.output_stream)
 
 
+class ServingModule(tf.Module):
+    """
+    Trained Keras model together with its feature extraction, for exporting as a SavedModel that needs only TensorFlow for inference.
+    The serving function takes the int16 PCM samples of one signal and their sample rate.
+    Signals are resampled in the graph by FFT resampling to the sample rate of the features, divided into chunks if the feature config has wav_config.chunks, and the chunk scores are aggregated into utterance-level scores as in Predict.
+    Silence is not dropped, since the WebRTC VAD does not run in the graph.
+    """
+
+    def __init__(self, keras_model, labels, feat_config, output_activation=None, chunk_aggregation="mean_loglik", name="serving"):
+        super().__init__(name=name)
+        self.model = keras_model
+        self.labels = tf.constant(labels, dtype=tf.string)
+        self.feat_extract_args = tf_data.feat_extraction_args_as_list(feat_config)
+        self.frontend = tf_data.get_frontend_layer(feat_config) if "frontend_layer" in feat_config else None
+        self.spec_kwargs = feat_config.get("spectrogram", {})
+        self.mean_var_norm_numpy = feat_config.get("mean_var_norm_numpy")
+        wav_config = feat_config.get("wav_config", {})
+        self.chunks = wav_config.get("chunks")
+        self.sample_rate = wav_config.get("target_sample_rate")
+        if self.sample_rate is None and self.frontend is not None:
+            self.sample_rate = self.frontend.sample_rate
+        self.output_activation = output_activation
+        self.chunk_aggregation = chunk_aggregation
+        # One fixed input signature, signals of any length are processed by the same graph
+        self.serve = tf.function(
+            self.predict_pcm,
+            input_signature=[tf.TensorSpec([None], tf.int16, name="pcm"), tf.TensorSpec([], tf.int32, name="sample_rate")])
+
+    def extract_features(self, pcm, sample_rate):
+        signal = tf.cast(pcm, tf.float32) / 32768.0
+        if self.sample_rate is not None:
+            if sample_rate != self.sample_rate:
+                new_length = tf.cast(tf.math.round(tf.cast(tf.size(signal), tf.float64) * self.sample_rate / tf.cast(sample_rate, tf.float64)), tf.int32)
+                signal = audio_feat.fft_resample(signal, new_length)
+            sample_rate = tf.constant(self.sample_rate, tf.int32)
+        if self.chunks:
+            chunk_length = audio_feat.ms_to_frames(sample_rate, self.chunks["length_ms"])
+            chunk_step = audio_feat.ms_to_frames(sample_rate, self.chunks["step_ms"])
+            tf.debugging.assert_greater_equal(tf.size(signal), chunk_length, message="signal is shorter than one chunk")
+            audio = tf.signal.frame(signal, chunk_length, chunk_step, axis=0)
+        else:
+            num_frames = audio_feat.spectrogram_lengths(tf.size(signal), sample_rate, **self.spec_kwargs)
+            tf.debugging.assert_positive(num_frames, message="signal is shorter than one spectrogram frame")
+            audio = tf.expand_dims(signal, 0)
+        signals = audio_feat.Wav(audio, tf.fill([tf.shape(audio)[0]], sample_rate))
+        feats = tf_data.extract_features(signals, *self.feat_extract_args, frontend=self.frontend)
+        if self.mean_var_norm_numpy:
+            feats = tf_data.mean_var_norm_nopad_slide(
+                feats,
+                self.mean_var_norm_numpy["window_len"],
+                self.mean_var_norm_numpy.get("normalize_variance", True))
+        return feats
+
+    def predict_pcm(self, pcm, sample_rate):
+        """Returns the labels, the scores of every chunk and the aggregated utterance-level scores."""
+        chunk_scores = self.model(self.extract_features(pcm, sample_rate), training=False)
+        # All chunks have the same source utterance
+        _, reduced, num_chunks = tf_data.reduce_chunk_scores(
+            tf.fill([tf.shape(chunk_scores)[0]], "utterance"),
+            chunk_scores,
+            self.chunk_aggregation,
+            self.output_activation)
+        scores = reduced[0]
+        if self.chunk_aggregation != "max":
+            scores /= tf.cast(num_chunks[0], scores.dtype)
+        return {"labels": self.labels, "chunk_scores": chunk_scores, "scores": scores}
+
+
 class KerasWrapper:
 
     @classmethod
@@ -82,6 +165,7 @@ class KerasWrapper:
         self.model_id = model_id
         self.device_str = device_str
         self.model = None
+        self.embedding_models = {}
         self.initial_epoch = 0
         model_module = importlib.import_module("lidbox.models." + model_definition["name"])
         self.model_loader = functools.partial(model_module.loader, **model_definition.get("kwargs", {}))
@@ -128,7 +212,7 @@ class KerasWrapper:
         else:
             loss = getattr(tf.keras.losses, loss_conf["cls"])(**loss_conf.get("kwargs", {}))
         if "metrics" in training_config:
-            metrics = parse_metrics(training_config["metrics"], target_names)
+            metrics = parse_metrics(training_config["metrics"], target_names, self.get_output_activation())
         else:
             metrics = None
         self.model.compile(
@@ -158,10 +242,66 @@ class KerasWrapper:
             verbose=model_config.get("verbose", 2),
         )
 
+    def fold_batch_norms(self):
+        """Fold the batch norms of all layers that support it, e.g. xvector.FrameLayer, into their weights for inference, and return the names of the folded layers."""
+        folded = []
+        for layer in self.model.layers:
+            if hasattr(layer, "fold_batch_norm"):
+                layer.fold_batch_norm()
+                folded.append(layer.name)
+        # Retrace predict, which might have been traced with the batch norms
+        self.model.predict_function = None
+        return folded
+
+    @with_device
+    def to_tflite(self, path, representative_dataset=None):
+        """
+        Convert the model to TensorFlow Lite and write it to path.
+        If representative_dataset is given, weights and activations are quantized to int8 using value ranges calibrated on the inputs it generates.
+        Layers without int8 kernels fall back to float32, inputs and outputs are float32.
+        """
+        converter = tf.lite.TFLiteConverter.from_keras_model(self.model)
+        if representative_dataset is not None:
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            converter.representative_dataset = representative_dataset
+        tflite_model = converter.convert()
+        with open(path, "wb") as f:
+            f.write(tflite_model)
+        return tflite_model
+
+    @with_device
+    def export(self, export_dir, labels, feat_config, chunk_aggregation="mean_loglik"):
+        """Write the model with its feature extraction into export_dir as a SavedModel with a 'serving_default' signature, see ServingModule."""
+        module = ServingModule(self.model, labels, feat_config, self.get_output_activation(), chunk_aggregation)
+        tf.saved_model.save(module, export_dir, signatures={"serving_default": module.serve})
+        return module
+
     @with_device
     def predict(self, testset):
         return self.predict_fn(self.model, testset)
 
+    @with_device
+    def predict_on_batch(self, inputs):
+        """Predict one batch of inputs with a single model call, without creating an input pipeline like predict does."""
+        return self.model.predict_on_batch(inputs)
+
+    @with_device
+    def embed_on_batch(self, inputs, layer_name):
+        """Outputs of the layer with name layer_name for one batch of inputs, computed by a sub-model that ends at that layer."""
+        if layer_name not in self.embedding_models:
+            layer = self.model.get_layer(layer_name)
+            self.embedding_models[layer_name] = tf.keras.Model(inputs=self.model.inputs, outputs=layer.output, name="{}-{}".format(self.model.name, layer_name))
+        return self.embedding_models[layer_name].predict_on_batch(inputs)
+
+    def get_output_activation(self):
+        """Name of the activation of the model outputs, 'softmax' or 'log_softmax', or None if the outputs are logits."""
+        output_layer = self.model.layers[-1]
+        if isinstance(output_layer, tf.keras.layers.Activation):
+            activation = output_layer.name
+        else:
+            activation = getattr(getattr(output_layer, "activation", None), "__name__", None)
+        return activation if activation in ("softmax", "log_softmax") else None
+
     @with_device
     def count_params(self):
         return sum(layer.count_params() for layer in self.model.layers)
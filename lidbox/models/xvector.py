@@ -10,24 +10,69 @@ from tensorflow.keras.layers import (
     Conv1D,
     Dense,
     Dropout,
+    GaussianNoise,
     Input,
+    InputLayer,
     Layer,
+    Masking,
 )
 from tensorflow.keras.models import Model
+import numpy as np
 import tensorflow as tf
 
 
 class GlobalMeanStddevPooling1D(Layer):
-    """Compute arithmetic mean and standard deviation of the inputs along the time steps dimension, then output the concatenation of the computed stats."""
-    def call(self, inputs):
+    """
+    Compute arithmetic mean and standard deviation of the inputs along the time steps dimension, then output the concatenation of the computed stats.
+    If the inputs have a mask, the stats are computed only over the unmasked time steps.
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.supports_masking = True
+
+    def call(self, inputs, mask=None):
         # assuming always channels_last
         steps_axis = 1
-        means = tf.math.reduce_mean(inputs, axis=steps_axis, keepdims=True)
-        variances = tf.math.reduce_mean(tf.math.square(inputs - means), axis=steps_axis)
+        if mask is None:
+            means = tf.math.reduce_mean(inputs, axis=steps_axis, keepdims=True)
+            variances = tf.math.reduce_mean(tf.math.square(inputs - means), axis=steps_axis)
+        else:
+            weights = tf.expand_dims(tf.cast(mask, inputs.dtype), -1)
+            num_steps = tf.math.reduce_sum(weights, axis=steps_axis, keepdims=True)
+            means = tf.math.divide_no_nan(tf.math.reduce_sum(weights * inputs, axis=steps_axis, keepdims=True), num_steps)
+            variances = tf.math.divide_no_nan(tf.math.reduce_sum(weights * tf.math.square(inputs - means), axis=steps_axis), tf.squeeze(num_steps, steps_axis))
         means = tf.squeeze(means, steps_axis)
         stddevs = tf.math.sqrt(tf.math.maximum(0.0, variances))
         return tf.concat((means, stddevs), axis=steps_axis)
 
+    def compute_mask(self, inputs, mask=None):
+        return None
+
+
+def fold_batch_norm_after_activation(linear_layer, batch_norm):
+    """
+    Fold an inference mode BatchNormalization that follows linear_layer and its activation into the weights of linear_layer.
+    Batch norm at inference is a per channel affine map scale * x + offset.
+    Since relu(|scale| * z) = |scale| * relu(z), the absolute scale is multiplied into the kernel and bias, and only the sign of the scale and the offset remain after the activation.
+    Returns the signs, or None if all scales are non-negative, and the offsets.
+    """
+    activation = linear_layer.get_config()["activation"]
+    assert activation in ("relu", "linear"), "cannot fold batch norm after activation '{}'".format(activation)
+    scale = 1.0 / np.sqrt(batch_norm.moving_variance.numpy() + batch_norm.epsilon)
+    if batch_norm.scale:
+        scale *= batch_norm.gamma.numpy()
+    offset = -batch_norm.moving_mean.numpy() * scale
+    if batch_norm.center:
+        offset += batch_norm.beta.numpy()
+    if activation == "linear":
+        sign = np.ones_like(scale)
+    else:
+        sign = np.where(scale < 0, -1.0, 1.0)
+    kernel, *bias = linear_layer.get_weights()
+    linear_layer.set_weights([kernel * (sign * scale)] + [b * (sign * scale) for b in bias])
+    sign = None if np.all(sign > 0) else tf.constant(sign, tf.float32)
+    return sign, tf.constant(offset, tf.float32)
+
 
 class FrameLayer(Layer):
     def __init__(self, filters, kernel_size, strides, name="frame", activation="relu", padding="valid", dropout_rate=None):
@@ -40,13 +85,42 @@ class FrameLayer(Layer):
                 padding=padding,
                 name="{}_conv".format(name))
         self.batch_norm = BatchNormalization(name="{}_bn".format(name))
+        self.folded_batch_norm = None
         self.dropout = None
         if dropout_rate:
             self.dropout = Dropout(rate=dropout_rate, name="{}_dropout".format(name))
+        self.supports_masking = True
 
-    def call(self, inputs, training=None):
-        x = self.conv(inputs)
-        x = self.batch_norm(x, training=training)
+    def fold_batch_norm(self):
+        """Fold the batch norm into the conv weights for inference, the layer cannot be trained after this."""
+        self.folded_batch_norm = fold_batch_norm_after_activation(self.conv, self.batch_norm)
+
+    def compute_mask(self, inputs, mask=None):
+        """
+        Output frames are unmasked if their whole receptive field in the input is unmasked.
+        Assumes the masked input frames are padding at the end of each sequence, as produced by padded_batch.
+        """
+        if mask is None:
+            return None
+        kernel_size, stride = self.conv.kernel_size[0], self.conv.strides[0]
+        if self.conv.padding == "same":
+            num_frames = -(-tf.math.reduce_sum(tf.cast(mask, tf.int32), axis=1) // stride)
+            max_frames = -(-tf.shape(inputs)[1] // stride)
+        else:
+            num_frames = tf.math.maximum(0, (tf.math.reduce_sum(tf.cast(mask, tf.int32), axis=1) - kernel_size) // stride + 1)
+            max_frames = tf.math.maximum(0, (tf.shape(inputs)[1] - kernel_size) // stride + 1)
+        return tf.sequence_mask(num_frames, max_frames)
+
+    def call(self, inputs, training=None, mask=None):
+        # The conv does not support masking, the mask of the outputs is computed by compute_mask
+        x = self.conv(tf.identity(inputs))
+        if self.folded_batch_norm is None:
+            x = self.batch_norm(x, training=training)
+        else:
+            sign, offset = self.folded_batch_norm
+            if sign is not None:
+                x *= sign
+            x += offset
         if self.dropout:
             x = self.dropout(x, training=training)
         return x
@@ -72,13 +146,24 @@ class SegmentLayer(Layer):
         super().__init__(name=name)
         self.dense = Dense(units, activation=activation, name="{}_dense".format(name))
         self.batch_norm = BatchNormalization(name="{}_bn".format(name))
+        self.folded_batch_norm = None
         self.dropout = None
         if dropout_rate:
             self.dropout = Dropout(rate=dropout_rate, name="{}_dropout".format(name))
 
+    def fold_batch_norm(self):
+        """Fold the batch norm into the dense weights for inference, the layer cannot be trained after this."""
+        self.folded_batch_norm = fold_batch_norm_after_activation(self.dense, self.batch_norm)
+
     def call(self, inputs, training=None):
         x = self.dense(inputs)
-        x = self.batch_norm(x, training=training)
+        if self.folded_batch_norm is None:
+            x = self.batch_norm(x, training=training)
+        else:
+            sign, offset = self.folded_batch_norm
+            if sign is not None:
+                x *= sign
+            x += offset
         if self.dropout:
             x = self.dropout(x)
         return x
@@ -99,9 +184,78 @@ class SegmentLayer(Layer):
         return cls(**config)
 
 
-def loader(input_shape, num_outputs, output_activation="log_softmax", channel_dropout_rate=0):
+class StreamingXVector:
+    """
+    Incremental inference with a trained x-vector model on a single stream of features that arrives in blocks of frames.
+    Every FrameLayer keeps the input frames that are still needed by its next output frame, so each block is convolved only once.
+    The stats pooling is replaced by running sums of the outputs of the last FrameLayer, from which the mean and standard deviation of all frames seen so far are computed after every block.
+    The layers after the stats pooling are applied on the pooled stats.
+    Only models that contain FrameLayers, masking, dropout and noise layers before the stats pooling are supported, e.g. xvector and xvector_extended.
+    """
+    def __init__(self, model):
+        layer_types = [type(layer) for layer in model.layers]
+        if GlobalMeanStddevPooling1D not in layer_types:
+            raise ValueError("model '{}' has no GlobalMeanStddevPooling1D layer".format(model.name))
+        pooling_index = layer_types.index(GlobalMeanStddevPooling1D)
+        self.frame_layers = []
+        for layer in model.layers[:pooling_index]:
+            if isinstance(layer, FrameLayer):
+                if layer.conv.padding != "valid" or layer.conv.dilation_rate != (1,):
+                    raise ValueError("streaming inference requires frame layers with valid padding and no dilation, layer '{}' has padding '{}' and dilation rate {}".format(layer.name, layer.conv.padding, layer.conv.dilation_rate))
+                self.frame_layers.append(layer)
+            elif not isinstance(layer, (InputLayer, Masking, Dropout, GaussianNoise)):
+                raise ValueError("streaming inference is not supported for layer '{}' of type {} before the stats pooling".format(layer.name, type(layer).__name__))
+        self.head_layers = model.layers[pooling_index+1:]
+        self.reset()
+
+    def reset(self):
+        self.buffers = [None] * len(self.frame_layers)
+        self.sums = None
+        self.square_sums = None
+        self.num_frames = 0
+
+    def update(self, X):
+        """Append frames X of shape (timedim, channels) to the stream and return the model outputs for all frames seen so far, or None if no frame has passed all frame layers yet."""
+        X = np.asarray(X, dtype=np.float32)
+        for i, layer in enumerate(self.frame_layers):
+            if self.buffers[i] is not None:
+                X = np.concatenate((self.buffers[i], X))
+            kernel_size, stride = layer.conv.kernel_size[0], layer.conv.strides[0]
+            num_outputs = (X.shape[0] - kernel_size) // stride + 1 if X.shape[0] >= kernel_size else 0
+            # Keep the frames that are needed by the next output frame
+            self.buffers[i] = X[num_outputs*stride:]
+            if num_outputs == 0:
+                return self.get_outputs()
+            X = layer(X[np.newaxis, :(num_outputs-1)*stride + kernel_size], training=False)[0].numpy()
+        X = X.astype(np.float64)
+        if self.sums is None:
+            self.sums = np.zeros(X.shape[1], np.float64)
+            self.square_sums = np.zeros(X.shape[1], np.float64)
+        self.sums += X.sum(axis=0)
+        self.square_sums += np.square(X).sum(axis=0)
+        self.num_frames += X.shape[0]
+        return self.get_outputs()
+
+    def get_outputs(self):
+        if not self.num_frames:
+            return None
+        means = self.sums / self.num_frames
+        stddevs = np.sqrt(np.maximum(0.0, self.square_sums / self.num_frames - np.square(means)))
+        x = tf.constant(np.concatenate((means, stddevs))[np.newaxis], tf.float32)
+        for layer in self.head_layers:
+            x = layer(x)
+        return x[0].numpy()
+
+
+def loader(input_shape, num_outputs, output_activation="log_softmax", channel_dropout_rate=0, mask_value=None):
+    """
+    If mask_value is given, input frames with all features equal to mask_value are masked, e.g. padding of padded_batch with the same padding value.
+    The mask is propagated through the frame layers and the masked frames are excluded from the stats pooling.
+    """
     inputs = Input(shape=input_shape, name="input")
     x = inputs
+    if mask_value is not None:
+        x = Masking(mask_value=mask_value, name="mask_padding")(x)
     if channel_dropout_rate > 0:
         x = Dropout(rate=channel_dropout_rate, noise_shape=(None, 1, input_shape[1]), name="channel_dropout")(x)
     x = FrameLayer(512, 5, 1, name="frame1")(x)
@@ -6,7 +6,9 @@ url: https://pdfs.semanticscholar.org/00a4/e57e9189162dc9875a1cdca527711f373b53.
 from tensorflow.keras.layers import (
     Activation,
     Dense,
+    Dropout,
     Input,
+    Masking,
 )
 from tensorflow.keras.models import Model
 import tensorflow as tf
@@ -18,9 +20,12 @@ from .xvector import (
 )
 
 
-def loader(input_shape, num_outputs, output_activation="log_softmax", channel_dropout_rate=0):
+def loader(input_shape, num_outputs, output_activation="log_softmax", channel_dropout_rate=0, mask_value=None):
+    """See xvector.loader for mask_value."""
     inputs = Input(shape=input_shape, name="input")
     x = inputs
+    if mask_value is not None:
+        x = Masking(mask_value=mask_value, name="mask_padding")(x)
     if channel_dropout_rate > 0:
         x = Dropout(rate=channel_dropout_rate, noise_shape=(None, 1, input_shape[1]), name="channel_dropout")(x)
     x = FrameLayer(512, 5, 1, name="frame1")(x)
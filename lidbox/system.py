@@ -1,18 +1,28 @@
 """File IO."""
+import collections
+import contextlib
+import fcntl
 import gzip
 import hashlib
 import json
 import os
 import subprocess
+import sys
+import threading
 
 from scipy.io import arff
+import kaldiio
 import librosa
 import numpy as np
+import soundfile
 import sox
 import yaml
 
 
 SUBPROCESS_BATCH_SIZE = 5000
+# Parsed contents of md5sum cache files, keyed by cache path, as pairs (amount of bytes parsed, md5sums)
+_md5sum_caches = {}
+_md5sum_caches_lock = threading.Lock()
 
 def run_command(cmd):
     process = subprocess.run(
@@ -64,6 +74,153 @@ def all_md5sums(paths, num_workers=32):
     with Pool(num_workers) as pool:
         return pool.map(md5sum, paths)
 
+def all_md5sums_cached(paths, cache_path, num_workers=32):
+    """
+    Same as all_md5sums, but the md5sums are stored in the tab separated file cache_path, keyed by the path, size and modification time of each file, and only files that are missing from the cache or have changed are read.
+    The files are hashed in threads instead of forked processes, since this is called from processes that are already running TensorFlow.
+    The parsed cache is kept in memory and only lines appended since the previous call are parsed, so this can be called once per file.
+    """
+    import concurrent.futures
+    keys = []
+    for path in paths:
+        stat = os.stat(path)
+        keys.append((os.path.abspath(path), stat.st_size, stat.st_mtime_ns))
+    with _md5sum_caches_lock:
+        cache = _read_md5sum_cache(cache_path)
+        missing = sorted(set(key for key in keys if key not in cache))
+        md5sums = [cache.get(key) for key in keys]
+    if missing:
+        # hashlib releases the GIL while hashing
+        with concurrent.futures.ThreadPoolExecutor(min(num_workers, len(missing))) as executor:
+            new_md5sums = dict(zip(missing, executor.map(md5sum, [path for path, _, _ in missing])))
+        with _md5sum_caches_lock, file_lock(cache_path):
+            with open(cache_path, "a") as f:
+                for key, digest in new_md5sums.items():
+                    print(*key, digest, sep='\t', file=f)
+        md5sums = [new_md5sums[key] if digest is None else digest for key, digest in zip(keys, md5sums)]
+    return md5sums
+
+def _read_md5sum_cache(cache_path):
+    """Update the in-memory copy of the md5sum cache file cache_path with lines appended since it was last read and return it."""
+    offset, cache = _md5sum_caches.get(cache_path, (0, {}))
+    if os.path.exists(cache_path):
+        # Writers append complete lines while holding an exclusive lock
+        with file_lock(cache_path, shared=True):
+            with open(cache_path, "rb") as f:
+                f.seek(offset)
+                data = f.read()
+        for line in data.decode("utf-8").splitlines():
+            path, size, mtime_ns, digest = line.split('\t')
+            cache[(path, int(size), int(mtime_ns))] = digest
+        offset += len(data)
+    _md5sum_caches[cache_path] = offset, cache
+    return cache
+
+@contextlib.contextmanager
+def file_lock(path, shared=False, verbosity=0):
+    """
+    Hold an advisory lock on the file path + '.lock' until the context exits.
+    Exclusive locks are held by processes writing the cache at path, shared locks by processes reading it.
+    If the lock is held by another process, block until it is released.
+    The lock is an flock, which does not exclude processes running on other NFS clients, i.e. concurrent writers of a cache on a network filesystem must run on the same host.
+    """
+    lock_path = path + ".lock"
+    os.makedirs(os.path.dirname(os.path.abspath(lock_path)), exist_ok=True)
+    operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    with open(lock_path, "a") as lock_f:
+        try:
+            fcntl.flock(lock_f, operation | fcntl.LOCK_NB)
+        except BlockingIOError:
+            if verbosity:
+                print("Waiting for another process to release the lock '{}'".format(lock_path))
+            fcntl.flock(lock_f, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_f, fcntl.LOCK_UN)
+
+def write_atomic(path, text):
+    """Write text into path such that concurrent readers see either nothing or the complete file."""
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "w") as f:
+        print(text, file=f, end='')
+    os.replace(tmp_path, path)
+
+def load_resampled_audio(path, sample_rate, cache_dir=None, res_type="kaiser_best", decoded=None):
+    """
+    Decode path into a mono signal, resampled to sample_rate with the librosa resampler res_type.
+    If decoded is given, it must be a pair (signal, sample_rate) of the already decoded contents of path, which is then resampled instead of decoding the file.
+    If cache_dir is given, the resampled signal is stored there as a .npy file named by the md5sum of the contents of path, sample_rate and res_type, and later calls load the stored signal instead of decoding and resampling again.
+    The md5sums are cached by all_md5sums_cached in cache_dir, hence files are not read again on a hit unless they have been modified, and identical audio at different paths shares the resampled signal.
+    """
+    def load():
+        if decoded is None:
+            return librosa.core.load(path, sr=sample_rate, mono=True, res_type=res_type)
+        signal, decoded_sample_rate = decoded
+        if sample_rate is None or sample_rate == decoded_sample_rate:
+            return signal, decoded_sample_rate
+        return librosa.core.resample(signal, decoded_sample_rate, sample_rate, res_type=res_type), sample_rate
+    if cache_dir is None or sample_rate is None:
+        return load()
+    content_md5 = all_md5sums_cached([path], os.path.join(cache_dir, "md5sums.tsv"), num_workers=1)[0]
+    key = "{}_{}Hz_{}".format(content_md5, sample_rate, res_type)
+    cache_path = os.path.join(cache_dir, key[:2], key + ".npy")
+    if os.path.exists(cache_path):
+        return np.load(cache_path), sample_rate
+    signal, sample_rate = load()
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    # Write into a temporary file first to never expose partially written signals to concurrent readers
+    tmp_path = "{}.{}.tmp.npy".format(cache_path[:-len(".npy")], os.getpid())
+    np.save(tmp_path, signal)
+    os.rename(tmp_path, cache_path)
+    return signal, sample_rate
+
+PCMCorpus = collections.namedtuple("PCMCorpus", ["samples", "index"])
+PCMCorpusEntry = collections.namedtuple("PCMCorpusEntry", ["path", "offset", "length", "sample_rate"])
+
+def write_pcm_corpus(utt2path, output_prefix, verbosity=0):
+    """
+    Decode all audio files in utt2path into one contiguous blob of mono int16 PCM samples at output_prefix + '.int16'.
+    Each utterance is written into the index file output_prefix + '.index' as a row 'utt path offset length sample_rate', where offset and length are in samples.
+    """
+    offset = 0
+    num_skipped = 0
+    with open(output_prefix + ".int16.tmp", "wb") as samples_f, open(output_prefix + ".index.tmp", "w") as index_f:
+        for i, (utt, path) in enumerate(utt2path.items(), start=1):
+            try:
+                signal, sample_rate = soundfile.read(path, dtype="int16", always_2d=True)
+            except RuntimeError as error:
+                print("warning: skipping utterance '{}', cannot read '{}' as PCM: {}".format(utt, path, error), file=sys.stderr)
+                num_skipped += 1
+                continue
+            if signal.shape[1] > 1:
+                # Merge channels by averaging
+                signal = np.round(signal.mean(axis=1)).astype(np.int16)
+            else:
+                signal = signal[:,0]
+            samples_f.write(signal.tobytes())
+            print(utt, path, offset, signal.size, sample_rate, file=index_f)
+            offset += signal.size
+            if verbosity > 1 and i % 10000 == 0:
+                print(i, "files packed")
+    os.rename(output_prefix + ".int16.tmp", output_prefix + ".int16")
+    os.rename(output_prefix + ".index.tmp", output_prefix + ".index")
+    if verbosity:
+        print("Packed {} samples from {} files into '{}', {} files skipped".format(offset, len(utt2path) - num_skipped, output_prefix + ".int16", num_skipped))
+
+def load_pcm_corpus(prefix):
+    """Memory map the samples blob written by write_pcm_corpus and load its index as a dict of utterance ids to PCMCorpusEntry."""
+    if os.path.getsize(prefix + ".int16") > 0:
+        samples = np.memmap(prefix + ".int16", dtype=np.int16, mode="r")
+    else:
+        samples = np.zeros(0, dtype=np.int16)
+    index = {}
+    with open(prefix + ".index") as f:
+        for line in f:
+            utt, path, offset, length, sample_rate = line.split()
+            index[utt] = PCMCorpusEntry(path, int(offset), int(length), int(sample_rate))
+    return PCMCorpus(samples, index)
+
 def load_gzip_json(path):
     with gzip.open(path, mode="rt", encoding="utf-8") as f:
         return json.load(f)
@@ -192,3 +349,128 @@ def parse_path_list(path):
             paths.append(path)
             labels.append(label)
     return paths, labels
+
+
+class TextScoreWriter:
+    """Write scores as text rows 'utt score1 score2 ...', preceded by a header row of the labels, unless labels is None."""
+
+    def __init__(self, path, labels, precision=6, separator=' '):
+        self.file = open(path, "w")
+        self.score_format = "%.{}f".format(precision)
+        self.separator = separator
+        if labels is not None:
+            print(*labels, file=self.file)
+
+    def write(self, utterance_ids, scores):
+        # Format whole columns at once instead of every float separately
+        lines = np.asarray(utterance_ids, dtype=str)
+        for column in np.char.mod(self.score_format, np.asarray(scores)).T:
+            lines = np.char.add(np.char.add(lines, self.separator), column)
+        if lines.size:
+            print(*lines, sep='\n', file=self.file)
+
+    def close(self):
+        self.file.close()
+
+
+class NpyScoreWriter:
+    """
+    Write scores as a float32 matrix into a .npy file and the utterance ids of the rows into path + '.ids', one id per line.
+    The labels of the columns are written into path + '.labels', unless labels is None, in which case the amount of columns is taken from the first write.
+    The rows are appended after a fixed size header, which is rewritten with the final amount of rows on close.
+    """
+    # Magic string, version and header length, followed by the header dict padded with spaces and terminated with a newline, as in numpy.lib.format version 1.0
+    header_bytes = 128
+
+    def __init__(self, path, labels, **kwargs):
+        self.path = path
+        self.num_labels = len(labels) if labels is not None else None
+        self.num_rows = 0
+        self.dtype = np.dtype(np.float32)
+        self.npy_file = open(path, "wb")
+        self.npy_file.write(self.npy_header())
+        self.ids_file = open(path + ".ids", "w")
+        if labels is not None:
+            with open(path + ".labels", "w") as f:
+                print(*labels, sep='\n', file=f)
+
+    def npy_header(self):
+        header = "{{'descr': {!r}, 'fortran_order': False, 'shape': ({:d}, {:d}), }}".format(self.dtype.str, self.num_rows, self.num_labels or 0)
+        header_len = self.header_bytes - 10
+        assert len(header) < header_len, "too long npy header '{}'".format(header)
+        return b"\x93NUMPY\x01\x00" + header_len.to_bytes(2, "little") + header.ljust(header_len - 1).encode("latin1") + b"\n"
+
+    def write(self, utterance_ids, scores):
+        scores = np.asarray(scores, dtype=self.dtype)
+        if self.num_labels is None and scores.ndim == 2:
+            self.num_labels = scores.shape[1]
+        assert scores.ndim == 2 and scores.shape[1] == self.num_labels, "expected scores of shape (N, {}) but got {}".format(self.num_labels, scores.shape)
+        self.npy_file.write(scores.tobytes())
+        for utt in utterance_ids:
+            print(utt, file=self.ids_file)
+        self.num_rows += scores.shape[0]
+
+    def close(self):
+        self.npy_file.seek(0)
+        self.npy_file.write(self.npy_header())
+        self.npy_file.close()
+        self.ids_file.close()
+
+
+class KaldiArkScoreWriter:
+    """Write the scores of each utterance as a Kaldi float vector into path + '.ark', indexed by path + '.scp'."""
+
+    def __init__(self, path, labels, **kwargs):
+        self.writer = kaldiio.WriteHelper("ark,scp:{0}.ark,{0}.scp".format(path))
+
+    def write(self, utterance_ids, scores):
+        for utt, utt_scores in zip(utterance_ids, np.asarray(scores, dtype=np.float32)):
+            self.writer(utt, utt_scores)
+
+    def close(self):
+        self.writer.close()
+
+
+SCORE_WRITERS = {
+    "text": TextScoreWriter,
+    "npy": NpyScoreWriter,
+    "kaldi_ark": KaldiArkScoreWriter,
+}
+
+@contextlib.contextmanager
+def open_score_writer(path, labels, output_format="text", **kwargs):
+    """
+    Context manager returning a score writer with method write(utterance_ids, scores), which appends a batch of scores into the output.
+    labels can be None for columns without labels, e.g. embeddings.
+    """
+    writer = SCORE_WRITERS[output_format](path, labels, **kwargs)
+    try:
+        yield writer
+    finally:
+        writer.close()
+
+def read_scores(path, input_format="text", separator=' '):
+    """
+    Read scores written by a score writer of the given format.
+    Returns the labels of the score columns, or None if the format does not store labels, the utterance ids of the rows and the scores as a float32 matrix.
+    """
+    if input_format == "text":
+        with open(path) as f:
+            labels = f.readline().split()
+            rows = [line.rstrip('\n').split(separator) for line in f if line.strip()]
+        utterance_ids = [row[0] for row in rows]
+        scores = np.array([row[1:] for row in rows], dtype=np.float32).reshape((len(rows), len(labels)))
+    elif input_format == "npy":
+        with open(path + ".labels") as f:
+            labels = [line.strip() for line in f if line.strip()]
+        with open(path + ".ids") as f:
+            utterance_ids = [line.strip() for line in f if line.strip()]
+        scores = np.load(path, mmap_mode="r")
+    elif input_format == "kaldi_ark":
+        labels = None
+        utt2scores = kaldiio.load_scp(path + ".scp")
+        utterance_ids = list(utt2scores)
+        scores = np.array([utt2scores[utt] for utt in utterance_ids], dtype=np.float32)
+    else:
+        raise ValueError("unknown scores format '{}', expected one of {}".format(input_format, sorted(SCORE_WRITERS)))
+    return labels, utterance_ids, scores
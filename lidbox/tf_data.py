@@ -1,6 +1,6 @@
 import contextlib
 import collections
-import io
+import hashlib
 import os
 import random
 import sys
@@ -8,14 +8,14 @@ import time
 import wave
 
 from . import audio_feat
+from . import system
+from . import vad_engine
 from lidbox import yaml_pprint
 import kaldiio
 import librosa.core
 import matplotlib.cm
 import numpy as np
-import soundfile
 import tensorflow as tf
-import webrtcvad
 
 debug = False
 if debug:
@@ -39,70 +39,251 @@ def feature_scaling(X, min, max, axis=None):
     X_max = tf.math.reduce_max(X, axis=axis, keepdims=True)
     return min + (max - min) * tf.math.divide_no_nan(X - X_min, X_max - X_min)
 
+def window_moments(X, begin, end):
+    """
+    Means and standard deviations over the time axis 1 of X, for every pair of window bounds [begin, end).
+    Computed from cumulative sums in float64, without materializing the windows.
+    """
+    X = tf.cast(X, tf.float64)
+    padding = [[0, 0], [1, 0], [0, 0]]
+    sums = tf.pad(tf.math.cumsum(X, axis=1), padding)
+    square_sums = tf.pad(tf.math.cumsum(tf.math.square(X), axis=1), padding)
+    window_len = tf.reshape(tf.cast(end - begin, tf.float64), [1, -1, 1])
+    mean = (tf.gather(sums, end, axis=1) - tf.gather(sums, begin, axis=1)) / window_len
+    variance = (tf.gather(square_sums, end, axis=1) - tf.gather(square_sums, begin, axis=1)) / window_len - tf.math.square(mean)
+    return mean, tf.math.sqrt(tf.math.maximum(tf.constant(0.0, tf.float64), variance))
+
+def normalize_with_moments(X, mean, std, normalize_variance):
+    centered = tf.cast(X, tf.float64) - mean
+    if normalize_variance:
+        centered = tf.math.divide_no_nan(centered, std)
+    return tf.cast(centered, X.dtype)
+
 @tf.function
 def mean_var_norm_slide(X, window_len=300, normalize_variance=True):
     """Apply mean and variance norm on batches of features matrices X with a given window length."""
     tf.debugging.assert_rank(X, 3, message="Input to mean_var_norm_slide should be of shape (batch_size, timedim, channels)")
-    if tf.shape(X)[1] <= window_len:
+    num_frames = tf.shape(X)[1]
+    if num_frames <= window_len:
         # All frames of X fit inside one window, no need for sliding window
-        centered = X - tf.math.reduce_mean(X, axis=1, keepdims=True)
-        if normalize_variance:
-            return tf.math.divide_no_nan(centered, tf.math.reduce_std(X, axis=1, keepdims=True))
-        else:
-            return centered
+        mean, std = window_moments(X, tf.zeros([num_frames], tf.int32), tf.fill([num_frames], num_frames))
     else:
         # Padding by reflecting the coefs along the time dimension should not dilute the means and variances as much as zeros would
         padding = tf.constant([[0, 0], [window_len//2, window_len//2 - 1 + (window_len&1)], [0, 0]])
-        X_padded = tf.pad(X, padding, mode="REFLECT")
-        windows = tf.signal.frame(X_padded, window_len, 1, axis=1)
-        tf.debugging.assert_equal(tf.shape(windows)[1], tf.shape(X)[1], message="Mismatching amount of output windows and time steps in the input")
-        centered = X - tf.math.reduce_mean(windows, axis=2)
-        if normalize_variance:
-            return tf.math.divide_no_nan(centered, tf.math.reduce_std(windows, axis=2))
-        else:
-            return centered
-
-# NOTE tensorflow does not yet support non-zero axes in tf.gather when indices are ragged
-# @tf.function
-# def mean_var_norm_gather(X, window_len=300):
-#     """Same as mean_var_norm_slide but without padding."""
-#     tf.debugging.assert_rank_at_least(X, 3)
-#     num_total_frames = tf.shape(X)[1]
-#     begin = tf.range(0, num_total_frames) - window_len // 2 + 1
-#     end = begin + window_len
-#     begin = tf.clip_by_value(begin, 0, num_total_frames)
-#     end = tf.clip_by_value(end, 0, num_total_frames)
-#     window_indices = tf.ragged.range(begin, end)
-#     windows = tf.gather(X, window_indices, axis=1)
-#     return tf.math.divide_no_nan(
-#         X - tf.math.reduce_mean(windows, axis=2),
-#         tf.math.reduce_std(windows, axis=2)
-#     )
+        begin = tf.range(num_frames)
+        mean, std = window_moments(tf.pad(X, padding, mode="REFLECT"), begin, begin + window_len)
+    return normalize_with_moments(X, mean, std, normalize_variance)
+
+@tf.function
+def mean_var_norm_nopad_slide(X, window_len=300, normalize_variance=True):
+    """Same as mean_var_norm_slide but without padding, the windows are truncated at both ends of X."""
+    tf.debugging.assert_rank(X, 3, message="Input to mean_var_norm_nopad_slide should be of shape (batch_size, timedim, channels)")
+    num_frames = tf.shape(X)[1]
+    if num_frames <= window_len:
+        begin = tf.zeros([num_frames], tf.int32)
+        end = tf.fill([num_frames], num_frames)
+    else:
+        begin = tf.range(num_frames) - window_len // 2
+        end = tf.clip_by_value(begin + window_len, 0, num_frames)
+        begin = tf.clip_by_value(begin, 0, num_frames)
+    mean, std = window_moments(X, begin, end)
+    return normalize_with_moments(X, mean, std, normalize_variance)
+
+def window_moments_numpy(X, begin, end):
+    """NumPy version of window_moments."""
+    X = X.astype(np.float64)
+    padding = [(0, 0), (1, 0), (0, 0)]
+    sums = np.pad(np.cumsum(X, axis=1), padding)
+    square_sums = np.pad(np.cumsum(np.square(X), axis=1), padding)
+    window_len = (end - begin).astype(np.float64).reshape(1, -1, 1)
+    mean = (sums[:,end] - sums[:,begin]) / window_len
+    variance = (square_sums[:,end] - square_sums[:,begin]) / window_len - np.square(mean)
+    return mean, np.sqrt(np.maximum(0.0, variance))
+
+def normalize_with_moments_numpy(X, mean, std, normalize_variance):
+    centered = X.astype(np.float64) - mean
+    if normalize_variance:
+        # Same as tf.math.divide_no_nan
+        centered = np.divide(centered, std, out=np.zeros_like(centered), where=std != 0)
+    return centered.astype(X.dtype)
+
+def mean_var_norm_slide_numpy(X, window_len, normalize_variance):
+    """NumPy version of mean_var_norm_slide."""
+    num_frames = X.shape[1]
+    if num_frames <= window_len:
+        mean, std = window_moments_numpy(X, np.zeros(num_frames, np.int64), np.full(num_frames, num_frames))
+    else:
+        padding = [(0, 0), (window_len//2, window_len//2 - 1 + (window_len&1)), (0, 0)]
+        begin = np.arange(num_frames)
+        mean, std = window_moments_numpy(np.pad(X, padding, mode="reflect"), begin, begin + window_len)
+    return normalize_with_moments_numpy(X, mean, std, normalize_variance)
 
 def mean_var_norm_nopad_slide_numpy(X, window_len, normalize_variance):
-    num_total_frames = X.shape[1]
-    if num_total_frames <= window_len:
-        centered = X - np.mean(X, axis=1, keepdims=True)
-        if normalize_variance:
-            centered /= np.std(X, axis=1, keepdims=True)
-        return centered
-    begin = np.arange(0, num_total_frames) - window_len // 2
-    end = begin + window_len
-    begin = np.clip(begin, 0, num_total_frames)
-    end = np.clip(end, 0, num_total_frames)
-    result = np.zeros_like(X)
-    for i, (b, e) in enumerate(zip(begin, end)):
-        window = X[:,b:e]
-        centered = X[:,i] - np.mean(window, axis=1)
-        if normalize_variance:
-            centered /= np.std(window, axis=1)
-        result[:,i] = centered
-    return result
+    """NumPy version of mean_var_norm_nopad_slide."""
+    num_frames = X.shape[1]
+    if num_frames <= window_len:
+        begin = np.zeros(num_frames, np.int64)
+        end = np.full(num_frames, num_frames)
+    else:
+        begin = np.arange(num_frames) - window_len // 2
+        end = np.clip(begin + window_len, 0, num_frames)
+        begin = np.clip(begin, 0, num_frames)
+    mean, std = window_moments_numpy(X, begin, end)
+    return normalize_with_moments_numpy(X, mean, std, normalize_variance)
+
+class StreamingMeanVarNorm:
+    """
+    Stateful mean_var_norm_nopad_slide_numpy for a single features matrix of shape (timedim, channels) that arrives in chunks.
+    Cumulative sums are carried across chunks and every frame is returned as soon as its window is complete.
+    Concatenating all outputs of update and flush gives the same result as applying mean_var_norm_nopad_slide_numpy on the concatenated chunks.
+    """
+    def __init__(self, window_len, normalize_variance=True):
+        self.window_len = window_len
+        self.normalize_variance = normalize_variance
+        self.reset()
+
+    def reset(self):
+        # Frames that are still inside some incomplete window and the cumulative sums up to each buffered frame
+        self.frames = None
+        self.sums = None
+        self.square_sums = None
+        # Index of the first buffered frame, the total amount of input frames, and the amount of output frames
+        self.buffer_begin = 0
+        self.num_frames = 0
+        self.num_done = 0
+
+    def _normalize(self, end_frame, window_end=None):
+        t = np.arange(self.num_done, end_frame)
+        begin = np.maximum(0, t - self.window_len // 2) - self.buffer_begin
+        if window_end is None:
+            end = t - self.window_len // 2 + self.window_len - self.buffer_begin
+        else:
+            end = np.minimum(t - self.window_len // 2 + self.window_len, window_end) - self.buffer_begin
+        window_len = (end - begin).astype(np.float64).reshape(-1, 1)
+        mean = (self.sums[end] - self.sums[begin]) / window_len
+        variance = (self.square_sums[end] - self.square_sums[begin]) / window_len - np.square(mean)
+        frames = self.frames[t - self.buffer_begin]
+        normalized = normalize_with_moments_numpy(frames[np.newaxis], mean[np.newaxis], np.sqrt(np.maximum(0.0, variance))[np.newaxis], self.normalize_variance)[0]
+        self.num_done = end_frame
+        # Drop all frames that are not inside the window of any remaining frame
+        drop = max(0, self.num_done - self.window_len // 2 - self.buffer_begin)
+        self.frames = self.frames[drop:]
+        self.sums = self.sums[drop:]
+        self.square_sums = self.square_sums[drop:]
+        self.buffer_begin += drop
+        return normalized
+
+    def update(self, X):
+        """Append frames X to the stream and return all frames that can be normalized."""
+        X = np.asarray(X)
+        if self.frames is None:
+            self.frames = X[:0]
+            self.sums = np.zeros((1, X.shape[1]), np.float64)
+            self.square_sums = np.zeros((1, X.shape[1]), np.float64)
+        X64 = X.astype(np.float64)
+        self.frames = np.concatenate((self.frames, X))
+        self.sums = np.concatenate((self.sums, self.sums[-1] + np.cumsum(X64, axis=0)))
+        self.square_sums = np.concatenate((self.square_sums, self.square_sums[-1] + np.cumsum(np.square(X64), axis=0)))
+        self.num_frames += X.shape[0]
+        if self.num_frames <= self.window_len:
+            # The stream might end before the first window fills, in which case all frames are normalized with global statistics
+            return X[:0]
+        # Frame t is complete when the end of its window, t - window_len//2 + window_len, has been seen
+        end_frame = self.num_frames - self.window_len + self.window_len // 2 + 1
+        return self._normalize(max(self.num_done, end_frame))
+
+    def flush(self):
+        """Normalize all remaining frames with windows truncated at the end of the stream, and reset the stream."""
+        if self.frames is None:
+            return None
+        if self.num_frames <= self.window_len:
+            normalized = mean_var_norm_nopad_slide_numpy(self.frames[np.newaxis], self.window_len, self.normalize_variance)[0]
+        else:
+            normalized = self._normalize(self.num_frames, self.num_frames)
+        self.reset()
+        return normalized
+
+def streaming_extract_features_fn(feat_config):
+    """
+    Same as extract_features with a fixed input signature of a batch of audio and the sample rates, but without mean_var_norm_slide, which StreamingFeatureExtractor applies incrementally.
+    """
+    *feat_extract_args, _ = feat_extraction_args_as_list(feat_config)
+    frontend = get_frontend_layer(feat_config) if "frontend_layer" in feat_config else None
+    return tf.function(
+        lambda audio, sample_rate: extract_features(audio_feat.Wav(audio, sample_rate), *feat_extract_args, {}, frontend=frontend),
+        input_signature=[tf.TensorSpec([None, None], tf.float32), tf.TensorSpec([None], tf.int32)])
+
+class StreamingFeatureExtractor:
+    """
+    Extract features from a single signal that arrives in blocks of samples, by computing the spectrogram frames of each block once and keeping the samples needed by the next frame.
+    If the feature config has mean_var_norm_slide or mean_var_norm_numpy, the features are normalized with StreamingMeanVarNorm, which delays each frame until its window is complete.
+    For mean_var_norm_slide, the windows are truncated at the ends of the stream instead of reflect padded, hence the first and last window_len/2 frames of streams longer than window_len differ from features of the whole signal.
+    Features that are scaled over the whole signal, i.e. db_spectrogram and sample_minmax_scaling, cannot be streamed.
+    extract_features_fn must be a function returned by streaming_extract_features_fn for the same feature config, and defaults to a new one.
+    """
+    def __init__(self, feat_config, sample_rate, extract_features_fn=None):
+        if "sample_minmax_scaling" in feat_config:
+            raise ValueError("cannot stream features that are scaled with 'sample_minmax_scaling' by the minimum and maximum of the whole signal")
+        if feat_config["type"] == "db_spectrogram":
+            raise ValueError("cannot stream db_spectrogram features, which are scaled by the maximum of the whole signal")
+        if extract_features_fn is None:
+            extract_features_fn = streaming_extract_features_fn(feat_config)
+        self.extract_features_fn = extract_features_fn
+        self.sample_rate = sample_rate
+        spec_kwargs = feat_config.get("spectrogram", {})
+        self.frame_length = int(audio_feat.ms_to_frames(sample_rate, spec_kwargs.get("frame_length_ms", 25)))
+        self.frame_step = int(audio_feat.ms_to_frames(sample_rate, spec_kwargs.get("frame_step_ms", 10)))
+        # Same order as extract_features and the mean_var_norm_numpy step after it
+        self.mean_var_norms = []
+        if "mean_var_norm_slide" in feat_config:
+            self.mean_var_norms.append(StreamingMeanVarNorm(
+                feat_config["mean_var_norm_slide"].get("window_len", 300),
+                feat_config["mean_var_norm_slide"].get("normalize_variance", True)))
+        if "mean_var_norm_numpy" in feat_config:
+            self.mean_var_norms.append(StreamingMeanVarNorm(
+                feat_config["mean_var_norm_numpy"]["window_len"],
+                feat_config["mean_var_norm_numpy"].get("normalize_variance", True)))
+        self.samples = np.zeros(0, np.float32)
+
+    def update(self, signal):
+        """Append samples to the stream and return the features of all frames that are complete, or None if there are none."""
+        self.samples = np.concatenate((self.samples, np.asarray(signal, dtype=np.float32)))
+        num_frames = (self.samples.size - self.frame_length) // self.frame_step + 1 if self.samples.size >= self.frame_length else 0
+        if num_frames == 0:
+            return None
+        audio = self.samples[np.newaxis, :(num_frames-1)*self.frame_step + self.frame_length]
+        self.samples = self.samples[num_frames*self.frame_step:]
+        feats = self.extract_features_fn(audio, tf.constant([self.sample_rate], tf.int32))[0].numpy()
+        for mean_var_norm in self.mean_var_norms:
+            feats = mean_var_norm.update(feats)
+        return feats if feats.shape[0] else None
+
+    def flush(self):
+        """Return the features of the remaining frames that were delayed by normalization, or None if there are none, and reset the stream."""
+        feats = None
+        for mean_var_norm in self.mean_var_norms:
+            # Frames flushed from the previous normalization are still pending in this one
+            blocks = [] if feats is None else [mean_var_norm.update(feats)]
+            flushed = mean_var_norm.flush()
+            if flushed is not None:
+                blocks.append(flushed)
+            feats = np.concatenate(blocks) if blocks else None
+        self.samples = np.zeros(0, np.float32)
+        return feats if feats is not None and feats.shape[0] else None
 
 @tf.function
-def extract_features(signals, feattype, spec_kwargs, melspec_kwargs, mfcc_kwargs, db_spec_kwargs, feat_scale_kwargs, mean_var_norm_kwargs):
+def extract_features(signals, feattype, spec_kwargs, melspec_kwargs, mfcc_kwargs, db_spec_kwargs, feat_scale_kwargs, mean_var_norm_kwargs, lengths=None, frontend=None):
+    """
+    Extract features from a batch of signals.
+    If lengths is given, the signals are assumed to be zero padded to equal length and power_to_db is computed separately for each signal.
+    If frontend is given, it must be an audio_feat.FeatureFrontEnd, which is used instead of the spectrogram, melspectrogram and mfcc functions.
+    """
     sample_rate = signals.sample_rate[0]
     tf.debugging.assert_equal(signals.sample_rate, [sample_rate], message="All signals in the feature extraction batch must have equal sample rates")
+    if frontend is not None:
+        tf.debugging.assert_equal(sample_rate, frontend.sample_rate, message="Feature extraction front-end layer was created for a different sample rate")
+        feat = frontend(signals.audio, lengths=lengths)
+        return apply_feature_normalization(feat, feat_scale_kwargs, mean_var_norm_kwargs)
     feat = audio_feat.spectrograms(signals, **spec_kwargs)
     tf.debugging.assert_all_finite(feat, "spectrogram failed")
     if feattype in ("melspectrogram", "logmelspectrogram", "mfcc"):
@@ -118,8 +299,15 @@ def extract_features(signals, feattype, spec_kwargs, melspec_kwargs, mfcc_kwargs
                 feat = mfccs[..., coef_begin:coef_end]
                 tf.debugging.assert_all_finite(feat, "mfcc failed")
     elif feattype in ("db_spectrogram",):
-        feat = audio_feat.power_to_db(feat, **db_spec_kwargs)
+        if lengths is None:
+            feat = audio_feat.power_to_db(feat, **db_spec_kwargs)
+        else:
+            num_frames = audio_feat.spectrogram_lengths(lengths, sample_rate, **spec_kwargs)
+            feat = audio_feat.power_to_db_masked(feat, tf.sequence_mask(num_frames, tf.shape(feat)[1]), **db_spec_kwargs)
         tf.debugging.assert_all_finite(feat, "db_spectrogram failed")
+    return apply_feature_normalization(feat, feat_scale_kwargs, mean_var_norm_kwargs)
+
+def apply_feature_normalization(feat, feat_scale_kwargs, mean_var_norm_kwargs):
     if feat_scale_kwargs:
         feat = feature_scaling(feat, **feat_scale_kwargs)
         tf.debugging.assert_all_finite(feat, "feature scaling failed")
@@ -128,6 +316,19 @@ def extract_features(signals, feattype, spec_kwargs, melspec_kwargs, mfcc_kwargs
         tf.debugging.assert_all_finite(feat, "mean_var_norm failed")
     return feat
 
+def get_frontend_layer(feat_config):
+    """Create an audio_feat.FeatureFrontEnd from the feature extraction config, with key 'frontend_layer' containing at least the sample rate."""
+    frontend_config = feat_config["frontend_layer"]
+    return audio_feat.FeatureFrontEnd(
+        frontend_config["sample_rate"],
+        feattype=feat_config["type"],
+        spectrogram=feat_config.get("spectrogram"),
+        melspectrogram=feat_config.get("melspectrogram"),
+        mfcc=feat_config.get("mfcc"),
+        db_spectrogram=feat_config.get("db_spectrogram"),
+        trim_mel_band=frontend_config.get("trim_mel_band", True),
+        sparse_mel_bands=frontend_config.get("sparse_mel_bands", False))
+
 def feat_extraction_args_as_list(feat_config):
     args = [feat_config["type"]]
     kwarg_dicts = [
@@ -182,14 +383,14 @@ def append_webrtcvad_decisions(ds, config):
     vad_frame_step = tf.constant(config["vad_frame_step"], tf.int32)
     feat_frame_length = tf.constant(config["feat_frame_length"], tf.int32)
     feat_frame_step = tf.constant(config["feat_frame_step"], tf.int32)
-    wavs_to_bytes = lambda wav, *rest: (wav, audio_feat.wav_to_bytes(wav), *rest)
-    apply_webrtcvad = lambda wav, wav_bytes, *rest: (
+    wavs_to_pcm = lambda wav, *rest: (wav, audio_feat.wav_to_pcm16(wav), *rest)
+    apply_webrtcvad = lambda wav, pcm, *rest: (
         wav,
         *rest,
         tf.numpy_function(
             audio_feat.framewise_webrtcvad_decisions,
             [tf.size(wav.audio),
-             wav_bytes,
+             pcm,
              wav.sample_rate,
              vad_frame_length,
              vad_frame_step,
@@ -197,7 +398,7 @@ def append_webrtcvad_decisions(ds, config):
              feat_frame_step,
              aggressiveness],
             tf.bool))
-    return (ds.map(wavs_to_bytes, num_parallel_calls=TF_AUTOTUNE)
+    return (ds.map(wavs_to_pcm, num_parallel_calls=TF_AUTOTUNE)
               .map(apply_webrtcvad, num_parallel_calls=TF_AUTOTUNE))
 
 def append_mfcc_energy_vad_decisions(ds, config):
@@ -237,7 +438,44 @@ def make_random_frame_chunker_fn(len_config):
         return tf.gather(features, chunk_indices)
     return chunk_timedim_randomly
 
-def prepare_dataset_for_training(ds, config, feat_config, label2onehot, model_id, conf_checksum='', verbosity=0):
+def frame_budget_buckets(num_frames, max_frames, num_buckets, max_batch_size=None):
+    """
+    Bucket boundaries and batch sizes for bucket_by_sequence_length, such that every batch has at most max_frames frames, including padding.
+    The boundaries divide the sorted sequence lengths num_frames into num_buckets contiguous groups with the minimum total amount of padding, when every sequence is padded to the longest sequence of its group.
+    The batch size of each bucket is max_frames divided by the longest sequence of the bucket.
+    Returns the boundaries, the batch sizes, and the fraction of padding frames of all frames when all sequences are padded to the longest sequence of their bucket.
+    """
+    lengths, counts = np.unique(np.asarray(num_frames, dtype=np.int64), return_counts=True)
+    assert lengths.size > 0, "cannot compute bucket boundaries without sequence lengths"
+    num_buckets = min(num_buckets, lengths.size)
+    cum_counts = np.concatenate(([0], np.cumsum(counts)))
+    cum_frames = np.concatenate(([0], np.cumsum(counts * lengths)))
+    # padding[k, j] is the minimum padding of lengths[:j+1] in k+1 groups, and begin[k, j] is the first index of the last group
+    padding = np.full((num_buckets, lengths.size), np.inf)
+    begin = np.zeros((num_buckets, lengths.size), np.int64)
+    padding[0] = lengths * cum_counts[1:] - cum_frames[1:]
+    for k in range(1, num_buckets):
+        for j in range(k, lengths.size):
+            # Padding of all groups before the last group, which is lengths[i:j+1], for every i
+            i = np.arange(k, j + 1)
+            total = padding[k-1, i-1] + lengths[j] * (cum_counts[j+1] - cum_counts[i]) - (cum_frames[j+1] - cum_frames[i])
+            best = np.argmin(total)
+            padding[k, j], begin[k, j] = total[best], i[best]
+    group_ends = [lengths.size - 1]
+    for k in range(num_buckets - 1, 0, -1):
+        group_ends.append(begin[k, group_ends[-1]] - 1)
+    group_ends.reverse()
+    boundaries = [int(lengths[end]) + 1 for end in group_ends[:-1]]
+    batch_sizes = [max(1, int(max_frames // lengths[end])) for end in group_ends]
+    if max_batch_size:
+        batch_sizes = [min(b, max_batch_size) for b in batch_sizes]
+    padding_ratio = padding[-1, -1] / (padding[-1, -1] + cum_frames[-1])
+    return boundaries, batch_sizes, padding_ratio
+
+def prepare_dataset_for_training(ds, config, feat_config, label2onehot, model_id, conf_checksum='', verbosity=0, num_frames=None):
+    """
+    If config has frame_budget_batching, num_frames must contain the amount of frames of all sequences in ds, from which the bucket boundaries are computed.
+    """
     if "frames" in config:
         raise NotImplementedError("todo")
         if verbosity:
@@ -305,7 +543,8 @@ def prepare_dataset_for_training(ds, config, feat_config, label2onehot, model_id
     if "bucket_by_sequence_length" in config:
         if verbosity:
             print("Batching features by bucketing samples into fixed length, padded sequence length buckets")
-        seq_len_fn = lambda feats, meta: tf.shape(feats)[0]
+        # Padded frames can be excluded from the model computations by masking them, e.g. with mask_value of xvector.loader equal to the padding value
+        seq_len_fn = lambda feats, *meta: tf.shape(feats)[0]
         bucket_conf = config["bucket_by_sequence_length"]
         bucket_boundaries = np.linspace(
             bucket_conf["bins"]["min"],
@@ -319,11 +558,31 @@ def prepare_dataset_for_training(ds, config, feat_config, label2onehot, model_id
             bucket_batch_sizes,
             **bucket_conf.get("kwargs", {}))
         ds = ds.apply(bucketing_fn)
+    elif "frame_budget_batching" in config:
+        assert "batch_size" not in config and "padded_batch" not in config, "frame_budget_batching cannot be combined with batch_size or padded_batch"
+        assert num_frames is not None, "frame_budget_batching requires the amount of frames of all sequences"
+        budget_conf = config["frame_budget_batching"]
+        bucket_boundaries, bucket_batch_sizes, padding_ratio = frame_budget_buckets(
+            num_frames,
+            budget_conf["max_frames"],
+            budget_conf.get("num_buckets", 8),
+            budget_conf.get("max_batch_size"))
+        if verbosity:
+            print("Batching features into batches of at most {} frames, using {} buckets computed from the lengths of {} sequences".format(budget_conf["max_frames"], len(bucket_batch_sizes), len(num_frames)))
+            print("Bucket boundaries {} with batch sizes {}, at most {:.1f}% of the frames are padding".format(bucket_boundaries, bucket_batch_sizes, 100 * padding_ratio))
+        if verbosity and np.max(num_frames) > budget_conf["max_frames"]:
+            print("Warning: longest sequence has {} frames, which exceeds max_frames {}".format(np.max(num_frames), budget_conf["max_frames"]))
+        seq_len_fn = lambda feats, *meta: tf.shape(feats)[0]
+        ds = ds.apply(tf.data.experimental.bucket_by_sequence_length(
+            seq_len_fn,
+            bucket_boundaries,
+            bucket_batch_sizes,
+            **budget_conf.get("kwargs", {})))
     elif "group_by_sequence_length" in config:
         max_batch_size = tf.constant(config["group_by_sequence_length"]["max_batch_size"], tf.int64)
         if verbosity:
             tf_print("Grouping samples by sequence length into batches of max size", max_batch_size)
-        get_seq_len = lambda feat, meta: tf.cast(tf.shape(feat)[0], tf.int64)
+        get_seq_len = lambda feat, *meta: tf.cast(tf.shape(feat)[0], tf.int64)
         group_to_batch = lambda key, group: group.batch(max_batch_size)
         ds = ds.apply(tf.data.experimental.group_by_window(get_seq_len, group_to_batch, window_size=max_batch_size))
         if "min_batch_size" in config["group_by_sequence_length"]:
@@ -331,9 +590,9 @@ def prepare_dataset_for_training(ds, config, feat_config, label2onehot, model_id
             if verbosity:
                 print("Dropping batches smaller than min_batch_size", min_batch_size)
             min_batch_size = tf.constant(min_batch_size, tf.int32)
-            ds = ds.filter(lambda batch, meta: (tf.shape(batch)[0] >= min_batch_size))
+            ds = ds.filter(lambda batch, *meta: (tf.shape(batch)[0] >= min_batch_size))
     if config.get("copy_cache_to_tmp", False):
-        tmp_cache_path = "/tmp/tensorflow-cache/{}/training-prepared_{}_{}".format(model_id, int(time.time()), conf_checksum)
+        tmp_cache_path = "/tmp/tensorflow-cache/{}/training-prepared_{}_{}_{}".format(model_id, int(time.time()), os.getpid(), conf_checksum)
         if verbosity:
             print("Caching prepared dataset iterator to '{}'".format(tmp_cache_path))
         os.makedirs(os.path.dirname(tmp_cache_path), exist_ok=True)
@@ -421,7 +680,76 @@ def snr_mixer(clean, noise, snr):
     noisyspeech = clean + noisenewlevel
     return clean, noisenewlevel, noisyspeech
 
-def get_chunk_loader(wav_config, verbosity, datagroup_key):
+NoiseBank = collections.namedtuple("NoiseBank", ["signal", "cumulative_energy"])
+
+def load_noise_bank(paths, sample_rate, cache_path=None):
+    """
+    Decode and resample all noise files once and concatenate them into a single contiguous signal.
+    The cumulative sum of squared samples is precomputed so that the RMS of any slice of the bank can be computed in constant time.
+    If cache_path is given, the bank is saved as .npy files at cache_path and memory mapped on all subsequent loads.
+    """
+    signal_path = cache_path + ".signal.npy" if cache_path else None
+    energy_path = cache_path + ".energy.npy" if cache_path else None
+    if cache_path and os.path.exists(energy_path):
+        return NoiseBank(np.load(signal_path, mmap_mode='r'), np.load(energy_path, mmap_mode='r'))
+    signal = np.concatenate([librosa.core.load(path, sr=sample_rate, mono=True)[0] for path in paths]).astype(np.float32)
+    cumulative_energy = np.concatenate(([0.0], np.cumsum(np.square(signal, dtype=np.float64))))
+    if not cache_path:
+        return NoiseBank(signal, cumulative_energy)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    # The energy file is written last and marks the cached bank complete
+    np.save(signal_path, signal)
+    np.save(energy_path + ".tmp.npy", cumulative_energy)
+    os.rename(energy_path + ".tmp.npy", energy_path)
+    return NoiseBank(np.load(signal_path, mmap_mode='r'), np.load(energy_path, mmap_mode='r'))
+
+def sample_noise(noise_bank, length):
+    """Return a random slice of given length from noise_bank and the RMS of the slice. The slice is a view into the bank, unless the bank is shorter than length."""
+    bank_size = noise_bank.signal.size
+    if bank_size >= length:
+        begin = random.randint(0, bank_size - length)
+        noise = noise_bank.signal[begin:begin+length]
+        energy = noise_bank.cumulative_energy[begin+length] - noise_bank.cumulative_energy[begin]
+    else:
+        noise = np.resize(noise_bank.signal, length)
+        energy = np.square(noise, dtype=np.float64).sum()
+    return noise, np.sqrt(energy / length)
+
+def snr_mixer_batch(clean, noises, noise_rms, snrs):
+    """
+    Vectorized snr_mixer for mixing one clean signal with all rows of noises, each having the same length as clean.
+    Returns the noisy signals as rows of a matrix.
+    """
+    target_rms = 10 ** (-25 / 20)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        clean = clean * (target_rms / np.sqrt(np.mean(np.square(clean, dtype=np.float64))))
+        # Both signals have RMS equal to target_rms after normalization, hence the noise scale depends only on the SNR
+        noise_scale = target_rms / np.asarray(noise_rms) * np.sqrt(10 ** (-np.asarray(snrs, dtype=np.float64) / 20))
+        return (clean[np.newaxis,:] + noise_scale[:,np.newaxis] * noises).astype(np.float32)
+
+def drop_silence(signal, sr, vad_config, verbosity=0):
+    """Drop all frames of signal that webrtcvad does not classify as speech, except non-speech segments shorter than vad_config['min_non_speech_length_ms']."""
+    vad_frame_ms = vad_config["frame_ms"]
+    assert vad_frame_ms in (10, 20, 30)
+    assert sr in (8000, 16000, 32000, 48000), "unexpected sample rate {}, webrtcvad supports only 8, 16, 32 and 48 kHz".format(sr)
+    frame_length = int(sr * 1e-3 * vad_frame_ms)
+    num_frames = signal.size // frame_length
+    frames = signal[:num_frames*frame_length].reshape(num_frames, frame_length)
+    vad_decisions = vad_engine.parallel_webrtcvad_decisions(
+        audio_feat.float_to_pcm16(signal),
+        sr,
+        np.arange(num_frames) * frame_length,
+        frame_length,
+        vad_config["aggressiveness"])
+    min_non_speech_frames = vad_config["min_non_speech_length_ms"] // vad_frame_ms
+    # too short non-speech segments are not dropped
+    vad_decisions = vad_engine.fill_short_non_speech(vad_decisions, min_non_speech_frames)
+    voiced_signal = frames[vad_decisions].reshape(-1)
+    if verbosity > 3:
+        print("dropping {} frames due to vad, signal shape {} voiced_signal shape {}".format(int((~vad_decisions).sum()), signal.shape, voiced_signal.shape))
+    return voiced_signal
+
+def get_chunk_loader(wav_config, verbosity, datagroup_key, pcm_corpus=None, resampled_audio_cache_dir=None):
     chunks = wav_config["chunks"]
     target_sr = wav_config.get("target_sample_rate")
     augment_config = wav_config.get("augmentation", [])
@@ -430,6 +758,11 @@ def get_chunk_loader(wav_config, verbosity, datagroup_key):
             print("skipping augmentation due to non-training datagroup: '{}'".format(datagroup_key), file=sys.stderr)
         augment_config = []
     vad_config = wav_config.get("webrtcvad")
+    res_type = wav_config.get("resampling", {}).get("type", "kaiser_best")
+    if verbosity > 1:
+        print("Resampling audio with librosa resampler '{}'".format(res_type), file=sys.stderr)
+        if resampled_audio_cache_dir:
+            print("Caching resampled audio in '{}'".format(resampled_audio_cache_dir), file=sys.stderr)
     for conf in augment_config:
         # prepare noise augmentation
         if conf["type"] == "additive_noise":
@@ -441,55 +774,30 @@ def get_chunk_loader(wav_config, verbosity, datagroup_key):
             with open(os.path.join(noise_source_dir, "id2path")) as f:
                 for id, path in (l.strip().split() for l in f):
                     label2path[id2label[id]].append(path)
-            for noise_type, noise_paths in label2path.items():
-                conf["noise_source"][noise_type] = noise_paths
-    def drop_silence(signal, sr):
-        vad_frame_ms = vad_config["frame_ms"]
-        assert vad_frame_ms in (10, 20, 30)
-        assert sr == target_sr, "unexpected sample rate {}, cannot do vad_config because wav write would distort pitch".format(sr)
-        with contextlib.closing(io.BytesIO()) as buf:
-            soundfile.write(buf, signal, sr, format="WAV")
-            buf.seek(0)
-            pcm_data, sr = read_wave(buf)
-        assert sr == target_sr, "vad_config failed during WAV read"
-        step = int(sr * 1e-3 * vad_frame_ms * 2)
-        if signal.size < step//2:
-            return np.zeros(0, dtype=signal.dtype)
-        frames = librosa.util.frame(signal, step//2, step//2, axis=0)
-        vad_decisions = np.ones(frames.shape[0], dtype=np.bool)
-        min_non_speech_frames = vad_config["min_non_speech_length_ms"] // vad_frame_ms
-        vad = webrtcvad.Vad(vad_config["aggressiveness"])
-        non_speech_begin = -1
-        for f, i in enumerate(range(0, len(pcm_data) - len(pcm_data) % step, step)):
-            if not vad.is_speech(pcm_data[i:i+step], sr):
-                vad_decisions[f] = False
-                if non_speech_begin < 0:
-                    non_speech_begin = f
-            else:
-                if non_speech_begin >= 0 and f - non_speech_begin < min_non_speech_frames:
-                    # too short non-speech segment, revert all non-speech decisions up to f
-                    vad_decisions[np.arange(non_speech_begin, f)] = True
-                non_speech_begin = -1
-        voiced_frames = frames[vad_decisions]
-        if voiced_frames.size > 0:
-            voiced_signal = np.concatenate(voiced_frames, axis=0)
-        else:
-            voiced_signal = np.zeros(0, dtype=signal.dtype)
-        if verbosity > 3:
-            print("dropping {} frames due to vad, signal shape {} voiced_signal shape {}".format(int((~vad_decisions).sum()), signal.shape, voiced_signal.shape))
-        return voiced_signal
-    def chunker(signal, sr, meta):
-        chunk_len = int(sr * 1e-3 * chunks["length_ms"])
-        chunk_step = int(sr * 1e-3 * chunks["step_ms"])
-        if signal.size >= chunk_len:
-            for i, chunk in enumerate(librosa.util.frame(signal, chunk_len, chunk_step, axis=0)):
-                chunk_uttid = tf.strings.join((meta[0], "-{:06d}".format(i)))
-                yield (chunk, sr), chunk_uttid, meta[1]
+            assert target_sr, "additive_noise augmentation requires target_sample_rate"
+            cache_dir = conf.get("noise_bank_cache")
+            for noise_type, noise_paths in sorted(label2path.items()):
+                cache_path = None
+                if cache_dir:
+                    paths_checksum = hashlib.md5('\n'.join(noise_paths).encode("utf-8")).hexdigest()
+                    cache_path = os.path.join(cache_dir, "{}_{}Hz_{}".format(noise_type, target_sr, paths_checksum))
+                if verbosity:
+                    print("loading noise bank for noise type '{}' from {} files".format(noise_type, len(noise_paths)), file=sys.stderr)
+                conf["noise_source"][noise_type] = load_noise_bank(noise_paths, target_sr, cache_path)
+    def load_signal(wav_path, utt):
+        entry = pcm_corpus.index.get(utt.decode("utf-8")) if pcm_corpus is not None else None
+        if entry is None or entry.path != wav_path.decode("utf-8"):
+            return system.load_resampled_audio(wav_path.decode("utf-8"), target_sr, resampled_audio_cache_dir, res_type)
+        # Slice the pre-decoded samples from the memory mapped corpus instead of decoding the file
+        signal = pcm_corpus.samples[entry.offset:entry.offset+entry.length].astype(np.float32) / 32768.0
+        if target_sr and entry.sample_rate != target_sr:
+            return system.load_resampled_audio(entry.path, target_sr, resampled_audio_cache_dir, res_type, decoded=(signal, entry.sample_rate))
+        return signal, entry.sample_rate
     def chunk_loader(wav_path, meta):
         utt, label, dataset = meta[:3]
-        original_signal, sr = librosa.core.load(wav_path, sr=target_sr, mono=True)
+        original_signal, sr = load_signal(wav_path, utt)
         if vad_config:
-            original_signal = drop_silence(original_signal, sr)
+            original_signal = drop_silence(original_signal, sr, vad_config, verbosity)
         chunk_length = int(sr * 1e-3 * chunks["length_ms"])
         if original_signal.size < chunk_length:
             if verbosity:
@@ -498,49 +806,89 @@ def get_chunk_loader(wav_config, verbosity, datagroup_key):
                               original_signal.size,
                               wav_path.decode("utf-8")), file=sys.stderr)
             return
-        yield from chunker(original_signal, target_sr, meta)
+        # Chunking and speed perturbation are applied outside the generator, the last element is the speed perturbation rate
+        yield (original_signal, sr), utt, label, 1.0
         for conf in augment_config:
             if "datasets_include" in conf and dataset not in conf["datasets_include"]:
                 continue
             if "datasets_exclude" in conf and dataset in conf["datasets_exclude"]:
                 continue
             if conf["type"] == "random_resampling":
-                # apply naive speed modification by resampling
                 rate = np.random.uniform(conf["range"][0], conf["range"][1])
-                with contextlib.closing(io.BytesIO()) as buf:
-                    soundfile.write(buf, original_signal, int(rate * target_sr), format="WAV")
-                    buf.seek(0)
-                    signal, _ = librosa.core.load(buf, sr=target_sr, mono=True)
                 new_uttid = tf.strings.join((utt, "-speed{:.3f}".format(rate)))
-                yield from chunker(signal, target_sr, (new_uttid, *meta[1:]))
+                yield (original_signal, sr), new_uttid, label, rate
             elif conf["type"] == "additive_noise":
-                for noise_type, db_min, db_max in conf["snr_def"]:
-                    noise_signal = np.zeros(0, dtype=original_signal.dtype)
-                    noise_paths = []
-                    while noise_signal.size < original_signal.size:
-                        rand_noise_path = random.choice(conf["noise_source"][noise_type])
-                        noise_paths.append(rand_noise_path)
-                        sig, _ = librosa.core.load(rand_noise_path, sr=target_sr, mono=True)
-                        noise_signal = np.concatenate((noise_signal, sig))
-                    noise_begin = random.randint(0, noise_signal.size - original_signal.size)
-                    noise_signal = noise_signal[noise_begin:noise_begin+original_signal.size]
-                    snr_db = random.randint(db_min, db_max)
-                    clean, noise, clean_and_noise = snr_mixer(original_signal, noise_signal, snr_db)
+                noise_types = [noise_type for noise_type, _, _ in conf["snr_def"]]
+                snrs = [random.randint(db_min, db_max) for _, db_min, db_max in conf["snr_def"]]
+                noises, noise_rms = zip(*(sample_noise(conf["noise_source"][noise_type], original_signal.size) for noise_type in noise_types))
+                noisy_signals = snr_mixer_batch(original_signal, np.stack(noises), noise_rms, snrs)
+                for noise_type, snr_db, clean_and_noise in zip(noise_types, snrs, noisy_signals):
                     new_uttid = tf.strings.join((utt, "-{:s}_snr{:d}".format(noise_type, snr_db)))
                     if not np.all(np.isfinite(clean_and_noise)):
                         if verbosity:
                             print("warning: snr_mixer failed, augmented signal '{}' has non-finite values and will be skipped. "
-                                  "Utterance source was '{}', and chosen noise signals were\n  {}"
-                                  .format(new_uttid.numpy().decode("utf-8"), wav_path.decode("utf-8"), '\n  '.join(noise_paths)),
+                                  "Utterance source was '{}'"
+                                  .format(new_uttid.numpy().decode("utf-8"), wav_path.decode("utf-8")),
                                   file=sys.stderr)
-                        return
-                    yield from chunker(clean_and_noise, target_sr, (new_uttid, *meta[1:]))
+                        continue
+                    yield (clean_and_noise, sr), new_uttid, label, 1.0
     if verbosity:
-        tf_print("Using wav chunk loader, generating chunks of length {} with step size {} (milliseconds)".format(chunks["length_ms"], chunks["step_ms"]))
+        tf_print("Using wav loader, generating chunks of length {} with step size {} (milliseconds)".format(chunks["length_ms"], chunks["step_ms"]))
     return chunk_loader
 
-def get_random_chunk_loader(paths, meta, wav_config, verbosity=0):
-    raise NotImplementedError("todo")
+def get_wav_chunker(chunks):
+    """Returns a function for Dataset.flat_map that divides a wav into fixed length chunks, with utterance ids uttid-000000, uttid-000001, etc."""
+    def chunk_wav(wav, uttid, label):
+        chunk_length = audio_feat.ms_to_frames(wav.sample_rate, chunks["length_ms"])
+        chunk_step = audio_feat.ms_to_frames(wav.sample_rate, chunks["step_ms"])
+        audio_chunks = tf.signal.frame(wav.audio, chunk_length, chunk_step, axis=0)
+        num_chunks = tf.shape(audio_chunks)[0]
+        chunk_uttids = tf.strings.join((uttid, tf.strings.as_string(tf.range(num_chunks), width=6, fill='0')), separator='-')
+        return tf.data.Dataset.from_tensor_slices((
+            audio_feat.Wav(audio_chunks, tf.fill([num_chunks], wav.sample_rate)),
+            chunk_uttids,
+            tf.fill([num_chunks], label)))
+    return chunk_wav
+
+CHUNK_SCORE_AGGREGATIONS = ("mean_loglik", "mean_posterior", "max")
+
+def chunk_source_uttids(chunk_uttids):
+    """Remove the chunk index suffix -000000, -000001, etc. added by get_wav_chunker and get_random_chunker from chunk utterance ids."""
+    return tf.strings.regex_replace(chunk_uttids, "-[0-9]{6}$", "")
+
+@tf.function
+def reduce_chunk_scores(chunk_uttids, scores, method, output_activation=None):
+    """
+    Reduce the scores of all chunks in a batch into one row of scores for each source utterance of the chunks.
+    Scores are first converted to log posteriors according to output_activation, which is 'log_softmax', 'softmax' or None for logits.
+    Returns the unique source utterance ids, and for each source utterance the sum of log posteriors if method is 'mean_loglik', the sum of posteriors if method is 'mean_posterior', or the maximum log posteriors if method is 'max', and the amount of chunks.
+    The sums must be divided by the amount of chunks after all batches have been reduced.
+    """
+    if output_activation == "log_softmax":
+        log_posteriors = scores
+    elif output_activation == "softmax":
+        log_posteriors = tf.math.log(tf.math.maximum(scores, 1e-30))
+    else:
+        log_posteriors = tf.nn.log_softmax(scores)
+    source_uttids, segment_ids = tf.unique(chunk_source_uttids(chunk_uttids))
+    num_segments = tf.size(source_uttids)
+    num_chunks = tf.math.unsorted_segment_sum(tf.ones_like(segment_ids), segment_ids, num_segments)
+    if method == "mean_loglik":
+        reduced = tf.math.unsorted_segment_sum(log_posteriors, segment_ids, num_segments)
+    elif method == "mean_posterior":
+        reduced = tf.math.unsorted_segment_sum(tf.math.exp(log_posteriors), segment_ids, num_segments)
+    elif method == "max":
+        reduced = tf.math.unsorted_segment_max(log_posteriors, segment_ids, num_segments)
+    else:
+        raise ValueError("unknown chunk score aggregation method '{}', expected one of {}".format(method, CHUNK_SCORE_AGGREGATIONS))
+    return source_uttids, reduced, num_chunks
+
+def get_random_chunker(wav_config, verbosity=0):
+    """
+    Returns a function for Dataset.map that divides a wav into a batch of chunks of random length, with utterance ids uttid-000000, uttid-000001, etc.
+    All chunk boundaries of a wav are drawn at once and the chunks are sliced from the signal with a single ragged gather.
+    The audio of the returned chunks is ragged, use unbatch_random_chunks to convert the batch into a dataset of chunks with dense audio.
+    """
     chunk_config = wav_config["wav_to_random_chunks"]
     sample_rate = wav_config["filter_sample_rate"]
     lengths = tf.cast(
@@ -551,36 +899,84 @@ def get_random_chunk_loader(paths, meta, wav_config, verbosity=0):
         ),
         tf.int32
     )
-    def get_random_length():
-        rand_index = tf.random.uniform([], 0, tf.size(lengths), dtype=tf.int32)
-        rand_len = tf.gather(lengths, rand_index)
-        return rand_len
     overlap_ratio = float(chunk_config["length"]["overlap_ratio"])
     assert overlap_ratio < 1.0
     min_chunk_length = int(sample_rate * chunk_config["min_chunk_length"])
     assert min_chunk_length > 0, "invalid min chunk length"
-    def random_chunk_loader():
-        for p, *m in zip(paths, meta):
-            wav = load_wav(tf.constant(p, tf.string))
-            if "filter_sample_rate" in wav_config and wav.sample_rate != wav_config["filter_sample_rate"]:
-                if verbosity:
-                    print("skipping file", p, ", it has a sample rate", wav.sample_rate, "but config has 'filter_sample_rate'", wav_config["filter_sample_rate"], file=sys.stderr)
-                continue
-            begin = 0
-            rand_len = get_random_length()
-            chunk = wav.audio[begin:begin+rand_len]
-            while len(chunk) >= min_chunk_length:
-                yield (audio_feat.Wav(chunk, wav.sample_rate), *m)
-                begin += round((1.0 - overlap_ratio) * float(rand_len))
-                rand_len = get_random_length()
-                chunk = wav.audio[begin:begin+rand_len]
+    # Step from the beginning of a chunk to the beginning of the next chunk, for each chunk length, computed from the integer lengths
+    length_steps = tf.math.maximum(1, tf.cast(tf.math.round((1.0 - overlap_ratio) * tf.cast(lengths, tf.float32)), tf.int32))
+    min_step = tf.math.reduce_min(length_steps)
+    def random_chunks(wav, uttid, label):
+        signal_length = tf.size(wav.audio)
+        max_num_chunks = signal_length // min_step + 1
+        length_indices = tf.random.uniform([max_num_chunks], 0, tf.size(lengths), dtype=tf.int32)
+        rand_lengths = tf.gather(lengths, length_indices)
+        steps = tf.gather(length_steps, length_indices)
+        begin = tf.math.cumsum(steps, exclusive=True)
+        end = tf.math.minimum(begin + rand_lengths, signal_length)
+        # Chunks are taken from the beginning of the signal until the first chunk that is too short
+        is_valid = tf.concat((end - begin >= min_chunk_length, [False]), axis=0)
+        num_chunks = tf.cast(tf.math.argmin(tf.cast(is_valid, tf.int32)), tf.int32)
+        begin, end = begin[:num_chunks], end[:num_chunks]
+        audio_chunks = tf.gather(wav.audio, tf.ragged.range(begin, end))
+        chunk_uttids = tf.strings.join((uttid, tf.strings.as_string(tf.range(num_chunks), width=6, fill='0')), separator='-')
+        return (
+            audio_feat.Wav(audio_chunks, tf.fill([num_chunks], wav.sample_rate)),
+            chunk_uttids,
+            tf.fill([num_chunks], label))
     if verbosity:
-        tf_print("Using random wav chunk loader, drawing lengths (in frames) from", lengths, "with", overlap_ratio, "overlap ratio and", min_chunk_length, "minimum chunk length")
-    return random_chunk_loader
+        tf_print("Using random wav chunker, drawing lengths (in frames) from", lengths, "with", overlap_ratio, "overlap ratio and", min_chunk_length, "minimum chunk length")
+    return random_chunks
 
-# Use batch_size > 1 iff _every_ audio file in paths has the same amount of samples
+def unbatch_random_chunks(wavs, uttids, labels):
+    """Dataset.flat_map function for the batches of chunks returned by the random_chunks function of get_random_chunker."""
+    def get_chunk(i):
+        # Indexing a row of the ragged batch gives a dense signal
+        return audio_feat.Wav(wavs.audio[i], wavs.sample_rate[i]), uttids[i], labels[i]
+    return tf.data.Dataset.range(tf.cast(tf.size(uttids), tf.int64)).map(get_chunk)
+
+def get_pcm_corpus_loader(pcm_corpus):
+    """Returns a function that loads wavs by slicing them from a memory mapped PCM corpus, or from the wav files for utterances missing from the corpus."""
+    def read_samples(offset, length):
+        return np.asarray(pcm_corpus.samples[offset:offset+length])
+    @tf.function
+    def load_wav_from_corpus(path, offset, length, sample_rate):
+        if offset < 0:
+            return load_wav(path)
+        samples = tf.numpy_function(read_samples, [offset, length], tf.int16)
+        samples.set_shape([None])
+        return audio_feat.Wav(tf.cast(samples, tf.float32) / 32768.0, sample_rate)
+    return load_wav_from_corpus
+
+def load_wavs(paths, meta, pcm_corpus=None, verbosity=0):
+    """Returns a dataset of (wav, uttid, label) elements, where wavs are decoded from paths or sliced from pcm_corpus, if given."""
+    wav_paths = tf.data.Dataset.from_tensor_slices((
+        tf.constant(paths, dtype=tf.string),
+        tf.constant(meta, dtype=tf.string)))
+    if pcm_corpus is not None:
+        if verbosity:
+            print("Loading wavs from memory mapped PCM corpus with {} utterances".format(len(pcm_corpus.index)))
+        entries = [pcm_corpus.index.get(m[0]) for m in meta]
+        entries = [e if e is not None and e.path == p else None for p, e in zip(paths, entries)]
+        if verbosity and any(e is None for e in entries):
+            print("{} utterances are missing from the PCM corpus and will be read from their wav files".format(sum(e is None for e in entries)))
+        corpus_slices = tf.data.Dataset.from_tensor_slices((
+            tf.constant([e.offset if e else -1 for e in entries], tf.int64),
+            tf.constant([e.length if e else 0 for e in entries], tf.int64),
+            tf.constant([e.sample_rate if e else 0 for e in entries], tf.int32)))
+        load_wav_from_corpus = get_pcm_corpus_loader(pcm_corpus)
+        # Keep only (uttid, label) as metadata, same as the wav chunk loaders
+        load_wav_with_meta = lambda path_meta, corpus_slice: (load_wav_from_corpus(path_meta[0], *corpus_slice), path_meta[1][0], path_meta[1][1])
+        wavs = tf.data.Dataset.zip((wav_paths, corpus_slices)).map(load_wav_with_meta, num_parallel_calls=TF_AUTOTUNE)
+    else:
+        # Keep only (uttid, label) as metadata, same as the wav chunk loaders
+        load_wav_with_meta = lambda path, meta: (load_wav(path), meta[0], meta[1])
+        wavs = wav_paths.map(load_wav_with_meta, num_parallel_calls=TF_AUTOTUNE)
+    return wavs
+
+# Use batch_size > 1 iff _every_ audio file in paths has the same amount of samples, or use batch_wavs_padded for signals of varying lengths
 # TODO: fix this mess
-def extract_features_from_paths(feat_config, paths, meta, datagroup_key, trim_audio=None, debug_squeeze_last_dim=False, verbosity=0):
+def extract_features_from_paths(feat_config, paths, meta, datagroup_key, trim_audio=None, debug_squeeze_last_dim=False, verbosity=0, pcm_corpus=None, resampled_audio_cache_dir=None):
     paths, meta = list(paths), [m[:3] for m in meta]
     assert len(paths) == len(meta), "Cannot extract features from paths when the amount of metadata {} does not match the amount of wavfile paths {}".format(len(meta), len(paths))
     wav_config = feat_config.get("wav_config")
@@ -588,13 +984,15 @@ def extract_features_from_paths(feat_config, paths, meta, datagroup_key, trim_au
         dataset_types = (
             (tf.float32, tf.int32),
             tf.string,
-            tf.string)
+            tf.string,
+            tf.float32)
         dataset_shapes = (
             (tf.TensorShape([None]), tf.TensorShape([])),
             tf.TensorShape([]),
+            tf.TensorShape([]),
             tf.TensorShape([]))
         if "chunks" in wav_config:
-            chunk_loader_fn = get_chunk_loader(wav_config, verbosity, datagroup_key)
+            chunk_loader_fn = get_chunk_loader(wav_config, verbosity, datagroup_key, pcm_corpus, resampled_audio_cache_dir)
             def ds_generator(*args):
                 return tf.data.Dataset.from_generator(
                     chunk_loader_fn,
@@ -611,39 +1009,91 @@ def extract_features_from_paths(feat_config, paths, meta, datagroup_key, trim_au
                         # The exact amount of workers is chosen by TensorFlow due to autotune, but this will be the maximum
                         cycle_length=wav_config.get("workers_per_cpu", 16)*len(os.sched_getaffinity(0)),
                         num_parallel_calls=TF_AUTOTUNE))
+            # Speed perturbation is applied on full signals, in parallel, before dividing them into chunks
+            change_speed = lambda wav, uttid, label, rate: (audio_feat.change_speed(audio_feat.Wav(wav[0], wav[1]), rate), uttid, label)
+            wavs = (wavs
+                    .map(change_speed, num_parallel_calls=TF_AUTOTUNE)
+                    .flat_map(get_wav_chunker(wav_config["chunks"])))
+        elif "wav_to_random_chunks" in wav_config:
+            wavs = load_wavs(paths, meta, pcm_corpus, verbosity)
+            if "filter_sample_rate" in wav_config:
+                filter_sample_rate = wav_config["filter_sample_rate"]
+                if verbosity:
+                    print("Dropping all wavs with sample rate other than", filter_sample_rate)
+                wavs = wavs.filter(lambda wav, *meta: wav.sample_rate == filter_sample_rate)
+            wavs = (wavs
+                    .map(get_random_chunker(wav_config, verbosity), num_parallel_calls=TF_AUTOTUNE)
+                    .flat_map(unbatch_random_chunks))
         else:
             print("unknown, non-empty wav_config given:")
             yaml_pprint(wav_config)
             raise NotImplementedError
-        wavs = wavs.map(lambda wav, *meta: (audio_feat.Wav(wav[0], wav[1]), *meta))
     else:
-        wav_paths = tf.data.Dataset.from_tensor_slices((
-            tf.constant(paths, dtype=tf.string),
-            tf.constant(meta, dtype=tf.string)))
-        load_wav_with_meta = lambda path, *meta: (load_wav(path), *meta)
-        wavs = wav_paths.map(load_wav_with_meta, num_parallel_calls=TF_AUTOTUNE)
-    if "batch_wavs_by_length" in feat_config:
-        window_size = feat_config["batch_wavs_by_length"]["max_batch_size"]
+        wavs = load_wavs(paths, meta, pcm_corpus, verbosity)
+    feat_extract_args = feat_extraction_args_as_list(feat_config)
+    frontend = None
+    if "frontend_layer" in feat_config:
+        frontend = get_frontend_layer(feat_config)
         if verbosity:
-            print("Batching all wavs by equal length into batches of max size {}".format(window_size))
-        key_fn = lambda wav, *meta: tf.cast(tf.size(wav.audio), tf.int64)
-        reduce_fn = lambda key, group_ds: group_ds.batch(window_size)
-        group_by_wav_length = tf.data.experimental.group_by_window(key_fn, reduce_fn, window_size)
-        wavs_batched = wavs.apply(group_by_wav_length)
+            print("Extracting features with front-end layer '{}' for sample rate {}".format(frontend.name, frontend.sample_rate))
+    if "batch_wavs_padded" in feat_config:
+        batch_size = feat_config["batch_wavs_padded"]["batch_size"]
+        if verbosity:
+            print("Batching wavs of varying lengths into zero padded batches of size {}".format(batch_size))
+        padded_shapes = (
+            audio_feat.Wav(tf.TensorShape([None]), tf.TensorShape([])),
+            tf.TensorShape([]),
+            tf.TensorShape([]),
+            tf.TensorShape([]))
+        wavs_batched = (wavs
+                .map(lambda wav, *meta: (wav, tf.size(wav.audio), *meta))
+                .padded_batch(batch_size, padded_shapes=padded_shapes))
+        if verbosity:
+            print("Applying feature extractor to padded batches of wavs")
+        # Feature scaling and mean_var_norm_slide depend on all frames of an utterance and are applied after dropping the padding
+        *extract_args, feat_scale_kwargs, mean_var_norm_kwargs = feat_extract_args
+        spec_kwargs = extract_args[1]
+        extract_feats = lambda wavs, lengths, *meta: (
+            extract_features(wavs, *extract_args, {}, {}, lengths=lengths, frontend=frontend),
+            audio_feat.spectrogram_lengths(lengths, wavs.sample_rate, **spec_kwargs),
+            lengths,
+            (*meta, wavs)
+        )
+        def drop_padding(feats, num_frames, length, meta):
+            *meta, wav = meta
+            feats = tf.expand_dims(feats[:num_frames], 0)
+            feats = apply_feature_normalization(feats, feat_scale_kwargs, mean_var_norm_kwargs)
+            wav = audio_feat.Wav(wav.audio[:length], wav.sample_rate)
+            # Batches of one utterance, same as the output of extract_features with batch size 1
+            return feats, tf.nest.map_structure(lambda t: tf.expand_dims(t, 0), (*meta, wav))
+        features = (wavs_batched
+                .map(extract_feats, num_parallel_calls=TF_AUTOTUNE)
+                .unbatch()
+                # Signals shorter than one spectrogram frame produce no features
+                .filter(lambda feats, num_frames, *rest: num_frames > 0)
+                .map(drop_padding, num_parallel_calls=TF_AUTOTUNE))
     else:
-        batch_size = feat_config.get("batch_size", 1)
+        if "batch_wavs_by_length" in feat_config:
+            window_size = feat_config["batch_wavs_by_length"]["max_batch_size"]
+            if verbosity:
+                print("Batching all wavs by equal length into batches of max size {}".format(window_size))
+            key_fn = lambda wav, *meta: tf.cast(tf.size(wav.audio), tf.int64)
+            reduce_fn = lambda key, group_ds: group_ds.batch(window_size)
+            group_by_wav_length = tf.data.experimental.group_by_window(key_fn, reduce_fn, window_size)
+            wavs_batched = wavs.apply(group_by_wav_length)
+        else:
+            batch_size = feat_config.get("batch_size", 1)
+            if verbosity:
+                print("Batching wavs with batch size", batch_size)
+            wavs_batched = wavs.batch(batch_size)
         if verbosity:
-            print("Batching wavs with batch size", batch_size)
-        wavs_batched = wavs.batch(batch_size)
-    if verbosity:
-        print("Applying feature extractor to batched wavs")
-    feat_extract_args = feat_extraction_args_as_list(feat_config)
-    # This function expects batches of wavs
-    extract_feats = lambda wavs, *meta: (
-        extract_features(wavs, *feat_extract_args),
-        (*meta, wavs)
-    )
-    features = wavs_batched.map(extract_feats, num_parallel_calls=TF_AUTOTUNE)
+            print("Applying feature extractor to batched wavs")
+        # This function expects batches of wavs
+        extract_feats = lambda wavs, *meta: (
+            extract_features(wavs, *feat_extract_args, frontend=frontend),
+            (*meta, wavs)
+        )
+        features = wavs_batched.map(extract_feats, num_parallel_calls=TF_AUTOTUNE)
     if "mean_var_norm_numpy" in feat_config:
         window_len = tf.constant(feat_config["mean_var_norm_numpy"]["window_len"], tf.int32)
         normalize_variance = tf.constant(feat_config["mean_var_norm_numpy"].get("normalize_variance", True), tf.bool)
@@ -0,0 +1,80 @@
+"""
+WebRTC VAD decisions computed in a pool of worker processes.
+This module does not import TensorFlow, so the worker processes stay small and the VAD loops run outside of the GIL of the process running the tf.data pipeline.
+Note that multiprocessing imports the main module of the program in every worker, so the main module should not import TensorFlow at the top level, like lidbox.__main__.
+"""
+import atexit
+import concurrent.futures
+import multiprocessing
+import os
+import threading
+
+import numpy as np
+import webrtcvad
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor(num_workers=None):
+    global _executor
+    # Called concurrently from parallel tf.data map threads
+    with _executor_lock:
+        if _executor is None:
+            if num_workers is None:
+                num_workers = len(os.sched_getaffinity(0))
+            # Forking a process that is already running TensorFlow threads is not safe.
+            # The workers are forked from a server process that has imported only this module.
+            mp_context = multiprocessing.get_context("forkserver")
+            mp_context.set_forkserver_preload([__name__])
+            _executor = concurrent.futures.ProcessPoolExecutor(num_workers, mp_context=mp_context)
+            atexit.register(shutdown_executor)
+        return _executor
+
+def shutdown_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
+
+def webrtcvad_decisions(pcm, sample_rate, frame_begin, frame_length, aggressiveness):
+    """For every sample index in frame_begin, run webrtcvad on the frame_length int16 PCM samples starting at that index."""
+    vad = webrtcvad.Vad(int(aggressiveness))
+    pcm = np.asarray(pcm, dtype=np.int16)
+    decisions = np.zeros(len(frame_begin), dtype=np.bool_)
+    for i, begin in enumerate(frame_begin):
+        decisions[i] = vad.is_speech(pcm[begin:begin+frame_length].tobytes(), int(sample_rate))
+    return decisions
+
+def parallel_webrtcvad_decisions(pcm, sample_rate, frame_begin, frame_length, aggressiveness):
+    """
+    Same as webrtcvad_decisions, but evaluated in a worker process.
+    webrtcvad adapts to the signal it has seen, so all frames of a signal are evaluated in one task with one webrtcvad.Vad instance, and the decisions do not depend on how the work is divided.
+    Signals submitted concurrently, e.g. from parallel tf.data map threads, are evaluated in parallel workers.
+    The task receives only the slice of pcm that the frames cover.
+    """
+    frame_begin = np.asarray(frame_begin, dtype=np.int64)
+    if frame_begin.size == 0:
+        return np.zeros(0, dtype=np.bool_)
+    offset = frame_begin.min()
+    future = get_executor().submit(
+        webrtcvad_decisions,
+        pcm[offset:frame_begin.max()+frame_length],
+        sample_rate,
+        frame_begin - offset,
+        frame_length,
+        aggressiveness)
+    return future.result()
+
+def fill_short_non_speech(decisions, min_length):
+    """Mark all non-speech segments shorter than min_length frames as speech, if they are followed by speech."""
+    decisions = np.array(decisions, dtype=np.bool_)
+    is_speech = np.concatenate(([True], decisions, [True])).astype(np.int8)
+    changes = np.diff(is_speech)
+    begin = np.flatnonzero(changes == -1)
+    end = np.flatnonzero(changes == 1)
+    fill = (end - begin < min_length) & (end < decisions.size)
+    fill_count = np.zeros(decisions.size + 1, dtype=np.int32)
+    np.add.at(fill_count, begin[fill], 1)
+    np.add.at(fill_count, end[fill], -1)
+    return decisions | (np.cumsum(fill_count[:-1]) > 0)